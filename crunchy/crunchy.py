@@ -5,6 +5,7 @@ from optparse import OptionParser
 import os
 import random
 import socket
+import time
 try:
     import webbrowser
 except:
@@ -45,29 +46,65 @@ def find_port(start=8001):
     testsock.close()
     return finalport
 
-def run_crunchy(host='127.0.0.1', port=None, url=None):
+def run_crunchy(host='127.0.0.1', port=None, url=None, server_mode='threaded',
+                keep_alive_timeout=None, profile_startup=False,
+                execution_mode='threads', run_timeout=None, output_limit=None):
     '''starts Crunchy
 
     * set the port to the value specified, or looks for a free one
     * open a web browser at given url, or a default if not specified
+    * serve requests using one thread per request (server_mode='threaded')
+      or an event loop (server_mode='async', requires Python 3.5+)
+    * keep idle connections open for keep_alive_timeout seconds, if specified
+    * run the code of the users in threads of the server
+      (execution_mode='threads') or in worker processes
+      (execution_mode='processes', requires Python 2.6+ on POSIX systems)
+    * interrupt the programs running for more than run_timeout seconds
+      without waiting for input, and drop their output beyond output_limit
+      characters, if specified (0: no limit)
+    * if profile_startup is True, only report the time taken to import and
+      register each plugin, without serving any request
     '''
     # delay importing these until we've parsed the options.
     import src.configuration
+    import src.utilities
     import src.http_serve as http_serve
     import src.pluginloader as pluginloader
+    import src.governor as governor
 
+    if keep_alive_timeout is not None:
+        http_serve.KEEP_ALIVE_TIMEOUT = keep_alive_timeout
+    if run_timeout is not None:
+        governor.RUN_TIMEOUT = run_timeout or None
+    if output_limit is not None:
+        governor.OUTPUT_LIMIT = output_limit or None
     if port is None:
         port = find_port()
     else:
         port = find_port(start=port)
-    server = http_serve.MyHTTPServer((host, port),
-                                     http_serve.HTTPRequestHandler)
+    if server_mode == 'async':
+        import src.async_serve as async_serve
+        server = async_serve.AsyncHTTPServer((host, port))
+    else:
+        server = http_serve.MyHTTPServer((host, port),
+                                         http_serve.HTTPRequestHandler)
 
     ## plugins will register possible additional keywords that
     ## configuration.py should have access to, before it is initialized
+    start = time.time()
     pluginloader.init_plugin_system(server)
     src.configuration.init()
     ##
+    if profile_startup:
+        print(pluginloader.startup_report())
+        print("Plugins and configuration initialized in %.1f ms" %
+              (1000*(time.time() - start)))
+        server.server_close()
+        return
+    if execution_mode == 'processes':
+        # before any request is handled: see process_exec.Zygote
+        import src.process_exec as process_exec
+        execution_backend = process_exec.init()
 
     base_url = 'http://' + host + ':' + str(port)
     if url is None:
@@ -80,6 +117,12 @@ def run_crunchy(host='127.0.0.1', port=None, url=None):
     print('\nCrunchy Server: serving up interactive tutorials at URL ' +
             url + '\n')
     server.still_serving = True
+    if server_mode == 'async':
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("Received Keyboard Interrupt, Quitting...")
+            server.still_serving = False
     while server.still_serving:
         try:
             server.handle_request()
@@ -87,6 +130,9 @@ def run_crunchy(host='127.0.0.1', port=None, url=None):
             print("Received Keyboard Interrupt, Quitting...")
             server.still_serving = False
     server.server_close()
+    if execution_mode == 'processes':
+        execution_backend.stop()
+    src.utilities.render_session_logs()
 
 usage = '''python crunchy.py [options]
 
@@ -145,12 +191,41 @@ def parse_options():
             help="Specifies the port number to try first (default is 8001) ")
     parser.add_option("--single", action="store_true", dest="single_user",
                       help="Start session in Single User Mode.")
+    parser.add_option("--server", action="store", type="choice",
+                      choices=["threaded", "async"], dest="server_mode",
+                      default="threaded",
+            help="threaded (default): one thread per request; async: event "\
+                 "driven server able to keep many more pages open (Python 3.5+)")
+    parser.add_option("--execution", action="store", type="choice",
+                      choices=["threads", "processes"], dest="execution_mode",
+                      default="threads",
+            help="threads (default): the code of the users is run by the "\
+                 "server; processes: it is run in worker processes, which can "\
+                 "be killed (Python 2.6+, not on Windows)")
+    parser.add_option("--keep_alive_timeout", action="store", type="int",
+                      dest="keep_alive_timeout",
+            help="Number of seconds an idle connection is kept open for reuse "\
+                 "by the browser (default is 10; 0 closes connections after "\
+                 "each request)")
+    parser.add_option("--run_timeout", action="store", type="int",
+                      dest="run_timeout",
+            help="Number of seconds a program can run without waiting for "\
+                 "input before being interrupted (default is 300; 0: no limit)")
+    parser.add_option("--output_limit", action="store", type="int",
+                      dest="output_limit",
+            help="Number of characters a program can write without waiting "\
+                 "for input; the rest is dropped (default is 1000000; 0: no "\
+                 "limit)")
     #parser.add_option("-d", "--debug", action="store_true", dest="debug",
     #        help="Enables interactive settings of debug flags "+\
     #             "(useful for developers)")
     #parser.add_option("--debug_ALL", action="store_true", dest="debug_all",
     #        help="Sets ALL the debug flags to True right from the start "+\
     #             "(useful for developers in case of major problems; not fully implemented)")
+    parser.add_option("--profile-startup", action="store_true",
+                      dest="profile_startup", default=False,
+            help="Reports the time taken to import and register each plugin,"\
+                 " then exits")
     parser.add_option("--accounts_file", action="store", type="string",
                       dest="accounts_file",
             help="Selects a user accounts file path different from default (.PASSWD)")
@@ -181,6 +256,14 @@ def parse_options():
     port = None
     if options.port:
         port = options.port
+    if options.server_mode == 'async' and src.interface.python_version < 3.5:
+        print("The async server requires at least Python version 3.5")
+        raise SystemExit
+    if options.execution_mode == 'processes' and (
+            src.interface.python_version < 2.6 or os.name != 'posix'):
+        print("Running the code in worker processes requires at least "
+              "Python version 2.6, on a POSIX system")
+        raise SystemExit
     if options.accounts_file:
         if os.path.exists(options.accounts_file):
             src.interface.accounts = account_manager.Accounts(
@@ -194,7 +277,13 @@ def parse_options():
         src.interface.accounts = account_manager.Accounts()
         if src.interface.accounts == {}:  # can happen with empty password file
             src.interface.accounts = account_manager.Accounts(False)
-    return url, port
+    server_settings = {'server_mode': options.server_mode,
+                       'keep_alive_timeout': options.keep_alive_timeout,
+                       'profile_startup': options.profile_startup,
+                       'execution_mode': options.execution_mode,
+                       'run_timeout': options.run_timeout,
+                       'output_limit': options.output_limit}
+    return url, port, server_settings
 
 def convert_url(url):
     '''converts a url into a form used by Crunchy'''
@@ -240,5 +329,5 @@ def open_browser(url):
             print('Please open %s in Firefox.' % url)
 
 if __name__ == "__main__":
-    _url, _port = parse_options()
-    run_crunchy(port=_port, url=_url)
+    _url, _port, _server_settings = parse_options()
+    run_crunchy(port=_port, url=_url, **_server_settings)
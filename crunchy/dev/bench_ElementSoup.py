@@ -0,0 +1,56 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_ElementSoup.py
+
+Measures the time taken by each ElementSoup backend to parse all the html
+pages found in server_root.
+
+This should be run from the base directory (crunchy).
+'''
+
+import codecs
+import os
+import sys
+import time
+from optparse import OptionParser
+
+parser = OptionParser()
+parser.add_option("-r", "--repeat", dest="repeat", type="int", default=5,
+                  help="Number of times each page is parsed (default: 5)")
+(options, args) = parser.parse_args()
+
+sys.path.insert(0, os.getcwd())
+from src.interface import python_version, StringIO
+if python_version < 3:
+    from src.element_tree import ElementSoup
+else:
+    from src.element_tree3 import ElementSoup
+
+pages = []
+for path, dirs, files in os.walk("server_root"):
+    for name in files:
+        if name.endswith((".htm", ".html")):
+            f = codecs.open(os.path.join(path, name), encoding='utf8',
+                            errors='replace')
+            pages.append(f.read())
+            f.close()
+size = sum([len(page) for page in pages])
+print("%d pages, %d characters, parsed %d times" % (len(pages), size,
+                                                   options.repeat))
+
+for backend in ElementSoup.BACKENDS:
+    if backend == "beautifulsoup" and ElementSoup.BS is None:
+        print("%-15s not available" % backend)
+        continue
+    start = time.time()
+    failures = 0
+    for i in range(options.repeat):
+        for page in pages:
+            try:
+                ElementSoup.parse(StringIO(page), backend=backend)
+            except Exception:
+                failures += 1
+    elapsed = time.time() - start
+    print("%-15s %8.3f s %10d characters/s %5d failures" % (backend,
+                        elapsed, size*options.repeat/elapsed, failures))
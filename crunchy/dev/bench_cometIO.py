@@ -0,0 +1,224 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_cometIO.py
+
+Measures the time taken to queue up many small writes in the buffers
+used by cometIO.py, and to retrieve them, comparing with the previous
+implementation which accumulated the data in a single string.
+
+Also measures the number of writes per second of a program through the
+whole pipeline (ThreadedBuffer.write -> CrunchyIOBuffer.put_output),
+comparing with the previous implementation which escaped the output with
+a series of replace() and tried to style each of the prompts.
+
+This should be run from the base directory (crunchy).
+'''
+
+import os
+import sys
+import threading
+import time
+from optparse import OptionParser
+
+parser = OptionParser()
+parser.add_option("-n", dest="counts", action="append", type="int",
+                  help="Number of writes; can be passed multiple times"\
+                       " (default: 100000 and 1000000)")
+parser.add_option("--no-legacy", dest="legacy", action="store_false",
+                  default=True,
+                  help="Do not time the previous implementation, which is"\
+                       " slow for large numbers of writes")
+(options, args) = parser.parse_args()
+counts = options.counts or [100000, 1000000]
+
+sys.path.insert(0, os.getcwd())
+from src.interface import plugin, config, names
+config['crunchy_base_dir'] = os.getcwd()
+import src.cometIO as cometIO
+import src.interface as interface
+import src.utilities as utilities
+import src.plugins.io_hook as io_hook
+
+class Services(object):
+    apply_io_hook = staticmethod(io_hook.apply_io_hook)
+    io_hooks = io_hook._io_hooks
+plugin['services'] = Services
+names['1'] = 'Crunchy'
+config['Crunchy'] = {'logging_uids': {}}
+cometIO.MAX_PENDING = sys.maxsize
+
+class LegacyStringBuffer(object):
+    """the previous implementation: the data is kept in a single string"""
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.event = threading.Event()
+        self.data = ""
+
+    def get(self):
+        self.lock.acquire()
+        t = self.data
+        self.data = ""
+        self.lock.release()
+        return t
+
+    def getline(self, uid):
+        self.lock.acquire()
+        data_t = self.data.split("\n", 1)
+        self.data = data_t[1]
+        self.lock.release()
+        return uid, data_t[0] + "\n"
+
+    def put(self, data):
+        self.lock.acquire()
+        self.data += data
+        self.event.set()
+        self.lock.release()
+
+    def put_output(self, data, uid):
+        """merges consecutive outputs by splicing the javascript
+        instruction found at the end of the string"""
+        services = plugin['services']
+        data = services.apply_io_hook('ANY', 'before_output', data)
+        data = services.apply_io_hook(uid, 'before_output', data)
+        data = data.replace('"', '&#34;')
+        data = data.replace("\n", "\\n")
+        data = data.replace("\r", "\\r")
+        self.lock.acquire()
+        if self.data.endswith(cometIO.output_end):
+            self.data = self.data[:-len(cometIO.output_end)] + data + \
+                        cometIO.output_end
+        else:
+            self.data += '$("#out_%s").append("%s' % (uid, data) + \
+                         cometIO.output_end
+        self.lock.release()
+
+def put_get(buffer, n):
+    for i in range(n):
+        buffer.put("x")
+    buffer.lock.acquire()
+    buffer.get() if isinstance(buffer, LegacyStringBuffer) else buffer.empty()
+    buffer.lock.release()
+
+def put_getline(buffer, n):
+    # input sent to an interpreter is read one line at a time, while the
+    # remaining lines are still waiting in the buffer
+    for i in range(n):
+        buffer.put("x\n")
+    for i in range(n):
+        buffer.getline("1_2")
+
+def put_output(buffer, n):
+    for i in range(n):
+        buffer.put_output("x", "1_2")
+    buffer.lock.acquire()
+    buffer.get() if isinstance(buffer, LegacyStringBuffer) else buffer.empty()
+    buffer.lock.release()
+
+class LegacyIOBuffer(cometIO.CrunchyIOBuffer):
+    """the previous implementation of put_output: the hooks are always
+    looked up, each character escaped by a replace(), and the clients
+    notified of every write"""
+    def notify(self):
+        self.event.set()
+        for listener in self.listeners:
+            listener()
+
+    def put_output(self, data, uid):
+        services = plugin['services']
+        data = services.apply_io_hook('ANY', 'before_output', data)
+        data = services.apply_io_hook(uid, 'before_output', data)
+        if data == "":
+            return
+        data = data.replace('"', '&#34;')
+        pdata = data.replace("\n", "\\n")
+        pdata = pdata.replace("\r", "\\r")
+        self.lock.acquire()
+        if not self.has_room(uid):
+            self.lock.release()
+            return
+        username = names[uid.split("_")[0]]
+        if self.open_uid == uid:
+            self.append(pdata)
+            if uid in config[username]['logging_uids']:
+                pass
+            self.notify()
+        else:
+            self.put('$("#out_%s").append("%s' % (uid, pdata))
+            self.open_uid = uid
+        self.lock.release()
+
+class LegacyThreadedBuffer(cometIO.ThreadedBuffer):
+    """the previous implementation of write, finding the widget from the
+    name of the thread"""
+    def write(self, data):
+        uid = threading.currentThread().getName()
+        if uid not in cometIO.input_buffers:
+            return self.default_out.write(data)
+        pageid = uid.split("_")[0]
+        data = utilities.changeHTMLspecialCharacters(data)
+        for _prompt in ['&gt;&gt;&gt; ', '... ', '--&gt; ',
+                        '&lt;t&gt;&gt;&gt; ', '_u__) ', '_u__)) ']:
+            dd = data.split('crunchy_py_prompt%s' % _prompt)
+            data = ("<span class='%s'>%s" % (interface.generic_prompt,
+                                             _prompt)).join(dd)
+        data = data.replace('\\', r'\\')
+        data = "<span class='%s'>%s</span>" % (self.buf_class, data)
+        cometIO.output_buffers[pageid].put_output(data, uid)
+
+def write(legacy, n):
+    """writes from a program, as print() does: some text, then a newline"""
+    if legacy:
+        out = LegacyThreadedBuffer(buf_class="STDOUT")
+        cometIO.output_buffers['1'] = LegacyIOBuffer()
+    else:
+        out = cometIO.ThreadedBuffer(buf_class="STDOUT")
+        cometIO.output_buffers['1'] = cometIO.CrunchyIOBuffer()
+    def program():
+        out.register_thread("1_2")
+        for i in range(n//2):
+            out.write("if a < b: print('x')")
+            out.write("\n")
+    # the name of the thread was set by register_thread
+    thread = threading.Thread(target=program, name="1_2")
+    thread.start()
+    thread.join()
+
+benchmarks = [("put + get", put_get, cometIO.StringBuffer),
+              ("put + getline", put_getline, cometIO.StringBuffer),
+              ("put_output", put_output, cometIO.CrunchyIOBuffer)]
+
+print("%-15s %10s %12s %12s %12s" % ("benchmark", "writes", "legacy (s)",
+                                      "chunked (s)", "writes/s"))
+for name, bench, buffer_class in benchmarks:
+    for n in counts:
+        results = []
+        for cls in (LegacyStringBuffer, buffer_class):
+            if cls is LegacyStringBuffer and not options.legacy:
+                results.append("-")
+                continue
+            buffer = cls()
+            start = time.time()
+            bench(buffer, n)
+            results.append("%.3f" % (time.time() - start))
+        print("%-15s %10d %12s %12s %12d" % (name, n, results[0], results[1],
+                                             n/max(float(results[1]), 1e-6)))
+
+print("")
+print("%-15s %10s %12s %12s %12s %12s" % ("pipeline", "writes", "legacy (s)",
+                      "current (s)", "legacy w/s", "current w/s"))
+for n in counts:
+    results = []
+    for legacy in (True, False):
+        if legacy and not options.legacy:
+            results.append(None)
+            continue
+        start = time.time()
+        write(legacy, n)
+        results.append(max(time.time() - start, 1e-6))
+    if results[0] is None:
+        print("%-15s %10d %12s %12.3f %12s %12d" % ("write", n, "-",
+                                        results[1], "-", n/results[1]))
+    else:
+        print("%-15s %10d %12.3f %12.3f %12d %12d" % ("write", n, results[0],
+                                results[1], n/results[0], n/results[1]))
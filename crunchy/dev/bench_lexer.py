@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_lexer.py
+
+Measures the time taken by the pygments lexers used by Crunchy to split
+the files included with Crunchy into tokens, with and without fusing the
+rules of each state into a single regular expression (fuse_rules option
+of RegexLexer); both must give the same tokens.
+
+This should be run from the base directory (crunchy).
+'''
+
+import codecs
+import glob
+import os
+import sys
+import time
+from optparse import OptionParser
+
+parser = OptionParser()
+parser.add_option("-r", dest="repeat", type="int", default=3,
+                  help="Number of times each text is lexed"\
+                       " (default: %default)")
+(options, args) = parser.parse_args()
+
+sys.path.insert(0, os.getcwd())
+from src.interface import python_version
+if python_version < 3:
+    from pygments.lexers import get_lexer_by_name
+else:
+    from pygments3.lexers import get_lexer_by_name
+
+def read(pattern):
+    text = []
+    for filename in sorted(glob.glob(pattern)):
+        f = codecs.open(filename, encoding='utf8', errors='replace')
+        text.append(f.read())
+        f.close()
+    return '\n'.join(text)
+
+samples = [("python", read(os.path.join("src", "*.py"))),
+           ("html", read(os.path.join("server_root", "docs", "*", "*.html"))),
+           ("css", read(os.path.join("server_root", "css", "*.css"))),
+           ("js", read(os.path.join("server_root", "javascript", "*.js")))]
+
+print("%-10s %10s %12s %12s %10s" % ("lexer", "chars", "rules (s)",
+                                      "fused (s)", "speedup"))
+for language, text in samples:
+    lexer = get_lexer_by_name(language)
+    results = []
+    for fuse in (False, True):
+        lexer.fuse_rules = fuse
+        list(lexer.get_tokens(text[:1000]))  # fuses the rules
+        start = time.time()
+        for i in range(options.repeat):
+            tokens = list(lexer.get_tokens(text))
+        results.append((time.time() - start, tokens))
+    if results[0][1] != results[1][1]:
+        print("Warning: the tokens found by %s differ" % language)
+    print("%-10s %10d %12.3f %12.3f %10.2f" % (language, len(text),
+                    results[0][0], results[1][0],
+                    results[0][0]/max(results[1][0], 1e-6)))
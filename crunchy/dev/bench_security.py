@@ -0,0 +1,273 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_security.py
+
+Compares security.remove_unwanted, which walks through each page only once,
+with the previous implementation which walked through it once per tag:
+all the html pages found in server_root are sanitized at each security
+level by both, checking that they produce the same tree and the same
+information about what has been removed, and the time taken is reported.
+
+This should be run from the base directory (crunchy).
+'''
+
+import codecs
+import copy
+import os
+import sys
+import time
+from optparse import OptionParser
+
+parser = OptionParser()
+parser.add_option("-r", "--repeat", dest="repeat", type="int", default=5,
+                  help="Number of times each page is sanitized (default: 5)")
+(options, args) = parser.parse_args()
+
+sys.path.insert(0, os.getcwd())
+from src.interface import config, python_version, tostring
+config['crunchy_base_dir'] = os.getcwd()
+import src.security as security
+if python_version < 3:
+    from src.element_tree import ElementSoup, ElementTree
+else:
+    from src.element_tree3 import ElementSoup, ElementTree
+
+security.u_print = lambda *args: None  # validated images are reported
+dangerous_text = "__dangerous_text"  # set by security.is_link_safe()
+legacy_good_images = set()
+legacy_bad_images = set()
+
+def legacy_remove_unwanted(tree, page):
+    '''the previous implementation, walking through the tree many times'''
+
+    # determine if site security level has been set to override
+    # the default
+    try:
+        security_level = security.config[page.username]['page_security_level'](page.url)
+    except Exception:
+        try:
+            security.u_print("page.username = ", page.username)
+        except:
+            security.u_print("page.username is not defined")
+        try:
+            security.u_print(security.config[page.username])
+        except:
+            security.u_print("config[page.username] is not defined")
+        raise
+    _allowed = security.allowed_attributes[security_level]
+    #The following will be updated so as to add result from page.
+    page.security_info = { 'level': security_level,
+                          'number removed': 0,
+                          'tags removed' : [],
+                          'attributes removed': [],
+                          'styles removed': []
+                        }
+
+# first, removing unwanted tags
+    unwanted = set()
+    tag_count = {}
+    page.security_info['number removed'] = 0
+    for element in tree.getiterator():
+        if element.tag not in _allowed:
+            unwanted.add(element.tag)
+            if element.tag in tag_count:
+                tag_count[element.tag] += 1
+            else:
+                tag_count[element.tag] = 1
+            page.security_info['number removed'] += 1
+    for tag in unwanted:
+        for element in tree.getiterator(tag):
+            element.clear() # removes the text
+            element.tag = None  # set up so that cleanup will remove it.
+        page.security_info['tags removed'].append([tag, tag_count[tag]])
+    if security.DEBUG:
+        security.u_print("These unwanted tags have been removed:")
+        security.u_print(unwanted)
+
+# next, removing unwanted attributes of allowed tags
+    unwanted = set()
+    count = 0
+    for tag in _allowed:
+        for element in tree.getiterator(tag):
+            # Filtering for possible dangerous content in "styles..."
+            if tag == "link":
+                if not 'trusted' in security_level:
+                    if not security.is_link_safe(element, page):
+                        page.security_info['styles removed'].append(
+                                [tag, '', getattr(security, dangerous_text)])
+                        setattr(security, dangerous_text, '')
+                        element.clear()
+                        element.tag = None
+                        page.security_info['number removed'] += 1
+                        continue
+            if tag == "meta":
+                for attr in list(element.attrib.items()):
+                    if (attr[0].lower() == 'http-equiv' and
+                        attr[1].lower() != 'content-type'):
+                        page.security_info['attributes removed'].append(
+                                                [tag, attr[0], attr[1]])
+                        del element.attrib[attr[0]]
+                        page.security_info['number removed'] += 1
+            for attr in list(element.attrib.items()):
+                if attr[0].lower() not in _allowed[tag]:
+                    if security.DEBUG:
+                        unwanted.add(attr[0])
+                    page.security_info['attributes removed'].append(
+                                                [tag, attr[0], ''])
+                    del element.attrib[attr[0]]
+                    page.security_info['number removed'] += 1
+                elif attr[0].lower() == 'href':
+                    testHREF = security.unquote_plus(attr[1]).replace("\r","").replace("\n","")
+                    testHREF = testHREF.replace("\t","").lstrip().lower()
+                    if testHREF.startswith("javascript:"):
+                        if security.DEBUG:
+                            security.u_print("removing href = "+ testHREF)
+                        page.security_info['attributes removed'].append(
+                                                [tag, attr[0], attr[1]])
+                        del element.attrib[attr[0]]
+                        page.security_info['number removed'] += 1
+                # Filtering for possible dangerous content in "styles..."
+                elif attr[0].lower() == 'style':
+                    if not 'trusted' in security_level:
+                        value = attr[1].lower().replace(' ', '').replace('\t', '')
+                        for x in security.dangerous_strings:
+                            if x in value:
+                                if security.DEBUG:
+                                    unwanted.add(value)
+                                page.security_info['styles removed'].append(
+                                                [tag, attr[0], attr[1]])
+                                del element.attrib[attr[0]]
+                                page.security_info['number removed'] += 1
+            # Filtering for possible dangerous content in "styles...", but
+            # skipping over empty <style/> element.
+            if tag == 'style' and element.text is not None:
+                if not 'trusted' in security_level:
+                    text = element.text.lower().replace(' ', '').replace('\t', '')
+                    for x in security.dangerous_strings:
+                        if x in text:
+                            if security.DEBUG:
+                                unwanted.add(text)
+                            page.security_info['styles removed'].append(
+                                                [tag, '', element.text])
+                            element.clear()
+                            element.tag = None
+                            page.security_info['number removed'] += 1
+            # making sure that this is an image
+            if tag == "img" and \
+                      not 'trusted' in security_level:
+                _rem = False
+                if 'src' in element.attrib:
+                    src = element.attrib["src"]
+                    if src in legacy_good_images:
+                        pass
+                    elif src in legacy_bad_images:
+                        element.clear()
+                        element.tag = None
+                        # do not repeat the information; same image
+                        #_rem = True
+                    else:
+                        if security.validate_image(src, page):
+                            legacy_good_images.add(src)
+                        else:
+                            legacy_bad_images.add(src)
+                            element.clear()
+                            element.tag = None
+                            _rem = True
+                else:
+                    element.clear()
+                    element.tag = None
+                    _rem = True
+                    src = 'No src attribute included.'
+                if _rem:
+                    page.security_info['number removed'] += 1
+                    page.security_info['attributes removed'].append(
+                        ['img', 'src',
+                        "could not validate or accept image:" + src])
+    legacy_cleanup(tree.getroot(), lambda e: e.tag)
+    if security.DEBUG:
+        security.u_print("These unwanted attributes have been removed:")
+        security.u_print(unwanted)
+    return
+
+def legacy_cleanup(elem, filter):
+    ''' See http://effbot.org/zone/element-bits-and-pieces.htm'''
+    out = []
+    for e in elem:
+        legacy_cleanup(e, filter)
+        if not filter(e):
+            if e.text:
+                if out:
+                    out[-1].tail += e.text
+                else:
+                    elem.text += e.text
+            out.extend(e)
+            if e.tail:
+                if out:
+                    out[-1].tail += e.tail
+                else:
+                    elem.text += e.tail
+        else:
+            out.append(e)
+
+    try:
+        elem[:] = out  # quick and works with Python 2.x but not 3.x
+    except AssertionError:
+        del elem[:]
+        for child in out:
+            elem.append(child)
+    return
+
+class Page(object):
+    def __init__(self, url):
+        self.username = "bench"
+        self.url = url
+        self.is_local = False
+        self.is_remote = False
+
+levels = sorted(security.allowed_attributes.keys())
+config["bench"] = {}
+pages = []
+for path, dirs, files in os.walk("server_root"):
+    for name in files:
+        if name.endswith((".htm", ".html")):
+            filename = os.path.join(path, name)
+            f = codecs.open(filename, encoding='utf8', errors='replace')
+            try:
+                tree = ElementTree.ElementTree(ElementSoup.parse(f,
+                                                    backend="html.parser"))
+            finally:
+                f.close()
+            url = "/" + "/".join(filename.split(os.sep)[1:])
+            pages.append((url, tree))
+print("%d pages, sanitized %d times at %d security levels" % (len(pages),
+                                                  options.repeat, len(levels)))
+
+times = {}
+differences = []
+for level in levels:
+    config["bench"]["page_security_level"] = lambda url: level
+    for url, tree in pages:
+        results = []
+        for sanitize in (legacy_remove_unwanted, security.remove_unwanted):
+            trees = [copy.deepcopy(tree) for i in range(options.repeat)]
+            page = Page(url)
+            # the previous implementation only reported an invalid image
+            # the first time it was found, even on another page
+            legacy_good_images.clear()
+            legacy_bad_images.clear()
+            security.resource_cache.clear()
+            start = time.time()
+            sanitize(trees[0], page)
+            security_info = page.security_info
+            for copied_tree in trees[1:]:
+                sanitize(copied_tree, page)
+            times[sanitize] = times.get(sanitize, 0) + time.time() - start
+            results.append((tostring(trees[0].getroot()), security_info))
+        if results[0] != results[1]:
+            differences.append((level, url))
+
+for level, url in differences:
+    print("different result for %s at level %s" % (url, level))
+print("%-10s %10.3f s" % ("legacy", times[legacy_remove_unwanted]))
+print("%-10s %10.3f s" % ("single", times[security.remove_unwanted]))
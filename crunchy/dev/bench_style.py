@@ -0,0 +1,181 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_style.py
+
+Measures the time taken to style all the code samples (<pre> and <code>
+elements with a title) found in the tutorials included with Crunchy,
+comparing the previous implementation, kept below, which parsed the html
+string produced by pygments, with the one used by style_markup() [without
+its cache] which builds the elements directly from the tokens; both must
+give the same result.
+
+This should be run from the base directory (crunchy).
+'''
+
+import codecs
+import os
+import re
+import sys
+import time
+from optparse import OptionParser
+
+parser = OptionParser()
+parser.add_option("-d", dest="directory",
+                  default=os.path.join("server_root", "docs"),
+                  help="Directory containing the pages (default: %default)")
+parser.add_option("-r", dest="repeat", type="int", default=5,
+                  help="Number of times each sample is styled"\
+                       " (default: %default)")
+(options, args) = parser.parse_args()
+
+sys.path.insert(0, os.getcwd())
+from src.interface import (config, from_comet, fromstring, tostring,
+                           python_version)
+config['crunchy_base_dir'] = os.getcwd()
+from_comet['register_new_page'] = lambda pageid: None
+import src.interface
+import src.vlam as vlam
+import src.plugins.style as style
+from src.utilities import extract_code
+
+if python_version < 3:
+    from pygments import highlight
+    from pygments.formatters import HtmlFormatter
+    from pygments.styles import get_style_by_name
+else:
+    from pygments3 import highlight
+    from pygments3.formatters import HtmlFormatter
+    from pygments3.styles import get_style_by_name
+
+# The previous implementation, formerly in src/plugins/style.py
+
+class PreHtmlFormatter(HtmlFormatter):
+    '''unlike HtmlFormatter, does not embed the styled code inside both
+       a <div> and a <pre>; rather embeds it inside a <pre> only.'''
+
+    def wrap(self, source, outfile):
+        return self._wrap_code(source)
+
+    def _wrap_code(self, source):
+        yield 0, '<pre>\n'
+        for i, t in source:
+            yield i, t
+        yield 0, '</pre>'
+
+def recover_entity_pattern(text, marker):
+    '''reverses the transformation done by replace_entity_pattern'''
+    marker = re.escape(marker)
+    return re.sub(marker + r"(\d{1,4})" + marker, r"&#\1;", text)
+
+formatters = {}
+
+def get_formatter(cssclass):
+    '''returns the formatter used for a given style'''
+    try:
+        return formatters[cssclass]
+    except KeyError:
+        formatter = PreHtmlFormatter()
+        formatter.cssclass = cssclass
+        formatter.style = get_style_by_name(cssclass)
+        formatters[cssclass] = formatter
+        return formatter
+
+def _style(raw_code, language, cssclass):
+    """Returns a string of formatted and styled HTML, where
+    raw_code is a string, language is a string that Pygments has a lexer for,
+    and cssclass is a class style available for Pygments.
+
+    It can be called from many threads at the same time."""
+    # Note: eventually, cssclass would be obtained from a user's preferences
+    # and would not need to be passed as an argument to style()
+    raw_code, marker = style.replace_entity_pattern(raw_code)
+    lexer = style.get_lexer(language)
+    formatter = get_formatter(cssclass)
+
+    # the removal of "\n" below prevents an extra space to be introduced
+    # with the background color of the selected cssclass
+    styled_code = highlight(raw_code, lexer, formatter).replace("\n</pre>", "</pre>")
+    return recover_entity_pattern(styled_code, marker)
+
+def add_linenumber(styled_code, vlam):
+    '''adds the line number information'''
+    lines = styled_code.split('\n')
+    # is the class surrounded by quotes or double quotes?
+    prompt1 = '<span class="%s"' % src.interface.generic_prompt
+    prompt2 = "<span class='%s'" % src.interface.generic_prompt
+    if lines[1].startswith(prompt1):
+        prompt_present = True
+        prompt = prompt1
+    elif lines[1].startswith(prompt2):
+        prompt_present = True
+        prompt = prompt2
+    else:
+        prompt_present = False
+    lineno = style.get_linenumber_offset(vlam)
+    # first and last lines are the embedding <pre>...</pre>
+    open_span = "<span class = 'linenumber %s'>" % src.interface.comment
+    for index, line in enumerate(lines[1:]):
+        if prompt_present:
+            if lines[index+1].startswith(prompt):
+                lines[index+1] = open_span + "%3d </span>" % (lineno) + line
+                lineno += 1
+            else:
+                lines[index+1] = open_span + "    </span>" + line
+        else:
+            lines[index+1] = open_span + "%3d </span>" % (lineno) + line
+            lineno += 1
+    return '\n'.join(lines)
+
+def legacy_markup(raw_code, language, cssclass, vlam=''):
+    """the previous implementation: the html string is parsed"""
+    styled_code = _style(raw_code, language, cssclass)
+    if 'linenumber' in vlam:
+        styled_code = add_linenumber(styled_code, vlam)
+    return fromstring(styled_code)
+
+def element_markup(raw_code, language, cssclass, vlam=''):
+    """style_markup() without highlight_cache"""
+    linenumber = None
+    if 'linenumber' in vlam:
+        linenumber = style.get_linenumber_offset(vlam)
+    return style._style_element(raw_code, language, linenumber)
+
+samples = []
+for path, dirs, files in os.walk(options.directory):
+    for name in files:
+        if not name.endswith(".html"):
+            continue
+        page = vlam.BasePage("bench")
+        page.create_tree(codecs.open(os.path.join(path, name),
+                                     encoding='utf8', errors='replace'))
+        for tag in ("pre", "code"):
+            for elem in page.tree.iter(tag):
+                title = elem.attrib.get("title", "").strip()
+                if not title:
+                    continue
+                language = title.split()[0]
+                if language not in style._pygment_language_names:
+                    language = "python"
+                samples.append((extract_code(elem), language, "tango", title))
+
+print("%s: %d code samples, styled %d times" % (options.directory,
+                                                len(samples), options.repeat))
+results = []
+for markup in (legacy_markup, element_markup):
+    start = time.time()
+    for i in range(options.repeat):
+        for sample in samples:
+            markup(*sample)
+    results.append(time.time() - start)
+
+differences = 0
+for sample in samples:
+    if tostring(legacy_markup(*sample), "utf-8") != \
+       tostring(element_markup(*sample), "utf-8"):
+        differences += 1
+if differences:
+    print("Warning: %d samples differ" % differences)
+print("%12s %12s %10s" % ("string (s)", "element (s)", "speedup"))
+print("%12.3f %12.3f %10.2f" % (results[0], results[1],
+                                results[0]/max(results[1], 1e-6)))
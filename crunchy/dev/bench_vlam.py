@@ -0,0 +1,146 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+bench_vlam.py
+
+Measures the time taken by vlam.BasePage to process the handlers of
+type 1, 2 and 3 of a page as a function of the number of registered
+handlers, comparing with the previous implementation which walked
+through the whole tree once for each tag having a registered handler.
+
+This should be run from the base directory (crunchy).
+'''
+
+import codecs
+import copy
+import os
+import sys
+import time
+from optparse import OptionParser
+
+parser = OptionParser()
+parser.add_option("-f", dest="filename",
+                  default=os.path.join("server_root", "docs", "tests",
+                                       "entities.html"),
+                  help="Page to process (default: %default)")
+parser.add_option("-n", dest="counts", action="append", type="int",
+                  help="Number of tags with registered handlers; can be"\
+                       " passed multiple times (default: 5, 20, 50 and 100)")
+parser.add_option("-r", dest="repeat", type="int", default=100,
+                  help="Number of times each page is processed"\
+                       " (default: %default)")
+(options, args) = parser.parse_args()
+counts = options.counts or [5, 20, 50, 100]
+
+sys.path.insert(0, os.getcwd())
+from src.interface import config, from_comet
+config['crunchy_base_dir'] = os.getcwd()
+from_comet['register_new_page'] = lambda pageid: None
+import src.vlam as vlam
+from src.utilities import uidgen
+
+class LegacyPage(vlam.BasePage):
+    """the previous implementation: one walk through the tree per tag"""
+    def process_handlers3(self):
+        for tag in self.handlers3:
+            for elem in list(self.tree.iter(tag)):
+                attributes = dict(elem.attrib)
+                for attr in attributes:
+                    if attr in self.handlers3[tag]:
+                        keyword = self.extract_keyword(elem, attr)
+                        if keyword in self.handlers3[tag][attr]:
+                            self.handlers3[tag][attr][keyword]( self,
+                                            elem, self.pageid + "_" + uidgen(self.username))
+                            break
+
+    def process_handlers2(self):
+        for tag in self.handlers2:
+            for elem in self.tree.getiterator(tag):
+                attributes = dict(elem.attrib)
+                for attr in attributes:
+                    if attr in self.handlers2[tag]:
+                        do_it = True
+                        if attr in self.handlers3.get(tag, {}):
+                            keyword = self.extract_keyword(elem, attr)
+                            if keyword in self.handlers3[tag][attr]:
+                                do_it = False
+                        if do_it:
+                            uid = self.pageid + "_" + uidgen(self.username)
+                            self.handlers2[tag][attr](self, elem, uid)
+
+    def process_type1(self, handlers):
+        for tag in handlers:
+            for elem in self.tree.getiterator(tag):
+                do_it = True
+                if tag in self.handlers2:
+                    for attr in elem.attrib:
+                        if attr in self.handlers2[tag]:
+                            do_it = False
+                            break
+                if tag in self.handlers3:
+                    for attr in elem.attrib:
+                        if attr in self.handlers3[tag]:
+                            keyword = self.extract_keyword(elem, attr)
+                            if keyword in self.handlers3[tag][attr]:
+                                do_it = False
+                                break
+                if do_it:
+                    uid = self.pageid + "_" + uidgen(self.username)
+                    handlers[tag](self, elem, uid)
+
+calls = [0]
+def handler(page, elem, uid):
+    calls[0] += 1
+
+# tags found on most pages come first, followed by made up ones
+common_tags = ["a", "pre", "span", "div", "p", "img", "link", "code", "td"]
+
+def register(n):
+    """registers handlers of type 1, 2 and 3 for n tags"""
+    tags = (common_tags + ["tag%d" % i for i in range(n)])[:n]
+    vlam.BasePage.handlers1 = {}
+    vlam.BasePage.handlers2 = {}
+    vlam.BasePage.handlers3 = {}
+    vlam.BasePage.final_handlers1 = {}
+    for i, tag in enumerate(tags):
+        if i % 3 == 0:
+            vlam.BasePage.handlers1[tag] = handler
+        elif i % 3 == 1:
+            vlam.BasePage.handlers2[tag] = {"name": handler}
+        else:
+            vlam.BasePage.handlers3[tag] = {"title": {"python_code": handler}}
+        if i % 5 == 0:
+            vlam.BasePage.final_handlers1[tag] = handler
+
+def process(page_class, tree):
+    page = page_class("bench")
+    page.tree = tree
+    page.process_handlers1()
+    page.process_handlers2()
+    page.process_handlers3()
+    page.process_final_handlers1()
+
+page = vlam.BasePage("bench")
+page.create_tree(codecs.open(options.filename, encoding='utf8'))
+tree = page.tree
+elements = len(list(tree.iter()))
+
+print("%s: %d elements, processed %d times" % (options.filename, elements,
+                                               options.repeat))
+print("%10s %12s %12s %10s" % ("handlers", "legacy (s)", "single (s)",
+                                "speedup"))
+for n in counts:
+    register(n)
+    results = []
+    for page_class in (LegacyPage, vlam.BasePage):
+        calls[0] = 0
+        trees = [copy.deepcopy(tree) for i in range(options.repeat)]
+        start = time.time()
+        for copied_tree in trees:
+            process(page_class, copied_tree)
+        results.append((time.time() - start, calls[0]))
+    if results[0][1] != results[1][1]:
+        print("Warning: %d handlers called instead of %d" % (results[1][1],
+                                                             results[0][1]))
+    print("%10d %12.3f %12.3f %10.1f" % (n, results[0][0], results[1][0],
+                                         results[0][0]/max(results[1][0], 1e-6)))
@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""
+    pygments.formatters.etree
+    ~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Formatter building an ElementTree structure.
+
+    :copyright: Copyright 2006-2009 by the Pygments team, see AUTHORS.
+    :license: BSD, see LICENSE for details.
+"""
+
+from pygments.formatter import Formatter
+from pygments.formatters.html import _get_ttype_class
+from pygments.util import get_bool_opt, get_int_opt
+
+
+__all__ = ['ElementFormatter']
+
+
+class ElementFormatter(Formatter):
+    """
+    Build the same ``<pre>`` element, containing ``<span>`` elements, that
+    would be obtained by parsing the output of the `HtmlFormatter` with the
+    ``nowrap`` option inside a ``<pre>`` tag; the final newline is left out.
+    Use `format_element()` to get the element itself, rather than its
+    serialization written to a file.
+
+    Additional options accepted:
+
+    `etree`
+        The ElementTree module used to create the elements (default:
+        ``xml.etree.ElementTree``).
+
+    `classprefix`
+        Prefix added to the CSS class of each token type, as for the
+        `HtmlFormatter` (default: ``''``).
+
+    `linenos`
+        If set to ``True``, each line starts with a ``<span>`` containing
+        its number (default: ``False``).
+
+    `linenostart`
+        The line number for the first line (default: ``1``).
+
+    `linenoclass`
+        CSS class of the line number ``<span>`` (default: ``'lineno'``).
+
+    `promptclass`
+        If the first line starts with a token having this CSS class, only
+        the lines starting with such a token are numbered; the others get
+        a blank line number (default: ``''``).
+    """
+    name = 'ElementTree'
+    aliases = ['etree', 'element']
+    filenames = []
+
+    def __init__(self, **options):
+        Formatter.__init__(self, **options)
+        self.etree = options.get('etree')
+        if self.etree is None:
+            import xml.etree.ElementTree as etree
+            self.etree = etree
+        self.classprefix = options.get('classprefix', '')
+        self.linenos = get_bool_opt(options, 'linenos', False)
+        self.linenostart = abs(get_int_opt(options, 'linenostart', 1))
+        self.linenoclass = options.get('linenoclass', 'lineno')
+        self.promptclass = options.get('promptclass', '')
+
+    def _get_css_class(self, ttype):
+        """Return the css class of this token type prefixed with
+        the classprefix option."""
+        return self.classprefix + _get_ttype_class(ttype)
+
+    def _format_lines(self, tokensource):
+        """
+        Split the tokens into lines; yield each line as a list of
+        [css class, text] pairs, merging consecutive tokens having the same
+        class exactly as `HtmlFormatter._format_lines()` does.
+        """
+        lspan = ''
+        line = []
+        for ttype, value in tokensource:
+            cls = self._get_css_class(ttype)
+            parts = value.split('\n')
+
+            # for all but the last line
+            for part in parts[:-1]:
+                if line:
+                    if lspan != cls:
+                        line.append([cls, part])
+                    else: # both are the same
+                        line[-1][1] += part
+                    yield line
+                    line = []
+                elif part:
+                    yield [[cls, part]]
+                else:
+                    yield []
+            # for the last line
+            if line and parts[-1]:
+                if lspan != cls:
+                    line.append([cls, parts[-1]])
+                    lspan = cls
+                else:
+                    line[-1][1] += parts[-1]
+            elif parts[-1]:
+                line = [[cls, parts[-1]]]
+                lspan = cls
+            # else we neither have to open a new span nor set lspan
+
+        if line:
+            yield line
+
+    def format_element(self, tokensource):
+        """
+        Return the ``<pre>`` element built from ``tokensource``.
+        """
+        Element = self.etree.Element
+        pre = Element('pre')
+        pieces = ['\n']  # text following the last element added
+        last = None
+
+        def add(tag, cls, text):
+            if last is None:
+                pre.text = ''.join(pieces) or None
+            else:
+                last.tail = ''.join(pieces) or None
+            del pieces[:]
+            span = Element(tag, {'class': cls})
+            span.text = text or None
+            pre.append(span)
+            return span
+
+        lines = self._format_lines(tokensource)
+        numbered = None
+        lineno = self.linenostart
+        for line in lines:
+            if self.linenos:
+                starts_with_prompt = (line and self.promptclass and
+                                      line[0][0] == self.promptclass)
+                if numbered is None:
+                    numbered = bool(starts_with_prompt)
+                if numbered and not starts_with_prompt:
+                    last = add('span', self.linenoclass, '    ')
+                else:
+                    last = add('span', self.linenoclass, '%3d ' % lineno)
+                    lineno += 1
+            for cls, text in line:
+                if cls:
+                    last = add('span', cls, text)
+                else:
+                    pieces.append(text)
+            pieces.append('\n')
+
+        if pieces[-1] == '\n':
+            pieces.pop()  # no newline before </pre>
+        if last is None:
+            pre.text = ''.join(pieces) or None
+        else:
+            last.tail = ''.join(pieces) or None
+        return pre
+
+    def format_unencoded(self, tokensource, outfile):
+        markup = self.etree.tostring(self.format_element(tokensource))
+        if not isinstance(markup, str):
+            markup = markup.decode('us-ascii')
+        outfile.write(markup)
@@ -28,6 +28,13 @@ __all__ = ['Lexer', 'RegexLexer', 'ExtendedRegexLexer', 'DelegatingLexer',
 
 _default_analyse = staticmethod(lambda x: 0.0)
 
+# Rules using these can not be fused with others into a single regex:
+# group numbers, group names and global flags would not mean the same.
+_unfusable = re.compile(r'\\[1-9]|\(\?P[<=]|\(\?\(|\(\?[aiLmsux]+\)')
+
+# Older versions of the re module do not support more groups in a regex.
+_max_groups = 99
+
 
 class LexerMeta(type):
     """
@@ -420,8 +427,72 @@ class RegexLexerMeta(LexerMeta):
             cls._process_state(tokendefs, processed, state)
         return processed
 
+    def _fuse_state(cls, tokens):
+        """
+        Replace consecutive rules of a processed state by a single regex,
+        an alternation with one named group per rule, which finds the
+        first rule matching at a given position in one call.
+        Return a list of ``(rex, action, new_state, alternatives)`` tuples,
+        where ``alternatives`` maps the group names to the fused rules,
+        or is ``None`` for a rule kept on its own.
+        """
+        fused = []
+        group = []
+        groups = 0
+
+        def flush():
+            if len(group) == 1:
+                rex, action, new_state = group[0]
+                fused.append((rex, action, new_state, None))
+            elif group:
+                alternatives = {}
+                patterns = []
+                for i, rule in enumerate(group):
+                    alternatives['_%d' % i] = rule
+                    patterns.append('(?P<_%d>%s)' % (i, rule[0].__self__.pattern))
+                try:
+                    rex = re.compile('|'.join(patterns),
+                                     group[0][0].__self__.flags).match
+                except Exception:
+                    for rex, action, new_state in group:
+                        fused.append((rex, action, new_state, None))
+                else:
+                    fused.append((rex, None, None, alternatives))
+            del group[:]
+
+        for rule in tokens:
+            regex = rule[0].__self__
+            if regex.flags & re.VERBOSE or _unfusable.search(regex.pattern):
+                flush()
+                groups = 0
+                fused.append(rule + (None,))
+                continue
+            if (groups + regex.groups + 1 > _max_groups or
+                group and group[0][0].__self__.flags != regex.flags):
+                flush()
+                groups = 0
+            group.append(rule)
+            groups += regex.groups + 1
+        flush()
+        return fused
+
+    def fuse_tokendef(cls, processed):
+        """
+        Return the fused version of ``processed``, a dict of processed
+        states, building it on first use.
+        """
+        try:
+            return cls._all_fused[id(processed)]
+        except KeyError:
+            fused = {}
+            for state, tokens in processed.items():
+                fused[state] = cls._fuse_state(tokens)
+            cls._all_fused[id(processed)] = fused
+            return fused
+
     def __call__(cls, *args, **kwds):
         if not hasattr(cls, '_tokens'):
+            cls._all_fused = {}
             cls._all_tokens = {}
             cls._tmpname = 0
             if hasattr(cls, 'token_variants') and cls.token_variants:
@@ -464,6 +535,11 @@ class RegexLexer(Lexer):
     #: current one.
     tokens = {}
 
+    #: If true, the rules of each state are fused into as few regular
+    #: expressions as possible (see `RegexLexerMeta._fuse_state`), giving
+    #: the same tokens faster.
+    fuse_rules = True
+
     def get_tokens_unprocessed(self, text, stack=('root',)):
         """
         Split ``text`` into (tokentype, text) pairs.
@@ -471,13 +547,22 @@ class RegexLexer(Lexer):
         ``stack`` is the inital stack (default: ``['root']``)
         """
         pos = 0
-        tokendefs = self._tokens
+        if self.fuse_rules:
+            tokendefs = self.__class__.fuse_tokendef(self._tokens)
+        else:
+            tokendefs = dict([(state, [rule + (None,) for rule in tokens])
+                              for state, tokens in self._tokens.items()])
         statestack = list(stack)
         statetokens = tokendefs[statestack[-1]]
         while 1:
-            for rexmatch, action, new_state in statetokens:
+            for rexmatch, action, new_state, alternatives in statetokens:
                 m = rexmatch(text, pos)
                 if m:
+                    if alternatives is not None:
+                        rexmatch, action, new_state = alternatives[m.lastgroup]
+                        if type(action) is not _TokenType:
+                            # callbacks expect the groups of their own regex
+                            m = rexmatch(text, pos)
                     if type(action) is _TokenType:
                         yield pos, action, m.group()
                     else:
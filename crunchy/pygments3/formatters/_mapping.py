@@ -17,6 +17,7 @@ from pygments3.util import docstring_headline
 
 # start
 from pygments3.formatters.bbcode import BBCodeFormatter
+from pygments3.formatters.etree import ElementFormatter
 from pygments3.formatters.html import HtmlFormatter
 from pygments3.formatters.img import BmpImageFormatter
 from pygments3.formatters.img import GifImageFormatter
@@ -33,6 +34,7 @@ from pygments3.formatters.terminal256 import Terminal256Formatter
 FORMATTERS = {
     BBCodeFormatter: ('BBCode', ('bbcode', 'bb'), (), 'Format tokens with BBcodes. These formatting codes are used by many bulletin boards, so you can highlight your sourcecode with pygments3 before posting it there.'),
     BmpImageFormatter: ('img_bmp', ('bmp', 'bitmap'), ('*.bmp',), 'Create a bitmap image from source code. This uses the Python Imaging Library to generate a pixmap from the source code.'),
+    ElementFormatter: ('ElementTree', ('etree', 'element'), (), 'Build the same ``<pre>`` element, containing ``<span>`` elements, that would be obtained by parsing the output of the `HtmlFormatter` with the ``nowrap`` option inside a ``<pre>`` tag; the final newline is left out. Use `format_element()` to get the element itself, rather than its serialization written to a file.'),
     GifImageFormatter: ('img_gif', ('gif',), ('*.gif',), 'Create a GIF image from source code. This uses the Python Imaging Library to generate a pixmap from the source code.'),
     HtmlFormatter: ('HTML', ('html',), ('*.html', '*.htm'), "Format tokens as HTML 4 ``<span>`` tags within a ``<pre>`` tag, wrapped in a ``<div>`` tag. The ``<div>``'s CSS class can be set by the `cssclass` option."),
     ImageFormatter: ('img', ('img', 'IMG', 'png'), ('*.png',), 'Create a PNG image from source code. This uses the Python Imaging Library to generate a pixmap from the source code.'),
@@ -35,10 +35,9 @@
     :copyright: Copyright 2006-2009 by the Pygments team, see AUTHORS.
     :license: BSD, see LICENSE for details.
 """
-try:
-    import pkg_resources
-except ImportError:
-    pkg_resources = None
+# pkg_resources takes a long time to import: it is only imported when
+# plugins are looked for, and set to None if it is not available.
+pkg_resources = False
 
 LEXER_ENTRY_POINT = 'pygments3.lexers'
 FORMATTER_ENTRY_POINT = 'pygments3.formatters'
@@ -46,29 +45,33 @@ STYLE_ENTRY_POINT = 'pygments3.styles'
 FILTER_ENTRY_POINT = 'pygments3.filters'
 
 
-def find_plugin_lexers():
+def iter_entry_points(group_name):
+    global pkg_resources
+    if pkg_resources is False:
+        try:
+            import pkg_resources
+        except ImportError:
+            pkg_resources = None
     if pkg_resources is None:
-        return
-    for entrypoint in pkg_resources.iter_entry_points(LEXER_ENTRY_POINT):
+        return []
+    return pkg_resources.iter_entry_points(group_name)
+
+
+def find_plugin_lexers():
+    for entrypoint in iter_entry_points(LEXER_ENTRY_POINT):
         yield entrypoint.load()
 
 
 def find_plugin_formatters():
-    if pkg_resources is None:
-        return
-    for entrypoint in pkg_resources.iter_entry_points(FORMATTER_ENTRY_POINT):
+    for entrypoint in iter_entry_points(FORMATTER_ENTRY_POINT):
         yield entrypoint.name, entrypoint.load()
 
 
 def find_plugin_styles():
-    if pkg_resources is None:
-        return
-    for entrypoint in pkg_resources.iter_entry_points(STYLE_ENTRY_POINT):
+    for entrypoint in iter_entry_points(STYLE_ENTRY_POINT):
         yield entrypoint.name, entrypoint.load()
 
 
 def find_plugin_filters():
-    if pkg_resources is None:
-        return
-    for entrypoint in pkg_resources.iter_entry_points(FILTER_ENTRY_POINT):
+    for entrypoint in iter_entry_points(FILTER_ENTRY_POINT):
         yield entrypoint.name, entrypoint.load()
@@ -0,0 +1,48 @@
+/*----------------------------- interpreters ------------------------------ */
+// Initialization of the interpreters inserted by vlam_interpreter.py; each
+// function is called once per page, with the uids of all the interpreters
+// of a given kind.  The page defines crunchy_exec_url, crunchy_pageid and
+// crunchy_username.
+
+function start_interpreters(code, uids){
+    for (var i = 0; i < uids.length; i++){
+        var j = new XMLHttpRequest();
+        j.open("POST", crunchy_exec_url + "?uid=" + uids[i], false);
+        j.send(code);
+    }
+};
+
+function init_BorgInterpreter(uids){
+    code = "import src.interpreter\nborg=src.interpreter.BorgConsole(group='" +
+           crunchy_pageid + "',username='" + crunchy_username + "')";
+    code += "\nborg.interact()\n";
+    start_interpreters(code, uids);
+};
+
+function init_SingleInterpreter(uids){
+    code = "import src.interpreter\nisolated=src.interpreter.SingleConsole(username='" +
+           crunchy_username + "')";
+    code += "\nisolated.interact(ps1='--> ')\n";
+    start_interpreters(code, uids);
+};
+
+function init_parrotInterpreter(uids){
+    code = "import src.interpreter\nisolated=src.interpreter.SingleConsole(username='" +
+           crunchy_username + "')";
+    code += "\nisolated.interact(ps1='_u__) ', symbol='exec')\n";
+    start_interpreters(code, uids);
+};
+
+function init_ParrotsInterpreter(uids){
+    code = "import src.interpreter\nborg=src.interpreter.BorgConsole(group='" +
+           crunchy_pageid + "', username='" + crunchy_username + "')";
+    code += "\nborg.interact(ps1='_u__)) ', symbol='exec')\n";
+    start_interpreters(code, uids);
+};
+
+function init_TypeInfoConsole(uids){
+    code = "import src.interpreter\nborg=src.interpreter.TypeInfoConsole(group='" +
+           crunchy_pageid + "', username='" + crunchy_username + "')";
+    code += "\nborg.interact(ps1='<t>>> ')\n";
+    start_interpreters(code, uids);
+};
@@ -47,6 +47,7 @@ plugin['register_preprocessor'] = register_preprocessor
 def register_tag_handler(tag, attribute, keyword, handler):
     """register a new tag handler, a generalisation of vlam handlers
        but for attributes other than 'title'."""
+    vlam.reset_dispatch_index()
     if keyword is None:
         if attribute is None:  # example: for <a ...>
             if tag in vlam.CrunchyPage.handlers1:
@@ -78,8 +79,8 @@ created, that conflicts with an existing one."""%(tag, attribute))
     if tag not in vlam.CrunchyPage.handlers3:
         vlam.CrunchyPage.handlers3[tag] = {}
     if attribute not in vlam.CrunchyPage.handlers3[tag]:
-        vlam.CrunchyPage.handlers3[tag][attribute] = {}
-    if keyword in vlam.CrunchyPage.handlers3[tag][attribute]:
+        vlam.CrunchyPage.handlers3[tag][attribute] = vlam.KeywordHandlers()
+    if dict.__contains__(vlam.CrunchyPage.handlers3[tag][attribute], keyword):
         print("""FATAL ERROR"
 Attempting to define a handler twice for the same
 tag: %s, attribute: %s, keyword: %s
@@ -90,6 +91,19 @@ created, that conflicts with an existing one."""%(tag, attribute, keyword))
     return
 plugin['register_tag_handler'] = register_tag_handler
 
+def register_fallback_handler(tag, attribute, fallback):
+    """register a function called with the keyword found in the given
+       attribute of a tag when no handler has been registered for this
+       keyword; it returns the handler to use, which is then registered,
+       or None.  This avoids registering many keywords that are rarely used."""
+    vlam.reset_dispatch_index()
+    if tag not in vlam.CrunchyPage.handlers3:
+        vlam.CrunchyPage.handlers3[tag] = {}
+    if attribute not in vlam.CrunchyPage.handlers3[tag]:
+        vlam.CrunchyPage.handlers3[tag][attribute] = vlam.KeywordHandlers()
+    vlam.CrunchyPage.handlers3[tag][attribute].fallbacks.append(fallback)
+plugin['register_fallback_handler'] = register_fallback_handler
+
 def register_preprocess_page_handler(tag, handler):
     vlam.CrunchyPage.preprocess_page[tag] = handler
 plugin['register_preprocess_page'] = register_preprocess_page_handler
@@ -116,10 +130,18 @@ def register_end_pagehandler(handler):
     vlam.CrunchyPage.end_pagehandlers.append(handler)
 plugin['register_end_pagehandler'] = register_end_pagehandler
 
-def create_vlam_page(filehandle, url, username=None, remote=False, local=False):
+def register_page_cleanup(handler):
+    """register a callback that is called with the pageid of each page
+       closed by the user, so that what was kept for it can be forgotten.
+    """
+    cometIO.page_cleanup_handlers.append(handler)
+plugin['register_page_cleanup'] = register_page_cleanup
+
+def create_vlam_page(filehandle, url, username=None, remote=False, local=False,
+                     filename=None):
     """Create (and return) a VLAM page from filehandle"""
     return vlam.CrunchyPage(filehandle, url, username=username,
-                                                    remote=remote, local=local)
+                            remote=remote, local=local, filename=filename)
 plugin['create_vlam_page'] = create_vlam_page
 
 def exec_code(code, uid, doctest=False):
@@ -149,14 +171,18 @@ def get_pageid():
     """when executed from inside a 'user thread', returns the pageid of the page
     from which the code is being executed.
     """
-    return threading.currentThread().getName().split("_")[0]
+    return get_uid().split("_")[0]
 plugin['get_pageid'] = get_pageid
 
 def get_uid():
     """when executed from inside a 'user thread', returns the uid of the widget
-    from which the code is being executed.
+    from which the code is being executed, including the threads started by
+    that code.
     """
-    return threading.currentThread().getName()
+    uid = cometIO.current_uid()
+    if uid is None:  # not a 'user thread'
+        return threading.currentThread().getName()
+    return uid
 plugin['get_uid'] = get_uid
 
 def kill_thread(uid):
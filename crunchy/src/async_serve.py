@@ -0,0 +1,301 @@
+"""
+async_serve.py: an event driven alternative to http_serve.MyHTTPServer
+
+With MyHTTPServer, each request is handled in its own thread; since every
+page keeps a /comet request open, waiting for some output, each page open
+in a browser ties up a thread for as long as it is displayed.
+Here, all connections are handled by a single asyncio event loop:
+idle /comet requests are simply coroutines waiting for some data to be put
+in their output buffer, while the other requests are dispatched,
+through the same handler registry, to a small pool of worker threads.
+
+It requires Python 3.5+ and is selected with
+    python crunchy.py --server=async
+
+unit tests in test_async_serve.rst
+"""
+
+import asyncio
+import concurrent.futures
+import email.utils
+import io
+import time
+import traceback
+
+from http.server import BaseHTTPRequestHandler
+
+import src.cometIO as cometIO
+import src.http_serve as http_serve
+
+DEBUG = False
+MAX_WORKERS = 20  # threads available to handlers other than /comet
+MAX_HEADER_SIZE = 65536
+
+# The handlers listed below would block a worker thread while waiting;
+# they are replaced by coroutines serving the same purpose.
+coroutine_handlers = {}
+
+class AsyncRequest(object):
+    """Plays the role of the HTTPRequestHandler instance passed to handlers
+    by the threaded server: handlers call send_response(), send_header(),
+    end_headers() and wfile.write() as usual, and the resulting response
+    is sent back by the event loop once the handler is done."""
+    def __init__(self, server, command, path, request_version, headers):
+        self.server = server
+        self.command = command
+        self.path = path
+        self.request_version = request_version
+        self.headers = headers
+        self.data = "".encode('ascii')
+        self.wfile = io.BytesIO()
+        self.response_headers = []
+        self.response_code = None
+        connection = headers.get('Connection', '').lower()
+        if request_version == "HTTP/1.1":
+            self.close_connection = (connection == 'close')
+        else:
+            self.close_connection = (connection != 'keep-alive')
+        if not http_serve.KEEP_ALIVE_TIMEOUT:
+            self.close_connection = True
+
+    def send_response(self, code, message=None):
+        if message is None:
+            if code in BaseHTTPRequestHandler.responses:
+                message = BaseHTTPRequestHandler.responses[code][0]
+            else:
+                message = ''
+        self.response_headers = ["HTTP/1.1 %d %s" % (code, message)]
+        self.response_code = code
+        self.response_content_type = None
+        self.response_encoding = None
+        self.response_etag = None
+        self.wfile = io.BytesIO()
+        self.send_header("Server", "Crunchy")
+        self.send_header("Date", email.utils.formatdate(time.time(), usegmt=True))
+
+    def send_header(self, keyword, value):
+        # both are taken care of by get_response()
+        if keyword.lower() == 'content-length':
+            return
+        if keyword.lower() == 'connection':
+            if value.lower() == 'close':
+                self.close_connection = True
+            return
+        if keyword.lower() == 'content-type':
+            self.response_content_type = value
+        elif keyword.lower() == 'content-encoding':
+            self.response_encoding = value
+        elif keyword.lower() == 'etag':
+            self.response_etag = value
+        self.response_headers.append("%s: %s" % (keyword, value))
+
+    def end_headers(self):
+        pass  # the headers are sent along with the content
+
+    def get_response(self):
+        """returns the complete response, ready to be sent"""
+        if self.response_code is None:
+            # the handler sent no status line; see HTTPRequestHandler
+            content = self.wfile.getvalue()
+            self.send_response(200)
+            self.wfile.write(content)
+        content = self.wfile.getvalue()
+        headers = self.response_headers[:]
+        coding = http_serve.response_coding(self, len(content))
+        if coding is not None:
+            content = http_serve.compress(content, coding)
+            headers.append("Content-Encoding: %s" % coding)
+            headers.append("Vary: Accept-Encoding")
+        headers.append("Content-Length: %d" % len(content))
+        if self.close_connection:
+            headers.append("Connection: close")
+        else:
+            headers.append("Keep-Alive: timeout=%d" % http_serve.KEEP_ALIVE_TIMEOUT)
+        headers = "\r\n".join(headers) + "\r\n\r\n"
+        return headers.encode('latin-1') + content
+
+    @http_serve.require_authenticate
+    async def process(self):
+        """handle the request, the same way HTTPRequestHandler.do_POST does"""
+        if not http_serve.identify_single_user(self):
+            return
+        self.path, self.args = http_serve.parse_url(self.path)
+        handler = self.server.get_handler(self.path)
+        if handler in coroutine_handlers:
+            try:
+                await coroutine_handlers[handler](self)
+            except asyncio.CancelledError:
+                raise
+            except:
+                self.send_response(500)
+                self.end_headers()
+                self.wfile.write(traceback.format_exc().encode('utf8'))
+        else:
+            await self.server.loop.run_in_executor(self.server.executor,
+                                                   http_serve.run_handler, self)
+
+class HTTPProtocol(asyncio.Protocol):
+    """Reads requests from a single connection and sends back the responses"""
+    def __init__(self, server):
+        self.server = server
+        self.received = bytearray()
+        self.data_ready = asyncio.Event()
+        self.at_eof = False
+        self.transport = None
+        self.task = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.task = self.server.loop.create_task(self.serve())
+
+    def data_received(self, data):
+        self.received.extend(data)
+        self.data_ready.set()
+
+    def eof_received(self):
+        self.at_eof = True
+        self.data_ready.set()
+
+    def connection_lost(self, exc):
+        # the browser went away, possibly while a /comet request was
+        # waiting for some output: nobody is left to read the response.
+        self.at_eof = True
+        if self.task is not None:
+            self.task.cancel()
+
+    async def wait_for_data(self):
+        self.data_ready.clear()
+        await self.data_ready.wait()
+
+    async def read_request(self):
+        """returns the next request sent on this connection, or None if
+        the connection has been closed"""
+        while True:
+            end = self.received.find("\r\n\r\n".encode('ascii'))
+            if end != -1:
+                break
+            if self.at_eof or len(self.received) > MAX_HEADER_SIZE:
+                return None
+            await self.wait_for_data()
+        head = bytes(self.received[:end + 4])
+        del self.received[:end + 4]
+
+        fp = io.BytesIO(head)
+        words = fp.readline().decode('latin-1').split()
+        if len(words) == 3:
+            command, path, request_version = words
+        elif len(words) == 2:
+            command, path = words
+            request_version = "HTTP/0.9"
+        else:
+            return None
+        headers = http_serve.parse_headers(fp)
+        request = AsyncRequest(self.server, command, path, request_version,
+                               headers)
+
+        length = int(headers.get('Content-Length') or 0)
+        while len(self.received) < length:
+            if self.at_eof:
+                return None
+            await self.wait_for_data()
+        request.data = bytes(self.received[:length])
+        del self.received[:length]
+        return request
+
+    async def serve(self):
+        """handles the requests sent on the connection, one after the other,
+        until either side closes it"""
+        try:
+            timeout = None  # no limit for the first request
+            while True:
+                try:
+                    request = await asyncio.wait_for(self.read_request(),
+                                                     timeout)
+                except asyncio.TimeoutError:
+                    return
+                if request is None:
+                    return
+                if DEBUG:
+                    print("%s %s" % (request.command, request.path))
+                coroutine = request.process()
+                # the request is dealt with by process() unless the
+                # authentication decorator has already sent an answer.
+                if coroutine is not None:
+                    await coroutine
+                self.transport.write(request.get_response())
+                if request.close_connection or not self.server.still_serving:
+                    return
+                timeout = http_serve.KEEP_ALIVE_TIMEOUT
+        finally:
+            self.transport.close()
+            if not self.server.still_serving:
+                self.server.loop.stop()
+
+class AsyncHTTPServer(http_serve.HandlerRegistry):
+    """Event driven http server, with the same handler registry as
+    http_serve.MyHTTPServer"""
+    def __init__(self, addr, max_workers=MAX_WORKERS):
+        http_serve.HandlerRegistry.__init__(self)
+        self.server_address = addr
+        self.still_serving = True
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers)
+        self.server = self.loop.run_until_complete(
+            self.loop.create_server(lambda: HTTPProtocol(self), addr[0], addr[1]))
+
+    def serve_forever(self):
+        """handle requests until still_serving is set to False, which
+        happens when the user quits Crunchy"""
+        self.loop.run_forever()
+
+    def server_close(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        self.executor.shutdown(wait=False)
+        self.loop.close()
+
+async def wait_for_output(buffer, loop, timeout=None):
+    """coroutine equivalent of cometIO.StringBuffer.get()"""
+    if timeout is not None:
+        deadline = loop.time() + timeout
+    while True:
+        ready = asyncio.Event()
+        wake_up = lambda: loop.call_soon_threadsafe(ready.set)
+        buffer.add_listener(wake_up)
+        try:
+            # check only once the listener is in place so that no data
+            # put in the buffer can go unnoticed.
+            delay = buffer.frame_delay()
+            if delay == 0:
+                data = buffer.get_nowait()
+                if data:
+                    return data
+                delay = None  # retrieved by another request in the meantime
+            if timeout is not None:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return ""
+                if delay is None or delay > remaining:
+                    delay = remaining
+            try:
+                await asyncio.wait_for(ready.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+        finally:
+            buffer.remove_listener(wake_up)
+
+async def comet(request):
+    """coroutine equivalent of cometIO.comet"""
+    pageid = request.args["pageid"]
+    if cometIO.page_seen(pageid, 1) is None:
+        cometIO.send_page_gone(request)
+        return
+    try:
+        data = await wait_for_output(cometIO.output_buffers[pageid],
+                                     request.server.loop,
+                                     cometIO.COMET_TIMEOUT)
+    finally:
+        cometIO.page_seen(pageid, -1)
+    cometIO.send_comet_data(request, data)
+coroutine_handlers[cometIO.comet] = comet
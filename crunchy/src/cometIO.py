@@ -8,12 +8,16 @@ Also handles the redirection of stdin, stdout and stderr.
 import threading
 import sys
 import re
+import time
+from collections import deque
 
 import src.interpreter as interpreter
+import src.governor as governor
 import src.utilities as utilities
 import src.interface as interface
 
-from src.interface import config, accounts, names, python_version
+from src.interface import config, accounts, names, python_version, translate
+_ = translate['_']
 
 # When print statements occur in cometIO.py, they are swallowed by the
 # http server.  As a result, we introduce debug_msg as a utility function
@@ -46,35 +50,129 @@ catch(err){;} /* may not exist if ctypes not present. */
 show_help_js = """
 $("#help_menu,#help_menu_x").show();
 """
+output_end = '");//output\n'
+truncated_js = """$("#out_%s").append("<span class='%s'>\\n%s\\n</span>");\n"""
+
+# Output sent to the browser is grouped in frames: once some output is
+# available, we wait up to FRAME_DELAY seconds (or until FRAME_SIZE
+# characters are available) for more output to be added to the same frame.
+FRAME_DELAY = 0.02
+FRAME_SIZE = 65536
+# When more than MAX_PENDING characters are waiting to be sent to a page,
+# the threads writing output are blocked for up to BACKPRESSURE_WAIT seconds,
+# giving the browser a chance to catch up; after that, output is dropped.
+MAX_PENDING = 1048576
+BACKPRESSURE_WAIT = 5
+# Code is executed by a pool of worker threads; at most MAX_RUNNING
+# executions (and MAX_RUNNING_PER_USER for a given user) are running at
+# the same time, the others waiting in a queue.  Executions waiting for
+# input from the user are not counted.  Workers left idle for
+# WORKER_IDLE_TIMEOUT seconds are stopped.
+MAX_RUNNING = 8
+MAX_RUNNING_PER_USER = 2
+WORKER_IDLE_TIMEOUT = 60
+
+# Pages for which no /comet request has been received for PAGE_TIMEOUT
+# seconds are considered closed: everything kept for them is reclaimed by
+# reclaim_pages(), called every REAP_INTERVAL seconds.  /comet requests are
+# answered within COMET_TIMEOUT seconds, even if there is no output, so
+# that the pages still displayed are seen regularly.
+PAGE_TIMEOUT = 300
+REAP_INTERVAL = 60
+COMET_TIMEOUT = 30
+
+queued_js = """
+$("#out_%s").append("<span id='queued_%s' class='%s'>%s\\n</span>");
+"""
+started_js = """
+$("#queued_%s").remove();
+"""
+
+# Every write of a program goes through ThreadedBuffer.write and
+# CrunchyIOBuffer.put_output, and has to be escaped.  Chained replace() are
+# faster than str.translate or a regular expression for the short strings
+# usually written, as each replace() is done in C and copies nothing when
+# the character is absent.
+def escape_html(text):
+    """escapes <>& for HTML, and the backslashes for javascript"""
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace(
+                        '>', '&gt;').replace('\\', '\\\\')
+
+def escape_js(text):
+    """escapes the double quotes and end of lines for javascript"""
+    return text.replace('"', '&#34;').replace('\n', '\\n').replace(
+                        '\r', '\\r')
+
+# The prompts of the interpreters are marked (see interpreter.py) so that
+# they can be styled; longest first, as '&gt;&gt;&gt; ' ends '&lt;t&gt;&gt;&gt; '.
+prompt_pattern = re.compile("crunchy_py_prompt(%s)" % "|".join([re.escape(p)
+                    for p in ['&lt;t&gt;&gt;&gt; ', # type info prompt
+                              '&gt;&gt;&gt; ',      # normal prompt
+                              '... ',               # normal continuation prompt
+                              '--&gt; ',            # isolated prompt
+                              '_u__)) ',            # Parrots
+                              '_u__) '              # parrot
+                              ]]))
+
+def style_output(data):
+    """escapes some output for HTML and javascript, recovering the
+    character references like &#1234; and styling the prompts"""
+    escaped = escape_html(data)
+    if '&' in data:
+        # this reverses changes like from &amp;#1234; to &#1234;
+        escaped = utilities.entity_pattern.sub(utilities.recover_entity_pattern,
+                                               escaped)
+    if 'crunchy_py_prompt' in data:
+        #Note: it is important to ensure that the py_prompt class is
+        # surrounded by single quotes - not double ones.
+        escaped = prompt_pattern.sub("<span class='%s'>\\1" %
+                                     interface.generic_prompt, escaped)
+    return escaped
 
 class StringBuffer(object):
     """A thread safe buffer used to queue up strings that can be appended
     together, I've left this in a separate class because it might one day be
-    useful someplace else"""
+    useful someplace else.
+    The strings are kept in a list of chunks, and only joined when retrieved,
+    so that adding some data never requires copying what is already there."""
     def __init__(self):
         self.lock = threading.RLock()
         self.event = threading.Event()
-        self.data = ""
-    def get(self):
+        # Event.is_set is named isSet before Python 2.6
+        self.event_is_set = getattr(self.event, 'is_set', self.event.isSet)
+        self.chunks = deque()
+        self.size = 0      # total length of the chunks
+        self.newlines = 0  # number of complete lines in the chunks
+        self.listeners = []
+    def get(self, timeout=None):
         """get the current contents of the buffer, if the buffer is empty, this
-        always blocks until data is available.
+        always blocks until data is available - or, if a timeout is given,
+        until that many seconds have passed, returning an empty string.
         Multiple clients are handled in no particular order"""
         debug_msg("entering StringBuffer.get", 1)
+        if timeout is not None:
+            deadline = time.time() + timeout
         while True:
             debug_msg("begin loop", 5)
             self.event.clear()
             debug_msg("cleared events", 5)
             self.lock.acquire()
             debug_msg("acquired lock", 5)
-            if len(self.data) > 0:
-                t = self.data
-                self.data = ""
+            delay = self.frame_delay()
+            if delay == 0:
+                t = self.empty()
                 self.lock.release()
                 debug_msg("leaving StringBuffer.get: " + t, 1)
                 return t
             self.lock.release()
             debug_msg("released lock", 5)
-            self.event.wait()
+            if timeout is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return ""
+                if delay is None or delay > remaining:
+                    delay = remaining
+            self.event.wait(delay)
 
     def getline(self, uid):
         """basically does the job of readline"""
@@ -82,44 +180,189 @@ class StringBuffer(object):
         while True:
             self.event.clear()
             self.lock.acquire()
-            data_t = self.data.split("\n", 1)
-            if len(data_t) > 1:
+            if self.newlines > 0:
                 # we have a complete line, do something with it
-                self.data = data_t[1]
+                line = self.read_line()
                 self.lock.release()
-                debug_msg("leaving StringBuffer.getline: " + data_t[0] +
+                debug_msg("leaving StringBuffer.getline: " + line +
                                                         "end_of_data", 2)
-                return uid, data_t[0] + "\n"
+                return uid, line
             # no luck:
             self.lock.release()
             self.event.wait()
 
+    def read_line(self):
+        """removes the first line from the buffer and returns it; must be
+        called with the lock held, when there is at least a complete line"""
+        parts = []
+        while True:
+            chunk = self.chunks.popleft()
+            pos = chunk.find("\n")
+            if pos == -1:
+                parts.append(chunk)
+            else:
+                parts.append(chunk[:pos + 1])
+                if pos + 1 < len(chunk):
+                    self.chunks.appendleft(chunk[pos + 1:])
+                break
+        line = "".join(parts)
+        self.size -= len(line)
+        self.newlines -= 1
+        return line
+
+    def get_nowait(self):
+        """get the current contents of the buffer, which may be empty,
+        without ever blocking"""
+        self.lock.acquire()
+        t = self.empty()
+        self.lock.release()
+        return t
+
+    def empty(self):
+        """returns the contents of the buffer, leaving it empty;
+        must be called with the lock held"""
+        t = "".join(self.chunks)
+        self.chunks.clear()
+        self.size = 0
+        self.newlines = 0
+        return t
+
+    def frame_delay(self):
+        """returns None if the buffer is empty; otherwise, returns the time
+        (in seconds) to wait before retrieving its contents"""
+        if self.size:
+            return 0
+        return None
+
     def put(self, data):
         """put some data into the buffer"""
         debug_msg("entering StringBuffer.put: " + data, 3)
         self.lock.acquire()
-        self.data += data
-        self.event.set()
+        self.append(data)
+        self.notify()
         self.lock.release()
         debug_msg("Leaving StringBuffer.put:", 3)
 
+    def append(self, data):
+        """adds some data at the end of the buffer, without notifying
+        the clients; must be called with the lock held"""
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+            self.newlines += data.count("\n")
+
+    def notify(self):
+        """wake up the clients waiting for data; must be called
+        with the lock held"""
+        # the clients clear the event before checking the buffer, so that
+        # it only needs to be set again once they have done so
+        if not self.event_is_set():
+            self.event.set()
+        for listener in self.listeners:
+            listener()
+
+    def add_listener(self, listener):
+        """register a function (taking no argument) to be called whenever
+        data is put in the buffer.  This allows clients, like the event
+        driven server in async_serve.py, to wait for data without
+        blocking a thread in get()"""
+        self.lock.acquire()
+        self.listeners.append(listener)
+        self.lock.release()
+
+    def remove_listener(self, listener):
+        """unregister a function added with add_listener"""
+        self.lock.acquire()
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+        self.lock.release()
+
 class CrunchyIOBuffer(StringBuffer):
     """A version optimised for crunchy IO"""
     help_flag = False
 
+    def __init__(self):
+        StringBuffer.__init__(self)
+        self.pending_since = 0
+        # uid whose output instruction is still open at the end of the
+        # buffer, so that more output can simply be appended to it.
+        self.open_uid = None
+        self.truncated = False
+        self.drained = threading.Condition(self.lock)
+
+    def append(self, data):
+        """adds some data at the end of the buffer; must be called with
+        the lock held"""
+        if not self.size:
+            self.pending_since = time.time()
+        StringBuffer.append(self, data)
+
+    def close_output(self):
+        """terminates the open output instruction, if any; must be called
+        with the lock held"""
+        if self.open_uid is not None:
+            StringBuffer.append(self, output_end)
+            self.open_uid = None
+
+    def put(self, data):
+        """put some data into the buffer"""
+        self.lock.acquire()
+        self.close_output()
+        StringBuffer.put(self, data)
+        self.lock.release()
+
+    def empty(self):
+        """returns the contents of the buffer, leaving it empty;
+        must be called with the lock held"""
+        self.close_output()
+        t = StringBuffer.empty(self)
+        self.drained.notifyAll()
+        return t
+
+    def frame_delay(self):
+        """returns None if the buffer is empty; otherwise, returns the time
+        (in seconds) to wait before retrieving its contents, so that
+        consecutive outputs can be sent to the browser together."""
+        self.lock.acquire()
+        if not self.size:
+            delay = None
+        elif self.size >= FRAME_SIZE:
+            delay = 0
+        else:
+            delay = max(0, self.pending_since + FRAME_DELAY - time.time())
+        self.lock.release()
+        return delay
+
+    def has_room(self, uid):
+        """returns True if output can be added to the buffer, waiting a bit
+        for the browser to retrieve some the first time it is full; must be
+        called with the lock held"""
+        if self.size > MAX_PENDING and not self.truncated:
+            self.drained.wait(BACKPRESSURE_WAIT)
+        if self.size > MAX_PENDING:
+            if not self.truncated:
+                self.truncated = True
+                self.put(truncated_js % (uid, interface.generic_traceback,
+                                         _("Too much output: some has been dropped.")))
+            return False
+        self.truncated = False
+        return True
+
     def put_output(self, data, uid):
-        """put some output into the pipe"""
+        """put some output into the pipe; consecutive outputs for the same
+        uid are merged in a single javascript instruction"""
 
-        #apply before_output hook first
-        data = interface.plugin['services'].apply_io_hook('ANY', 'before_output', data)
-        data = interface.plugin['services'].apply_io_hook(uid, 'before_output', data)
+        #apply before_output hook first, unless none is registered for uid
+        services = interface.plugin['services']
+        hooks = getattr(services, 'io_hooks', None)
+        if hooks is None or 'ANY' in hooks or uid in hooks:
+            data = services.apply_io_hook('ANY', 'before_output', data)
+            data = services.apply_io_hook(uid, 'before_output', data)
         if data == "":
             return
-        data = data.replace('"', '&#34;')
-        pdata = data.replace("\\", "\\\\")
-        pdata = data.replace("\n", "\\n")
-        pdata = pdata.replace("\r", "\\r")
-        debug_msg("pdata = "+ pdata, 4)
+        pdata = escape_js(data)
+        if 4 in debug_ids:
+            debug_msg("pdata = "+ pdata, 4)
         if python_version < 3:
             try:
                 pdata = pdata.decode('utf-8')
@@ -128,17 +371,21 @@ class CrunchyIOBuffer(StringBuffer):
                 debug_msg('   The likely cause is trying to print a unicode string prefixed by u')
                 debug_msg('   as in u"...".  If not, please file a bug report.')
         self.lock.acquire()
+        if not self.has_room(uid):
+            self.lock.release()
+            return
         pageid = uid.split("_")[0]
         username = names[pageid]
-        debug_msg("username = %s in CrunchyIOBuffer.put_output"%username, 5)
-        if self.data.endswith('";//output\n'):
-            self.data = self.data[:-11] + '%s";//output\n' % (pdata)
+        if 5 in debug_ids:
+            debug_msg("username = %s in CrunchyIOBuffer.put_output"%username, 5)
+        if self.open_uid == uid:
+            self.append(pdata)
             # Saving session; appending from below
             if uid in config[username]['logging_uids']:
                 log_id = config[username]['logging_uids'][uid][0]
-                config[username]['log'][log_id].append(data)
-                utilities.log_session(username)
-            self.event.set()
+                utilities.log_entry(username, log_id,
+                                    data.replace('"', '&#34;'))
+            self.notify()
         elif self.help_flag == True:
             self.put(show_help_js)
             pdata = pdata.replace("class='%s'"%interface.generic_output, "class='help_menu'")
@@ -147,12 +394,13 @@ class CrunchyIOBuffer(StringBuffer):
             self.help_flag = False
         else:
             #use jQuery:
-            self.put("""$("#out_%s").append("%s");//output\n""" % (uid, pdata))
+            self.put('$("#out_%s").append("%s' % (uid, pdata))
+            self.open_uid = uid
             # Saving session; first line...
             if uid in config[username]['logging_uids']:
                 log_id = config[username]['logging_uids'][uid][0]
-                config[username]['log'][log_id].append(data)
-                utilities.log_session(username)
+                utilities.log_entry(username, log_id,
+                                    data.replace('"', '&#34;'))
         self.lock.release()
 
 # there is one CrunchyIOBuffer for output per page:
@@ -162,9 +410,231 @@ input_buffers = {}
 # and also one thread per input widget:
 threads = {}
 
+# set when the code is run in worker processes; see process_exec.py
+execution_backend = None
+
+class Route(object):
+    """Where the IO of a program goes: the widget uid, and the buffer its
+    input is read from.  It is kept by each thread running the program,
+    including the threads started by the program itself."""
+    def __init__(self, uid, input_buffer):
+        self.uid = uid
+        self.pageid = uid.split("_")[0]
+        self.input = input_buffer
+        self.active = True  # until the program is over
+
+# the Route of the current thread, if its IO is redirected
+routing = threading.local()
+
+def current_route():
+    """returns the Route of the current thread, or None if its IO is not
+    redirected"""
+    route = getattr(routing, 'route', None)
+    if route is not None and route.active:
+        return route
+    return None
+
+def current_uid():
+    """returns the uid of the widget running the code of the current
+    thread, or None"""
+    route = getattr(routing, 'route', None)
+    if route is not None:
+        return route.uid
+    return None
+
+def route_new_threads(start):
+    """wraps Thread.start so that the threads started by a program have
+    their IO redirected to the same widget"""
+    def start_routed(self):
+        route = current_route()
+        if route is not None:
+            run = self.run
+            def run_routed():
+                routing.route = route
+                run()
+            self.run = run_routed
+        return start(self)
+    return start_routed
+threading.Thread.start = route_new_threads(threading.Thread.start)
+
 def kill_thread(uid):
     """Kill a thread, given an associated uid"""
-    threads[uid].terminate()
+    if execution_backend is not None and execution_backend.kill(uid):
+        return
+    if execution_pool.cancel(uid):
+        return  # it had not started yet
+    thread = threads.get(uid)
+    if thread is not None:
+        thread.terminate()
+
+class Worker(interpreter.KillableThread):
+    """A thread of the ExecutionPool, running one Interpreter after the
+    other"""
+    def __init__(self, pool):
+        interpreter.KillableThread.__init__(self)
+        self.pool = pool
+        self.task = None  # set by ExecutionPool.next_task
+        self.retired = False
+        self.setDaemon(True)
+
+    def run(self):
+        # a worker can be started while a program is running (see
+        # ExecutionPool.suspend); it is not one of its threads
+        routing.route = None
+        # kill_thread can interrupt a task just as it is over: the
+        # KeyboardInterrupt can then be raised anywhere in this loop, and
+        # next_task counts each task as done only once.
+        while not self.retired:
+            try:
+                task = self.task
+                if task is not None and threads.get(task.channel) is self:
+                    del threads[task.channel]
+                if self.pool.next_task(self) is None:
+                    return
+                try:
+                    self.task.run()
+                except Exception:  # e.g. its page has been reclaimed
+                    debug_msg("Problem in Worker.run", 6)
+            except KeyboardInterrupt:  # see kill_thread
+                pass
+
+class ExecutionPool(object):
+    """Runs Interpreter instances (as tasks) in a bounded number of
+    reused worker threads; see MAX_RUNNING and MAX_RUNNING_PER_USER.
+    Tasks which have to wait are announced on their page."""
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.queue = deque()  # tasks waiting to be run
+        self.ready = deque()  # tasks to be picked up by a worker
+        self.running = {}  # username -> number of running tasks
+        self.nb_running = 0
+        self.idle = 0  # number of workers waiting for a task
+        self.nb_workers = 0
+
+    def submit(self, task):
+        """runs the task as soon as possible"""
+        self.lock.acquire()
+        try:
+            task.suspended = False
+            task.queued = False
+            task.finished = False
+            self.queue.append(task)
+            self.schedule()
+            if task in self.queue:
+                task.queued = True
+                write_js(task.channel.split("_")[0], queued_js % (task.channel,
+                          task.channel, interface.generic_output,
+                          _("Waiting for other programs to finish...")))
+        finally:
+            self.lock.release()
+
+    def cancel(self, uid):
+        """removes the task for uid from the queue; returns False if there
+        was none"""
+        self.lock.acquire()
+        try:
+            for task in self.queue:
+                if task.channel == uid:
+                    self.queue.remove(task)
+                    write_js(uid.split("_")[0], started_js % uid +
+                                                hide_io_js % (uid, uid, uid))
+                    return True
+            return False
+        finally:
+            self.lock.release()
+
+    def can_run(self, username):
+        """returns True if a task can be started for username; must be
+        called with the lock held"""
+        return (self.nb_running < MAX_RUNNING and
+                self.running.get(username, 0) < MAX_RUNNING_PER_USER)
+
+    def start(self, task):
+        """counts a task as running; must be called with the lock held"""
+        self.nb_running += 1
+        self.running[task.username] = self.running.get(task.username, 0) + 1
+
+    def stop(self, task):
+        """counts a task as no longer running; must be called with the
+        lock held"""
+        self.nb_running -= 1
+        self.running[task.username] -= 1
+        if not self.running[task.username]:
+            del self.running[task.username]
+
+    def schedule(self):
+        """hands the queued tasks which can be run to workers, in order;
+        must be called with the lock held"""
+        for task in list(self.queue):
+            if not self.can_run(task.username):
+                continue
+            self.queue.remove(task)
+            self.start(task)
+            self.ready.append(task)
+            if self.idle < len(self.ready):
+                self.nb_workers += 1
+                Worker(self).start()
+        # wakes up the idle workers, and the tasks waiting in resume()
+        self.lock.notifyAll()
+
+    def next_task(self, worker):
+        """gives the next task to be run by a worker (as worker.task), once
+        it is done with the previous one; returns it, or None once the
+        worker has been idle for WORKER_IDLE_TIMEOUT seconds"""
+        self.lock.acquire()
+        try:
+            self.idle += 1
+            try:
+                done = worker.task
+                if done is not None and not done.finished:
+                    done.finished = True
+                    if not done.suspended:
+                        self.stop(done)
+                    self.schedule()
+                worker.task = None
+                deadline = time.time() + WORKER_IDLE_TIMEOUT
+                while not self.ready:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.lock.wait(remaining)
+            finally:
+                self.idle -= 1
+            if not self.ready:
+                self.nb_workers -= 1
+                worker.retired = True
+                return None
+            task = worker.task = self.ready.popleft()
+            if task.queued:
+                write_js(task.channel.split("_")[0], started_js % task.channel)
+            return task
+        finally:
+            self.lock.release()
+
+    def suspend(self, task):
+        """called from a running task which waits for input: it is no
+        longer counted as running in the meantime"""
+        self.lock.acquire()
+        try:
+            self.stop(task)
+            task.suspended = True
+            self.schedule()
+        finally:
+            self.lock.release()
+
+    def resume(self, task):
+        """called from a task which received the input it waited for:
+        waits until it can be counted as running again"""
+        self.lock.acquire()
+        try:
+            while not self.can_run(task.username):
+                self.lock.wait()
+            self.start(task)
+            task.suspended = False
+        finally:
+            self.lock.release()
+
+execution_pool = ExecutionPool()
 
 def comet(request):
     """An http path handler, called from the page - blocks until there is data
@@ -173,14 +643,23 @@ def comet(request):
     debug_msg("Entering comet() in cometIO.py", 9)
     pageid = request.args["pageid"]
     debug_msg(" ... request.args = %s" % request.args, 9)
-    #wait for some data
-    debug_msg(" ... wait for data", 9)
-    data = output_buffers[pageid].get()
-    debug_msg(" ... found data", 9)
-    # OK, data found
-    request.send_response(200)
-    request.end_headers()
+    page = page_seen(pageid, 1)
+    if page is None:
+        send_page_gone(request)
+        return
+    try:
+        #wait for some data
+        debug_msg(" ... wait for data", 9)
+        data = output_buffers[pageid].get(COMET_TIMEOUT)
+        debug_msg(" ... found data", 9)
+    finally:
+        page_seen(pageid, -1)
+    send_comet_data(request, data)
+    debug_msg(" ... done in comet()", 9)
 
+def send_comet_data(request, data):
+    """sends the javascript code retrieved from an output buffer as the
+    response to a comet request"""
     # Whereas for Python 2  data is passed in encoded strings, with
     # Python 3, request data (from std{in, out, err}) is passed along in
     # Unicode strings; these need to
@@ -188,15 +667,167 @@ def comet(request):
     #if python_version >= 3:
     data = data.encode('utf-8')
 
+    request.send_response(200)
+    request.send_header('Content-Length', str(len(data)))
+    request.end_headers()
     request.wfile.write(data)
     request.wfile.flush()
-    debug_msg(" ... done in comet()", 9)
+
+def send_page_gone(request):
+    """answers a /comet request for a page which has been reclaimed; the
+    page stops asking for output"""
+    request.send_response(404)
+    request.send_header('Content-Length', '0')
+    request.end_headers()
 
 def register_new_page(pageid):
     """Sets up the output queue for a new page"""
     output_buffers[pageid] = CrunchyIOBuffer()
+    pages_lock.acquire()
+    pages[pageid] = PageRecord(pageid, names.get(pageid))
+    pages_lock.release()
 interface.from_comet['register_new_page'] = register_new_page
 
+class PageRecord(object):
+    """what is known about a page displayed in a browser"""
+    def __init__(self, pageid, username):
+        self.pageid = pageid
+        self.username = username
+        self.created = self.last_seen = time.time()
+        self.waiting = 0  # number of /comet requests being handled
+
+    def idle(self, now):
+        """returns True if the page seems to have been closed"""
+        return not self.waiting and now - self.last_seen > PAGE_TIMEOUT
+
+# the pages which are displayed, by pageid
+pages = {}
+pages_lock = threading.Lock()
+# functions called with the pageid of each page reclaimed, so that plugins
+# can forget what they kept for it
+page_cleanup_handlers = []
+
+def page_seen(pageid, waiting):
+    """records a /comet request for a page, starting (waiting=1) or
+    ending (waiting=-1); returns the page, or None if it is unknown."""
+    pages_lock.acquire()
+    try:
+        page = pages.get(pageid)
+        if page is not None:
+            page.waiting += waiting
+            page.last_seen = time.time()
+        return page
+    finally:
+        pages_lock.release()
+
+def reclaim_page(pageid):
+    """forgets everything kept for a page, stopping its programs"""
+    pages_lock.acquire()
+    page = pages.pop(pageid, None)
+    pages_lock.release()
+    prefix = pageid + "_"
+    for uid in list(threads):
+        if not uid.startswith(prefix):
+            continue
+        try:
+            kill_thread(uid)
+        except Exception:
+            pass  # it just ended
+        # a program waiting for input only stops once it gets some
+        if uid in input_buffers:
+            input_buffers[uid].put("\n")
+    for task in list(execution_pool.queue):
+        if task.channel.startswith(prefix):
+            execution_pool.cancel(task.channel)
+    output_buffers.pop(pageid, None)
+    names.pop(pageid, None)
+    interpreter.BorgGroups._shared_states.pop(pageid, None)
+    if page is not None and page.username in config:
+        logging_uids = config[page.username].get('logging_uids', {})
+        for uid in list(logging_uids):
+            if uid.startswith(prefix):
+                del logging_uids[uid]
+    for handler in page_cleanup_handlers:
+        handler(pageid)
+
+def reclaim_pages():
+    """reclaims the pages which seem to have been closed; returns their
+    number"""
+    now = time.time()
+    pages_lock.acquire()
+    idle = [page.pageid for page in pages.values() if page.idle(now)]
+    pages_lock.release()
+    for pageid in idle:
+        reclaim_page(pageid)
+    return len(idle)
+
+def reap_pages():
+    """reclaims the pages closed, every REAP_INTERVAL seconds"""
+    while True:
+        time.sleep(REAP_INTERVAL)
+        try:
+            reclaim_pages()
+        except Exception:
+            debug_msg("Problem in reclaim_pages", 6)
+
+reaper = None
+def start_reaper():
+    """starts the thread reclaiming the pages closed, if needed"""
+    global reaper
+    if reaper is None:
+        reaper = threading.Thread(target=reap_pages, name="page reaper")
+        reaper.setDaemon(True)
+        reaper.start()
+
+def page_status():
+    """returns, for each page displayed, a dict giving its pageid,
+    username, age and idle time (in seconds), the number of programs
+    running or queued, the size of the output not yet sent and the number
+    of variables defined in its shared (Borg) interpreters"""
+    now = time.time()
+    pages_lock.acquire()
+    records = list(pages.values())
+    pages_lock.release()
+    status = []
+    for page in records:
+        prefix = page.pageid + "_"
+        buffer = output_buffers.get(page.pageid)
+        borg = interpreter.BorgGroups._shared_states.get(page.pageid, {})
+        status.append({
+            'pageid': page.pageid,
+            'username': page.username,
+            'age': int(now - page.created),
+            'idle': int(now - page.last_seen),
+            'programs': len([uid for uid in list(threads) if uid.startswith(prefix)]),
+            'queued': len([task for task in execution_pool.queue
+                           if task.channel.startswith(prefix)]),
+            'output': buffer is not None and buffer.size or 0,
+            'variables': len(borg.get('locals', {})),
+        })
+    return status
+
+status_row = "<tr>" + "<td>%s</td>" * 8 + "</tr>\n"
+status_columns = ['pageid', 'username', 'age', 'idle', 'programs', 'queued',
+                  'output', 'variables']
+
+def status(request):
+    """An http request handler showing the pages displayed, and the
+    resources they use"""
+    rows = [status_row % tuple(status_columns)]
+    for page in page_status():
+        rows.append(status_row % tuple([utilities.changeHTMLspecialCharacters(
+                        str(page[column])) for column in status_columns]))
+    html = ("<html><head><title>Crunchy status</title></head><body>"
+            "<h1>%d pages</h1><table>%s</table></body></html>" %
+            (len(rows) - 1, "".join(rows)))
+    data = html.encode('utf-8')
+    request.send_response(200)
+    request.send_header('Content-Type', 'text/html; charset=UTF-8')
+    request.send_header('Cache-Control', 'no-cache')
+    request.send_header('Content-Length', str(len(data)))
+    request.end_headers()
+    request.wfile.write(data)
+
 def write_js(pageid, jscode):
     """write some javascript to a page"""
     output_buffers[pageid].put(jscode)
@@ -209,7 +840,8 @@ def write_output(pageid, uid, output):
         debug_msg("Problem in write_output", 6)
 
 def do_exec(code, uid, doctest=False):
-    """exec code in a new thread (and isolated environment).
+    """exec code in a worker thread of the execution pool (and isolated
+    environment), or in a worker process if execution_backend is set.
     """
     debug_msg("Entering cometIO.do_exec()", 9)
     # When a security mode is set to "display ...", we only parse the
@@ -228,13 +860,14 @@ def do_exec(code, uid, doctest=False):
 
     # make the io widget appear
     output_buffers[pageid].put(show_io_js % (uid, uid, uid))
+    if execution_backend is not None:
+        execution_backend.submit(code, uid, doctest, username)
+        return
     debug_msg(" creating an intrepreter instance in cometIO.do_exec()", 9)
     t = interpreter.Interpreter(code, uid, symbols=config[username]['symbols'],
                                 doctest=doctest)
-    debug_msg(" setting a daemon thread in cometIO.do_exec()", 5)
-    t.setDaemon(True)
-    debug_msg("  starting the thread in cometIO.do_exec()", 5)
-    t.start()
+    debug_msg("  submitting it to the execution pool in cometIO.do_exec()", 5)
+    execution_pool.submit(t)
     debug_msg("reached the end of cometIO.do_exec()", 5)
 
 def push_input(request):
@@ -261,14 +894,48 @@ def push_input(request):
         input_buffers[uid].put(request.data)
 
     request.send_response(200)
+    request.send_header('Content-Length', '0')
     request.end_headers()
 
+def stop_runaway(uid):
+    """interrupts a program which has been running for too long without
+    waiting for input; see governor.py"""
+    pageid = uid.split("_")[0]
+    if pageid in output_buffers:
+        output_buffers[pageid].put(truncated_js % (uid,
+            interface.generic_traceback,
+            _("This program has been running for too long without waiting for input: it is being stopped.")))
+    kill_thread(uid)
+
 def raw_push_input(uid, data):
     input_buffers[uid].put(data)
 
 def is_accept_input(uid):
     return uid in input_buffers
 
+def suspend_task():
+    """called before waiting for input: if the current thread is a worker
+    of the execution pool, it stops counting as running; returns the
+    worker, to be passed to resume_task.  The threads started by a program
+    do not count: the program is still running while they wait."""
+    worker = threading.currentThread()
+    uid = current_uid()
+    if threads.get(uid) is not worker:
+        return None
+    governor.waiting(uid)
+    if isinstance(worker, Worker) and worker.task is not None:
+        worker.pool.suspend(worker.task)
+        return worker
+    return None
+
+def resume_task(worker):
+    """called once the input has been received; see suspend_task"""
+    uid = current_uid()
+    if threads.get(uid) is threading.currentThread():
+        governor.resumed(uid)
+    if worker is not None:
+        worker.pool.resume(worker.task)
+
 class ThreadedBuffer(object):
     """Split some IO acording to calling thread"""
     def __init__(self, out_buf=None, in_buf=None, buf_class="STDOUT"):
@@ -299,12 +966,24 @@ class ThreadedBuffer(object):
         return
 #====     end of IPython stuff
 
+    def close(self):
+        '''
+        dummy function: the streams redirected are shared by all threads;
+        called by multiprocessing when a worker process starts.
+        '''
+        return
+
     def register_thread(self, uid):
-        """register a thread for redirected IO, registers the current thread"""
+        """register the current thread, and the threads it will start, for
+        redirected IO"""
         mythread = threading.currentThread()
-        mythread.setName(uid)
-        input_buffers[uid] = StringBuffer()
-        threads[uid] = threading.currentThread()
+        if threads.get(uid) is not mythread or uid not in input_buffers:
+            # stdin, stdout and stderr are registered one after the other
+            input_buffers[uid] = StringBuffer()
+        threads[uid] = mythread
+        route = current_route()
+        if route is None or route.uid != uid or route.input is not input_buffers[uid]:
+            routing.route = Route(uid, input_buffers[uid])
         debug_msg("registering thread for uid=%s" % uid, 8)
 
     def unregister_thread(self):
@@ -312,15 +991,23 @@ class ThreadedBuffer(object):
         Uregister the current thread.
         This will cancel all pending input
         Assumes that no more input will be written specifically for this thread.
-        In future IO for this thread will go via the defaults.
+        In future IO for this thread, and the threads it has started, will
+        go via the defaults.
         """
-        uid = threading.currentThread().getName()
-        if not self.__redirect(uid):
+        route = current_route()
+        if route is None:
             return
-        pageid = uid.split("_")[0]
-        del input_buffers[uid]
+        route.active = False
+        routing.route = None
+        uid = route.uid
+        # the thread can no longer be stopped by kill_thread
+        if threads.get(uid) is threading.currentThread():
+            del threads[uid]
+        if input_buffers.get(uid) is route.input:
+            del input_buffers[uid]
         # hide the input box and the Stop thread link
-        output_buffers[pageid].put(hide_io_js % (uid, uid, uid))
+        if route.pageid in output_buffers:  # unless the page has been reclaimed
+            output_buffers[route.pageid].put(hide_io_js % (uid, uid, uid))
 
 
     def write(self, data):
@@ -329,8 +1016,8 @@ class ThreadedBuffer(object):
         # First, check to see whether this is intended for comet at
         # all. This lets us use pdb, among other things, without
         # characters being escaped for HTML.
-        uid = threading.currentThread().getName()
-        if not self.__redirect(uid):
+        route = current_route()
+        if route is None:
             try:
                 return self.default_out.write(data)
             except:
@@ -341,34 +1028,30 @@ class ThreadedBuffer(object):
         # state.  As a result, if we have long running code in one
         # Borg interpreter, there can be exchange of input or output between
         # the code running in that interpreter and code entered in another one.
-        pageid = uid.split("_")[0]
-        data = utilities.changeHTMLspecialCharacters(data)
-
-        debug_msg("write --- data , " + data.replace('\\', r'\\'), 4)
-        #Note: in the following, it is important to ensure that the
-        # py_prompt class is surrounded by single quotes - not double ones.
-        # normal prompt
-
-        for _prompt in ['&gt;&gt;&gt; ', # normal prompt
-                        '... ', # normal continuation prompt
-                        '--&gt; ', # isolated prompt
-                        '&lt;t&gt;&gt;&gt; ', # type info prompt
-                        '_u__) ', # parrot
-                        '_u__)) ' # Parrots
-                        ]:
-            dd = data.split('crunchy_py_prompt%s' % _prompt)
-            data = ("<span class='%s'>%s" % (interface.generic_prompt, _prompt)).join(dd)
-
-        data = data.replace('\\', r'\\')
+        uid = route.uid
+        run = governor.runs.get(uid)
+        if run is not None and not run.add_output(len(data)):
+            if run.notify_truncation():
+                output_buffers[route.pageid].put(truncated_js % (uid,
+                    interface.generic_traceback,
+                    _("Output limit reached: the rest of the output of this program is not displayed.")))
+            return
+        data = style_output(data)
+        if 4 in debug_ids:
+            debug_msg("write --- data , " + data, 4)
         data = "<span class='%s'>%s</span>" % (self.buf_class, data)
-        output_buffers[pageid].put_output(data, uid)
+        output_buffers[route.pageid].put_output(data, uid)
 
     def read(self):
         """N.B. this function is rarely, if ever, used - and is probably untested"""
-        uid = threading.currentThread().getName()
-        if self.__redirect(uid):
+        route = current_route()
+        if route is not None:
             #read the data
-            data = input_buffers[uid].get()
+            worker = suspend_task()
+            try:
+                data = route.input.get()
+            finally:
+                resume_task(worker)
         else:
             data = self.default_in.read()
         return data
@@ -376,22 +1059,22 @@ class ThreadedBuffer(object):
     def readline(self):
         """used by Interactive Console - raw_input(">>>")"""
 
-        uid = threading.currentThread().getName()
+        route = current_route()
+        uid = current_uid()
         new_id = "none"
         debug_msg("entering readline, uid=%s" % uid, 7)
-        if self.__redirect(uid):
-            new_id, data = input_buffers[uid].getline(uid)
+        if route is not None:
+            worker = suspend_task()
+            try:
+                new_id, data = route.input.getline(uid)
+            finally:
+                resume_task(worker)
         else:
             data = self.default_in.readline()
         debug_msg("leaving readline, uid=%s, new_id=%s\ndata=%s" % (uid,
                                                            new_id, data), 7)
         return data
 
-    def __redirect(self, uid):
-        """decide if the thread with uid uid should be redirected"""
-        t = uid in input_buffers
-        return t
-
     def default_write(self, data):
         """write to the default output"""
         # Normalize to Unicode because Python 3's doctest will not
@@ -0,0 +1,65 @@
+"""
+compression of the responses sent to the browser, using the content
+codings it accepts; see http_serve.response_coding() and the static files
+sent by the handle_default plugin.
+"""
+
+import zlib
+
+# Responses of at least COMPRESS_MIN_SIZE bytes are compressed when the
+# browser accepts it, unless their type would not gain anything (images...)
+# or their handler took care of it; see http_serve.response_coding().
+COMPRESS_MIN_SIZE = 1024
+COMPRESS_MAX_SIZE = 16*1024*1024  # larger responses are sent as is
+COMPRESS_LEVEL = 6
+ENCODINGS = ('gzip', 'deflate')  # by order of preference
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript',
+                      'application/x-javascript', 'application/json',
+                      'application/xml', 'application/xhtml+xml',
+                      'image/svg+xml')
+
+def accepted_encoding(accept_encoding):
+    '''returns the content coding, among ENCODINGS, acceptable according
+    to the Accept-Encoding header of a request, or None'''
+    if not accept_encoding:
+        return None
+    qvalues = {}
+    for item in accept_encoding.split(','):
+        params = item.split(';')
+        qvalue = 1.0
+        for param in params[1:]:
+            name, value = (param.split('=', 1) + [''])[:2]
+            if name.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0
+        qvalues[params[0].strip().lower()] = qvalue
+    for coding in ENCODINGS:
+        if qvalues.get(coding, qvalues.get('*', 0)) > 0:
+            return str(coding)  # a native string, even if the header is not
+    return None
+
+def compressible(content_type):
+    '''returns True if a response of the given Content-Type is worth
+    compressing; generated pages and comet frames have none.'''
+    if content_type is None:
+        return True
+    content_type = content_type.lower()
+    for prefix in COMPRESSIBLE_TYPES:
+        if content_type.startswith(prefix):
+            return True
+    return False
+
+def compressor(coding):
+    '''returns a zlib compression object producing the given coding'''
+    if coding == 'gzip':
+        wbits = 16 + zlib.MAX_WBITS
+    else:
+        wbits = zlib.MAX_WBITS  # "deflate" is the zlib format
+    return zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, wbits)
+
+def compress(data, coding):
+    '''returns data compressed with the given coding'''
+    c = compressor(coding)
+    return c.compress(data) + c.flush()
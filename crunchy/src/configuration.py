@@ -47,6 +47,7 @@ options = {
     'popups': [True, False],
     'forward_accept_language': [True, False],
     'friendly': [True, False],
+    'html_parser': ['beautifulsoup', 'html.parser'],
     'menu_position': ['default'],
     'alternate_python_version': [ANY],
     'user_dir': [ANY],
@@ -212,6 +213,12 @@ will be sent back if they are available.""")
 If True, Crunchy will try to simplify some tracebacks and doctest
 results so that they are easier to understand for beginners.""")
 
+    html_parser = make_property('html_parser',
+        doc="""\
+Specifies the parser used to read html pages: 'beautifulsoup' or
+'html.parser', which is faster and builds the same page from
+nearly all the documents.""")
+
     override_default_interpreter = make_property('override_default_interpreter',
         doc="""\
 If a value other than None is specified, Crunchy will replace
@@ -1,5 +1,5 @@
 # $Id$
-# element loader based on BeautifulSoup
+# element loader based on BeautifulSoup, or on the standard library HTMLParser
 
 # Absolute imports will ensure that BeautifulSoup, which relies on
 # them, will be importing the same modules that we do. Without this,
@@ -14,17 +14,25 @@ import os.path
 sys.path.insert(0, os.path.dirname(__file__))
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'beautifulsoup'))
 
-# http://www.crummy.com/software/BeautifulSoup/
-from . import BeautifulSoup as BS
-
-# soup classes that are left out of the tree
-ignorable_soup = (BS.Comment,
-                  BS.Declaration,
-                  BS.ProcessingInstruction,
-                  )
-
 from . import ElementTree as ET
 import html.entities, re
+from html.parser import HTMLParser
+
+BACKENDS = ("beautifulsoup", "html.parser")
+default_backend = "beautifulsoup"
+
+# http://www.crummy.com/software/BeautifulSoup/
+try:
+    from . import BeautifulSoup as BS
+except ImportError: # it relies on HTMLParseError, removed in Python 3.5
+    BS = None
+    default_backend = "html.parser"
+else:
+    # soup classes that are left out of the tree
+    ignorable_soup = (BS.Comment,
+                      BS.Declaration,
+                      BS.ProcessingInstruction,
+                      )
 
 pattern = re.compile("&(\w+);")
 
@@ -48,9 +56,183 @@ def unescape(string):
             return m.group(0) # use as is
     return pattern.sub(unescape_entity, string)
 
-def parse(file, builder=None):
+# markup that HTMLParser would choke on, fixed as BeautifulSoup does
+markup_massage = [(re.compile('(<[^<>]*)/>'), lambda x: x.group(1) + ' />'),
+                  (re.compile(r'<!\s+([^<>]*)>'), lambda x: '<!' + x.group(1) + '>')]
+attribute_entity = re.compile(r"&(#\d+|#x[0-9a-fA-F]+|\w+);")
+xml_entities = ("apos", "quot", "amp", "lt", "gt")
+
+def unescape_attribute(value):
+    # character references are replaced before unescape() is applied,
+    # as for BeautifulSoup's attributes
+    def unescape_reference(m):
+        ref = m.group(1)
+        if ref in xml_entities or not ref.startswith('#'):
+            return m.group(0)
+        if ref.startswith('#x'):
+            return chr(int(ref[2:], 16))
+        return chr(int(ref[1:]))
+    return unescape(attribute_entity.sub(unescape_reference, value))
+
+class SoupParser(HTMLParser):
+    """Feeds a TreeBuilder directly from the events of HTMLParser,
+    recovering from tag soup the same way BeautifulSoup does: implicitly
+    closing the tags that can not be nested, ignoring unmatched end tags,
+    and so on; the rules below are those of BeautifulSoup.BeautifulSoup."""
+    ROOT_TAG_NAME = '[document]'
+    SELF_CLOSING_TAGS = set(['br', 'hr', 'input', 'img', 'meta', 'spacer',
+                             'link', 'frame', 'base'])
+    PRESERVE_WHITESPACE_TAGS = set(['pre', 'textarea'])
+    QUOTE_TAGS = set(['script', 'textarea'])
+    # tag: tags resetting its nesting
+    NESTABLE_TAGS = {'span': [], 'font': [], 'q': [], 'object': [], 'bdo': [],
+                     'sub': [], 'sup': [], 'center': [],
+                     'blockquote': [], 'div': [], 'fieldset': [], 'ins': [],
+                     'del': [],
+                     'ol': [], 'ul': [], 'li': ['ul', 'ol'], 'dl': [],
+                     'dd': ['dl'], 'dt': ['dl'],
+                     'table': [], 'tr': ['table', 'tbody', 'tfoot', 'thead'],
+                     'td': ['tr'], 'th': ['tr'], 'thead': ['table'],
+                     'tbody': ['table'], 'tfoot': ['table']}
+    RESET_NESTING_TAGS = set(['blockquote', 'div', 'fieldset', 'ins', 'del',
+                              'noscript', 'address', 'form', 'p', 'pre',
+                              'ol', 'ul', 'li', 'dl', 'dd', 'dt',
+                              'table', 'tr', 'td', 'th', 'thead', 'tbody',
+                              'tfoot'])
+    STRIP_ASCII_SPACES = {9: None, 10: None, 12: None, 13: None, 32: None}
+
+    def __init__(self, builder):
+        try:
+            # character references are dealt with as BeautifulSoup does
+            HTMLParser.__init__(self, convert_charrefs=False)
+        except TypeError: # Python < 3.4
+            HTMLParser.__init__(self)
+        self.builder = builder
+        self.tag_stack = [self.ROOT_TAG_NAME]
+        self.quote_stack = []
+        self.preserve_whitespace = 0  # number of open tags from
+                                      # PRESERVE_WHITESPACE_TAGS
+        self.current_data = []
+        builder.start(self.ROOT_TAG_NAME, {})
+
+    def feed(self, markup):
+        for fix, m in markup_massage:
+            markup = fix.sub(m, markup)
+        HTMLParser.feed(self, markup)
+
+    def close(self):
+        # like BeautifulSoup, leaves out any incomplete markup at the end
+        # instead of calling HTMLParser.close()
+        self.end_data()
+        while len(self.tag_stack) > 1:
+            self.pop_tag()
+        self.builder.end(self.ROOT_TAG_NAME)
+        return self.builder.close()
+
+    def push_tag(self, name, attrs):
+        attrib = {}
+        for k, v in attrs:
+            if v is None:  # as in <input checked>
+                attrib[k] = k
+            else:
+                attrib[k] = unescape_attribute(v)
+        self.builder.start(name, attrib)
+        self.tag_stack.append(name)
+        if name in self.PRESERVE_WHITESPACE_TAGS:
+            self.preserve_whitespace += 1
+
+    def pop_tag(self):
+        name = self.tag_stack.pop()
+        if name in self.PRESERVE_WHITESPACE_TAGS:
+            self.preserve_whitespace -= 1
+        self.builder.end(name)
+
+    def end_data(self):
+        if self.current_data:
+            data = ''.join(self.current_data)
+            self.current_data = []
+            if (not self.preserve_whitespace and
+                    data.translate(self.STRIP_ASCII_SPACES) == ''):
+                if '\n' in data:
+                    data = '\n'
+                else:
+                    data = ' '
+            self.builder.data(unescape(data))
+
+    def pop_to_tag(self, name, inclusive=True):
+        if name == self.ROOT_TAG_NAME:
+            return
+        pops = 0
+        for i in range(len(self.tag_stack) - 1, 0, -1):
+            if name == self.tag_stack[i]:
+                pops = len(self.tag_stack) - i
+                break
+        if not inclusive:
+            pops -= 1
+        for i in range(pops):
+            self.pop_tag()
+
+    def smart_pop(self, name):
+        reset_triggers = self.NESTABLE_TAGS.get(name)
+        nestable = reset_triggers is not None
+        resets_nesting = name in self.RESET_NESTING_TAGS
+        for i in range(len(self.tag_stack) - 1, 0, -1):
+            p = self.tag_stack[i]
+            if p == name and not nestable:
+                self.pop_to_tag(name)
+                return
+            if ((reset_triggers is not None and p in reset_triggers) or
+                (reset_triggers is None and resets_nesting and
+                 p in self.RESET_NESTING_TAGS)):
+                self.pop_to_tag(p, False)
+                return
+
+    def handle_starttag(self, name, attrs):
+        if self.quote_stack:
+            # not a real tag
+            attrs = ''.join([' %s="%s"' % (k, v) for k, v in attrs])
+            self.handle_data('<%s%s>' % (name, attrs))
+            return
+        self.end_data()
+        if name in self.SELF_CLOSING_TAGS:
+            self.push_tag(name, attrs)
+            self.pop_tag()
+            return
+        self.smart_pop(name)
+        self.push_tag(name, attrs)
+        if name in self.QUOTE_TAGS:
+            self.quote_stack.append(name)
+
+    def handle_endtag(self, name):
+        if self.quote_stack and self.quote_stack[-1] != name:
+            # not a real end tag
+            self.handle_data('</%s>' % name)
+            return
+        self.end_data()
+        self.pop_to_tag(name)
+        if self.quote_stack:
+            self.quote_stack.pop()
+
+    def handle_data(self, data):
+        self.current_data.append(data)
+
+    def handle_charref(self, ref):
+        self.handle_data('&#%s;' % ref)
+
+    def handle_entityref(self, ref):
+        self.handle_data('&%s;' % ref)
+
+    # comments, declarations and processing instructions are left out,
+    # as ignorable_soup is.
+    def handle_comment(self, data):
+        self.end_data()
+
+    handle_decl = handle_pi = handle_comment
+
+def parse(file, builder=None, backend=None):
     """Loads an XHTML or HTML file into an Element structure, using
-    Leonard Richardson's tolerant BeautifulSoup parser.
+    Leonard Richardson's tolerant BeautifulSoup parser or, if backend is
+    "html.parser", a SoupParser.
 
     @param file Source file (a file object). Even on Python 2, this must
         be a filehandle that returns Unicode (see the codecs module),
@@ -58,11 +240,19 @@ def parse(file, builder=None):
         from a Unicode string. Will raise an AssertionError otherwise.
     @param builder Optional tree builder. If omitted, defaults to the
         "best" available <b>TreeBuilder</b> implementation.
+    @param backend One of BACKENDS; defaults to default_backend.
     @return An Element instance representing the HTML root element."""
 
     bob = builder
     if bob == None:
         bob = ET.TreeBuilder()
+    if backend is None or BS is None:
+        backend = default_backend
+
+    if backend == "html.parser":
+        parser = SoupParser(bob)
+        parser.feed(file.read())
+        return wrap(parser.close())
 
     def emit(soup):
         if isinstance(soup, BS.NavigableString):
@@ -82,9 +272,10 @@ def parse(file, builder=None):
 
     # build the tree
     emit(soup)
-    root = bob.close()
+    return wrap(bob.close())
 
-    # wrap the document in a html root element, if necessary
+def wrap(root):
+    """wraps the document in a html root element, if necessary"""
     if len(root) == 1 and root[0].tag == "html":
         return root[0]
 
@@ -0,0 +1,367 @@
+"""
+governor.py: keeps track of the resources used by the code of the users
+
+Each execution of some code (an Interpreter, in a thread of the server or
+in a worker process) is recorded while it runs: its wall time, the time
+spent waiting for input, its processor time when it can be measured, the
+output it produced and, in a worker process, the peak memory used.
+Once it is over, it is added to the usage of its user.
+
+Two quotas are enforced, the same for every user unless set otherwise in
+``quotas``:
+    * timeout: a program running for that many seconds without waiting for
+      input is interrupted;
+    * output: once a program has written that many characters since it last
+      received some input, the rest of its output is dropped, and the user
+      is told so.
+
+The usage of all the users, and the programs running, are available as
+JSON at /resources.
+
+unit tests in test_governor.rst
+"""
+
+import sys
+import threading
+import time
+try:
+    import resource
+except ImportError:  # not available on all systems
+    resource = None
+try:
+    import json
+except ImportError:  # Python < 2.6
+    json = None
+
+RUN_TIMEOUT = 300       # seconds; None: no limit
+OUTPUT_LIMIT = 1000000  # characters written by a program; None: no limit
+WATCHDOG_INTERVAL = 1   # seconds between checks of the programs running
+RECENT_RUNS = 50        # number of executions over kept for /resources
+
+# the external programs started by the users are limited to
+EXTERNAL_CPU_LIMIT = 600  # seconds of processor time
+EXTERNAL_MEMORY_LIMIT = 1024 * 1024 * 1024  # bytes of address space
+
+# {username: {'timeout': seconds, 'output': characters}}, overriding the
+# default quotas above for some users
+quotas = {}
+
+# True in a worker process (see process_exec.py), whose peak memory can
+# be attributed to the programs it runs
+measure_memory = False
+
+def quota(username, name):
+    """returns the quota 'timeout' or 'output' of a user"""
+    user_quotas = quotas.get(username)
+    if user_quotas is not None and name in user_quotas:
+        return user_quotas[name]
+    if name == 'timeout':
+        return RUN_TIMEOUT
+    return OUTPUT_LIMIT
+
+def thread_cpu_time(ident=None):
+    """returns the processor time used by a thread (the current one if
+    ident is None), or None if it can not be measured"""
+    if ident is not None:
+        if hasattr(time, 'pthread_getcpuclockid'):  # Python 3.7+, POSIX
+            try:
+                return time.clock_gettime(time.pthread_getcpuclockid(ident))
+            except (OSError, ValueError):
+                return None
+        return None
+    if hasattr(time, 'thread_time'):  # Python 3.7+
+        return time.thread_time()
+    if resource is not None and hasattr(resource, 'RUSAGE_THREAD'):  # Linux
+        usage = resource.getrusage(resource.RUSAGE_THREAD)
+        return usage.ru_utime + usage.ru_stime
+    return None
+
+def peak_memory():
+    """returns the peak memory used by the current process, in bytes, or
+    None if it can not be measured"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if peak and sys.platform != 'darwin':
+        peak *= 1024  # given in kilobytes, except on Mac OS X
+    return peak or None
+
+class Run(object):
+    """The resources used by an execution"""
+    def __init__(self, uid, username, local=True):
+        self.uid = uid
+        self.username = username
+        self.started = time.time()
+        self.ended = None
+        self.ident = None  # of the thread running it, if in this process
+        self.cpu_started = None
+        if local:
+            self.ident = getattr(threading.currentThread(), 'ident', None)
+            self.cpu_started = thread_cpu_time()
+        self.cpu = None
+        self.memory = None
+        self.output = 0
+        self.output_limit = quota(username, 'output')
+        self.burst = 0            # output since it last received some input
+        self.truncating = False
+        self.truncations = 0
+        self.waited = 0.0         # seconds spent waiting for input
+        self.busy_since = self.started  # None while waiting for input
+        self.waiting_since = None
+        self.timeouts = 0     # number of times it has been interrupted
+        self.interrupted = False  # since it last received some input
+
+    def add_output(self, size):
+        """records some output; returns False if it exceeds the quota"""
+        self.output += size
+        self.burst += size
+        return self.output_limit is None or self.burst <= self.output_limit
+
+    def notify_truncation(self):
+        """returns True the first time the output has to be truncated,
+        since the program last received some input"""
+        if self.truncating:
+            return False
+        self.truncating = True
+        self.truncations += 1
+        return True
+
+    def busy_time(self, now):
+        """seconds since the program last received some input"""
+        if self.busy_since is None:
+            return 0
+        return now - self.busy_since
+
+    def stats(self, now=None):
+        """returns the resources used as a dict"""
+        if now is None:
+            now = self.ended or time.time()
+        cpu = self.cpu
+        if (cpu is None and self.ended is None and self.ident is not None
+                and self.cpu_started is not None):
+            current = thread_cpu_time(self.ident)
+            if current is not None:
+                cpu = current - self.cpu_started
+        if cpu is not None:
+            cpu = round(cpu, 3)
+        return {'uid': self.uid,
+                'username': self.username,
+                'wall': round(now - self.started, 3),
+                'waiting_input': round(self.waited, 3),
+                'cpu': cpu,
+                'output': self.output,
+                'truncations': self.truncations,
+                'timeouts': self.timeouts,
+                'memory': self.memory}
+
+# the executions going on, by uid
+runs = {}
+# the executions over: the most recent ones, and totals by user
+recent = []
+usage = {}
+lock = threading.Lock()
+
+def new_total():
+    """the usage of a user, before any execution"""
+    return {'runs': 0, 'wall': 0, 'cpu': 0, 'output': 0, 'truncations': 0,
+            'timeouts': 0, 'memory': None, 'external': 0}
+
+def start_run(uid, username, local=True):
+    """records the start of an execution, run by the current thread if
+    local is True, or in another process"""
+    run = Run(uid, username, local)
+    lock.acquire()
+    runs[uid] = run
+    lock.release()
+    return run
+
+def end_run(uid, remote=None):
+    """records the end of an execution, with the resources used by it in
+    another process (as given by Run.stats) if remote is not None; returns
+    its Run, or None if it was not recorded"""
+    lock.acquire()
+    try:
+        run = runs.pop(uid, None)
+        if run is None:
+            return None
+        run.ended = time.time()
+        if run.busy_since is None:  # stopped while waiting for input
+            run.waited += run.ended - run.waiting_since
+        if remote is not None:
+            run.cpu = remote.get('cpu')
+            run.memory = remote.get('memory')
+            run.output = remote.get('output', 0)
+            run.truncations = remote.get('truncations', 0)
+        else:
+            if run.cpu_started is not None:
+                cpu = thread_cpu_time()
+                if cpu is not None:
+                    run.cpu = cpu - run.cpu_started
+            if measure_memory:
+                run.memory = peak_memory()
+        stats = run.stats()
+        recent.append(stats)
+        del recent[:-RECENT_RUNS]
+        total = usage.get(run.username)
+        if total is None:
+            total = usage[run.username] = new_total()
+        total['runs'] += 1
+        total['wall'] += stats['wall']
+        total['cpu'] += stats['cpu'] or 0
+        total['output'] += run.output
+        total['truncations'] += run.truncations
+        total['timeouts'] += run.timeouts
+        if run.memory is not None:
+            total['memory'] = max(total['memory'] or 0, run.memory)
+        return run
+    finally:
+        lock.release()
+
+def external_run(username):
+    """records a program started by a user outside of Crunchy"""
+    lock.acquire()
+    try:
+        if username not in usage:
+            usage[username] = new_total()
+        usage[username]['external'] += 1
+    finally:
+        lock.release()
+
+def waiting(uid):
+    """the execution uid is waiting for input"""
+    run = runs.get(uid)
+    if run is not None and run.busy_since is not None:
+        run.busy_since = None
+        run.waiting_since = time.time()
+
+def resumed(uid):
+    """the execution uid has received some input"""
+    run = runs.get(uid)
+    if run is not None and run.busy_since is None:
+        now = time.time()
+        run.waited += now - run.waiting_since
+        run.busy_since = now
+        run.interrupted = False
+        run.burst = 0
+        run.truncating = False
+
+def runaway(now=None):
+    """returns the uids of the executions which have exceeded their
+    timeout, and have not been interrupted yet"""
+    if now is None:
+        now = time.time()
+    found = []
+    lock.acquire()
+    try:
+        for run in runs.values():
+            timeout = quota(run.username, 'timeout')
+            if (timeout is not None and not run.interrupted and
+                    run.busy_time(now) > timeout):
+                run.interrupted = True
+                run.timeouts += 1
+                found.append(run.uid)
+    finally:
+        lock.release()
+    return found
+
+def watch(stop):
+    """calls stop(uid) for the executions exceeding their timeout, every
+    WATCHDOG_INTERVAL seconds"""
+    while True:
+        time.sleep(WATCHDOG_INTERVAL)
+        for uid in runaway():
+            try:
+                stop(uid)
+            except Exception:
+                pass  # it just ended
+
+watchdog = None
+def start_watchdog(stop):
+    """starts the thread interrupting the programs running for too long"""
+    global watchdog
+    if watchdog is None:
+        watchdog = threading.Thread(target=watch, args=(stop,),
+                                    name="execution watchdog")
+        watchdog.setDaemon(True)
+        watchdog.start()
+
+def report():
+    """returns the usage of each user, the executions going on and the
+    most recent ones, as a dict"""
+    now = time.time()
+    lock.acquire()
+    try:
+        running = [run.stats(now) for run in runs.values()]
+        users = {}
+        for username, total in usage.items():
+            users[username] = dict(total)
+            users[username]['running'] = 0
+        for stats in running:
+            if stats['username'] not in users:
+                users[stats['username']] = new_total()
+                users[stats['username']]['running'] = 0
+            users[stats['username']]['running'] += 1
+        return {'quotas': {'timeout': RUN_TIMEOUT, 'output': OUTPUT_LIMIT},
+                'users': users,
+                'running': running,
+                'recent': recent[:]}
+    finally:
+        lock.release()
+
+def resources(request):
+    """An http request handler giving the resources used by the code of
+    the users, in JSON"""
+    if json is not None:
+        data = json.dumps(report(), sort_keys=True)
+        content_type = 'application/json'
+    else:
+        data = repr(report())
+        content_type = 'text/plain'
+    data = data.encode('utf-8')
+    request.send_response(200)
+    request.send_header('Content-Type', content_type)
+    request.send_header('Cache-Control', 'no-cache')
+    request.send_header('Content-Length', str(len(data)))
+    request.end_headers()
+    request.wfile.write(data)
+
+def set_limits(cpu, memory):
+    """limits the processor time (in seconds) and the address space (in
+    bytes) of the current process; used in the worker processes running
+    the code of the users (see process_exec.py)"""
+    if resource is None:
+        return
+    for limit, value in ((resource.RLIMIT_CPU, cpu),
+                         (resource.RLIMIT_AS, memory)):
+        if not value:
+            continue
+        soft, hard = resource.getrlimit(limit)
+        if hard != resource.RLIM_INFINITY:
+            value = min(value, hard)
+        try:
+            resource.setrlimit(limit, (value, hard))
+        except (ValueError, resource.error):
+            pass
+
+# Run by the Python interpreter of a program started outside of Crunchy
+# (see limited_command): sets the limits, then replaces itself by the
+# program, so that they apply to it and not to the terminal displaying it.
+LIMITS_SCRIPT = """import os, sys
+try:
+    import resource
+    for limit, value in ((resource.RLIMIT_CPU, %d), (resource.RLIMIT_AS, %d)):
+        soft, hard = resource.getrlimit(limit)
+        if value and (hard == resource.RLIM_INFINITY or value < hard):
+            resource.setrlimit(limit, (value, hard))
+except Exception:
+    pass
+os.execvp(sys.argv[1], sys.argv[1:])
+"""
+
+def limited_command(command):
+    """returns the arguments running command (a list, starting with a
+    Python interpreter) with its processor time and address space limited
+    to EXTERNAL_CPU_LIMIT and EXTERNAL_MEMORY_LIMIT"""
+    return [command[0], '-c', LIMITS_SCRIPT % (EXTERNAL_CPU_LIMIT or 0,
+                                               EXTERNAL_MEMORY_LIMIT or 0)
+           ] + list(command)
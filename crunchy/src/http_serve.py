@@ -24,12 +24,14 @@ if sys.version_info[0] < 3:
     from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
     from SocketServer import ThreadingMixIn, TCPServer
     from urlparse import urlparse
+    from StringIO import StringIO as BytesIO
 else:
     from urllib.parse import parse_qs
     import urllib.request, urllib.parse, urllib.error
     from http.server import BaseHTTPRequestHandler, HTTPServer
     from socketserver import ThreadingMixIn, TCPServer
     from urllib.parse import urlparse, unquote_plus
+    from io import BytesIO
 
 from traceback import format_exc
 
@@ -44,6 +46,8 @@ else:
     from urllib.request import parse_http_list, parse_keqv_list
 
 import src.CrunchyPlugin as CrunchyPlugin
+from src.compression import (COMPRESS_MIN_SIZE, COMPRESS_MAX_SIZE,
+    accepted_encoding, compressible, compressor, compress)
 import src.interface
 if src.interface.python_version < 2.5:
     def all(S):
@@ -53,6 +57,9 @@ if src.interface.python_version < 2.5:
         return True
 
 DEBUG = False
+# idle time (in seconds) during which a connection is kept open, waiting
+# for the browser to reuse it; 0 closes every connection after a single request.
+KEEP_ALIVE_TIMEOUT = 10
 
 realm = "Crunchy Access"
 
@@ -69,6 +76,53 @@ else:
     def md5hex(x):
         return hashlib.md5(x).hexdigest()
 
+def response_coding(request, length=None):
+    '''returns the coding with which the response being sent to request
+    is to be compressed, or None.  The request records the status and the
+    Content-Type and Content-Encoding headers of its response.
+    Responses carrying an ETag are left alone: their handler decides
+    which variant to send, as each one needs its own ETag.'''
+    if (request.response_code != 200 or request.response_etag or
+        request.response_encoding is not None or
+        not compressible(request.response_content_type)):
+        return None
+    if length is not None and not COMPRESS_MIN_SIZE <= length <= COMPRESS_MAX_SIZE:
+        return None
+    return accepted_encoding(request.headers.get('Accept-Encoding'))
+
+class CompressingBuffer(object):
+    '''Used as wfile for a response which may be compressed: the content
+    is kept as written until it reaches COMPRESS_MIN_SIZE, then compressed
+    as it is written so that long responses (large pages, comet frames)
+    are never held in memory uncompressed.'''
+    def __init__(self, coding):
+        self.coding = coding
+        self.buffer = BytesIO()
+        self.compressor = None
+        self.compressed = False
+
+    def write(self, data):
+        if self.compressor is not None:
+            self.buffer.write(self.compressor.compress(data))
+            return
+        self.buffer.write(data)
+        if self.buffer.tell() >= COMPRESS_MIN_SIZE:
+            self.compressor = compressor(self.coding)
+            self.compressed = True
+            data = self.buffer.getvalue()
+            self.buffer = BytesIO()
+            self.buffer.write(self.compressor.compress(data))
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        '''returns the content, once the response is complete'''
+        if self.compressor is not None:
+            self.buffer.write(self.compressor.flush())
+            self.compressor = None
+        return self.buffer.getvalue()
+
 def require_digest_access_authenticate(func):
     '''A decorator to add digest authorization checks to HTTP Request Handlers'''
     accounts = src.interface.accounts
@@ -148,12 +202,13 @@ else:
     # proper error message via the browser
     require_authenticate = lambda x: x
 
-class MyHTTPServer(ThreadingMixIn, HTTPServer):
-    daemon_threads = True
-    def __init__(self, addr, rqh):
+class HandlerRegistry(object):
+    """Keeps track of the http handlers registered by the plugins; shared
+    by the threaded server below and by the event driven one defined
+    in async_serve.py"""
+    def __init__(self):
         self.default_handler = None
         self.handler_table = {}
-        HTTPServer.__init__(self, addr, rqh)
 
     def register_default_handler(self, handler):
         """register a default handler"""
@@ -187,6 +242,12 @@ class MyHTTPServer(ThreadingMixIn, HTTPServer):
                 print("path %s NOT in self.handler_table."%path)
             return self.default_handler
 
+class MyHTTPServer(HandlerRegistry, ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    def __init__(self, addr, rqh):
+        HandlerRegistry.__init__(self)
+        HTTPServer.__init__(self, addr, rqh)
+
 def parse_headers(fp, _class=Message):
     """Parses only RFC2822 headers from a file pointer.
 
@@ -249,6 +310,48 @@ def parse_url(path):
 def message_wrapper(self, fp, irrelevant):
     return parse_headers(fp)
 
+not_allowed_page = """<html><body><h1>You are not allowed to view this page.</h1>
+<p>There might be a few reasons for this (all assumed that Crunchy is running in single user mode)
+<br/> 1) You are prevented from accessing a Crunchy session started by another user on this computer!
+<br/> 2) you are not using Firefox! ;-)
+<br /> 3) your browser does not accept cookies (at least, not on 127.0.0.1)
+- in single user mode, for security reason (see 1 above), Crunchy requires the use of cookies.
+<br /> If you are the one who started the Crunchy session and get this message, try setting a user account with
+the account manager, and restart Crunchy - this should make use of authentication (username/password) rather
+than cookies.</p>
+<h4>If you still have problems not solved by any of the above, please file a bug report.</h4></body></html>"""
+
+def identify_single_user(request):
+    """In single user mode, sets the username of the request, provided
+    that it comes from the browser that started the session (as identified
+    by its cookie); otherwise, sends back an explanation and returns False.
+    """
+    global first_request
+    if first_request and bypass_authentication:
+        request.crunchy_username = src.interface.unknown_user_name
+        first_request = False
+    elif bypass_authentication:
+        if ("Cookie" in request.headers and
+                src.interface.plugin['session_random_id']
+                in request.headers["Cookie"]):
+            request.crunchy_username = src.interface.unknown_user_name
+        else:
+            request.send_response(200)
+            request.end_headers()
+            request.wfile.write(not_allowed_page.encode('utf8'))
+            return False
+    return True
+
+def run_handler(request):
+    """calls the handler registered for the (parsed) request path,
+    reporting any exception raised back to the browser"""
+    try:
+        request.server.get_handler(request.path)(request)
+    except:
+        request.send_response(500)
+        request.end_headers()
+        request.wfile.write(format_exc().encode('utf8'))
+
 class HTTPRequestHandler(BaseHTTPRequestHandler):
 
     # In Python 3, BaseHTTPRequestHandler went from using the
@@ -260,60 +363,156 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
     if sys.version_info[0] < 3:
         MessageClass = message_wrapper
 
-    @require_authenticate
-    def do_POST(self):
-        """handle an HTTP request"""
-        global first_request
-        # at first, assume that the given path is the actual path and there are no arguments
-        if DEBUG:
-            print(self.path)
+    protocol_version = "HTTP/1.1"
+    response_wfile = None  # until a response is started, see send_response
+    response_code = None
 
-        if first_request and bypass_authentication:
-            self.crunchy_username = src.interface.unknown_user_name
-            first_request = False
-        elif bypass_authentication:
-            if ("Cookie" in self.headers and
-                    src.interface.plugin['session_random_id']
-                    in self.headers["Cookie"]):
-                self.crunchy_username = src.interface.unknown_user_name
-            else:
-                self.send_response(200)
-                self.end_headers()
-                self.wfile.write("""<html><body><h1>You are not allowed to view this page.</h1>
-<p>There might be a few reasons for this (all assumed that Crunchy is running in single user mode)
-<br/> 1) You are prevented from accessing a Crunchy session started by another user on this computer!
-<br/> 2) you are not using Firefox! ;-)
-<br /> 3) your browser does not accept cookies (at least, not on 127.0.0.1)
-- in single user mode, for security reason (see 1 above), Crunchy requires the use of cookies.
-<br /> If you are the one who started the Crunchy session and get this message, try setting a user account with
-the account manager, and restart Crunchy - this should make use of authentication (username/password) rather
-than cookies.</p>
-<h4>If you still have problems not solved by any of the above, please file a bug report.</h4></body></html>""")
-                return
+    def setup(self):
+        # the timeout applies to the socket, while waiting for
+        # the browser to send a new request on the same connection.
+        self.timeout = KEEP_ALIVE_TIMEOUT or None
+        BaseHTTPRequestHandler.setup(self)
 
-        self.path, self.args = parse_url(self.path)
+    def do_POST(self):
+        """handle an HTTP request"""
+        # The POST data must be read, even if the request is turned down,
+        # so that the next request sent on the same connection can be found.
         # Clumsy syntax due to Python 2 and 2to3's lack of a byte
         # literal.
         self.data = "".encode('ascii')
-
-        # Extract POST data, if any.
         length = self.headers.get('Content-Length')
         if length:
             self.data = self.rfile.read(int(length))
+        if not self.timeout:
+            self.close_connection = True
 
-        # Run the handler.
-        if DEBUG:
-            print("Preparing to call get_handler in do_POST")
-        try:
-            self.server.get_handler(self.path)(self)
-        except:
-            self.send_response(500)
-            self.end_headers()
-            self.wfile.write(format_exc().encode('utf8'))
+        # some handlers only write some content, or nothing at all: it is
+        # held back until they are done (see finish_response)
+        self.response_wfile = self.wfile
+        self.wfile = BytesIO()
+        self.response_code = None
+        self.process()
+        self.finish_response()
 
     # We draw no distinction.
     do_GET = do_POST
 
-    def send_response(self, code):
-        BaseHTTPRequestHandler.send_response(self, code)
-        self.send_header("Connection", "close")
+    @require_authenticate
+    def process(self):
+        """dispatch the request to the registered handler"""
+        # at first, assume that the given path is the actual path and there are no arguments
+        if DEBUG:
+            print(self.path)
+
+        if not identify_single_user(self):
+            return
+
+        self.path, self.args = parse_url(self.path)
+
+        # Run the handler.
+        if DEBUG:
+            print("Preparing to call get_handler in do_POST")
+        run_handler(self)
+
+    # To reuse a connection, the browser needs to know where a response
+    # ends.  Handlers that send a Content-Length header have their response
+    # written directly to the socket; for the others, the headers and
+    # the content are held back until the handler is done so that
+    # the length can be added by finish_response().
+    # Responses which can be compressed (see response_coding) are held back
+    # as well, their Content-Length being replaced by the compressed one.
+
+    def send_response(self, code, message=None):
+        if self.response_wfile is None:
+            self.response_wfile = self.wfile
+        self.wfile = BytesIO()
+        self.content_length_sent = False
+        self.headers_ended = False
+        self.response_code = code
+        self.response_content_type = None
+        self.response_encoding = None
+        self.response_etag = None
+        # Python 3 keeps the headers in a buffer of its own; the ones from
+        # a response interrupted by an exception must be discarded.
+        if hasattr(self, '_headers_buffer'):
+            self._headers_buffer = []
+        BaseHTTPRequestHandler.send_response(self, code, message)
+
+    def send_error(self, *args):
+        # sent when the request can not be read; with Python 2, without a
+        # Content-Length
+        BaseHTTPRequestHandler.send_error(self, *args)
+        self.finish_response()
+
+    def send_header(self, keyword, value):
+        if sys.version_info[0] < 3:
+            # with Python 2, the headers are written in the same buffer as
+            # the content: unicode values (parsed from the request...) would
+            # turn it into unicode, failing on compressed content.
+            if isinstance(keyword, unicode):
+                keyword = keyword.encode('latin-1')
+            if isinstance(value, unicode):
+                value = value.encode('latin-1')
+        keyword_lower = keyword.lower()
+        if keyword_lower == 'content-length':
+            if response_coding(self, int(value)) is not None:
+                return  # held back, see above
+            self.content_length_sent = True
+        elif keyword_lower == 'content-type':
+            self.response_content_type = value
+        elif keyword_lower == 'content-encoding':
+            self.response_encoding = value
+        elif keyword_lower == 'etag':
+            self.response_etag = value
+        BaseHTTPRequestHandler.send_header(self, keyword, value)
+
+    def end_headers(self):
+        if self.content_length_sent:
+            self.send_connection_headers()
+            BaseHTTPRequestHandler.end_headers(self)
+            self.response_wfile.write(self.wfile.getvalue())
+            self.wfile = self.response_wfile
+        else:
+            self.headers_wfile = self.wfile
+            coding = response_coding(self)
+            if coding is not None:
+                self.wfile = CompressingBuffer(coding)
+            else:
+                self.wfile = BytesIO()
+        self.headers_ended = True
+
+    def send_connection_headers(self):
+        if self.close_connection:
+            BaseHTTPRequestHandler.send_header(self, "Connection", "close")
+        else:
+            BaseHTTPRequestHandler.send_header(self, "Keep-Alive",
+                                               "timeout=%d" % self.timeout)
+
+    def finish_response(self):
+        """send the response held back, if any, with its Content-Length"""
+        if self.wfile is self.response_wfile:
+            return
+        if self.response_code is None:
+            # the handler sent no status line: the browser still needs a
+            # response, and to know where it ends
+            content = self.wfile.getvalue()
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(content)
+        if not self.headers_ended:
+            self.end_headers()
+        content = self.wfile.getvalue()
+        if getattr(self.wfile, 'compressed', False):
+            coding = self.wfile.coding
+            self.wfile = self.headers_wfile
+            self.send_header("Content-Encoding", coding)
+            self.send_header("Vary", "Accept-Encoding")
+        else:
+            self.wfile = self.headers_wfile
+        BaseHTTPRequestHandler.send_header(self, "Content-Length",
+                                           str(len(content)))
+        self.send_connection_headers()
+        BaseHTTPRequestHandler.end_headers(self)
+        self.wfile.write(content)
+        self.response_wfile.write(self.wfile.getvalue())
+        self.wfile = self.response_wfile
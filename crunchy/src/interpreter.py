@@ -14,8 +14,9 @@ from src.interface import (StringIO, exec_code, translate, config, plugin,
                            names, u_print, python_version)
 config['ctypes_available'] = ctypes_available
 
-from src.utilities import trim_empty_lines_from_end, log_session
+from src.utilities import trim_empty_lines_from_end, log_entry
 import src.errors as errors
+import src.governor as governor
 
 _ = translate['_']
 
@@ -25,18 +26,23 @@ _ = translate['_']
 def _async_raise(tid, excobj):
     if not ctypes_available:
         return      # exit nicely of ctypes isn't available
-    res = ctypes.pythonapi.PyThreadState_SetAsyncExc(tid, ctypes.py_object(excobj))
+    # thread ids do not always fit in the C int that ctypes assumes
+    res = ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(tid),
+                                                     ctypes.py_object(excobj))
     if res == 0:
         raise ValueError("nonexistent thread id")
     elif res > 1:
         # """if it returns a number greater than one, you're in trouble,
         # and you should call it again with exc=NULL to revert the effect"""
-        ctypes.pythonapi.PyThreadState_SetAsyncExc(tid, 0)
+        ctypes.pythonapi.PyThreadState_SetAsyncExc(ctypes.c_ulong(tid), None)
         raise SystemError("PyThreadState_SetAsyncExc failed")
 
 class KillableThread(threading.Thread):
     def raise_exc(self, excobj):
-        assert self.isAlive(), "thread must be started"
+        if hasattr(self, 'is_alive'):
+            assert self.is_alive(), "thread must be started"
+        else:  # Python < 2.6
+            assert self.isAlive(), "thread must be started"
         for tid, tobj in threading._active.items():
             if tobj is self:
                 _async_raise(tid, excobj)
@@ -99,6 +105,7 @@ class Interpreter(KillableThread):
         sys.stdin.register_thread(self.channel)
         sys.stdout.register_thread(self.channel)
         sys.stderr.register_thread(self.channel)
+        governor.start_run(self.channel, self.username)
         try:
             try:
                 self.ccode = compile(self.code, "User's code", 'exec')
@@ -129,8 +136,7 @@ class Interpreter(KillableThread):
                         else:
                             user_code = _("# no code entered by user\n")
                         data = "<span class='stdin'>" + user_code + "</span>"
-                        config[self.username]['log'][log_id].append(data)
-                        log_session(username)
+                        log_entry(self.username, log_id, data)
                 exec_code(self.ccode, self.symbols, source=None,
                           username=self.username)
                 #exec self.ccode in self.symbols#, {}
@@ -174,8 +180,7 @@ class Interpreter(KillableThread):
                     user_code = "\n" + "- "*25 + "\n" + user_code
 
                     data = "<span class='stdin'>" + user_code + "</span>"
-                    config[self.username]['log'][log_id].append(data)
-                    log_session(self.username)
+                    log_entry(self.username, log_id, data)
                 # proceed with regular output
                 if self.friendly:
                     message, success = errors.simplify_doctest_error_message(
@@ -186,6 +191,7 @@ class Interpreter(KillableThread):
                         sys.stderr.write(message)
                 else:
                     sys.stdout.write(self.doctest_out.getvalue())
+            self.resources = governor.end_run(self.channel)
             sys.stdin.unregister_thread()
             sys.stdout.unregister_thread()
             sys.stderr.unregister_thread()
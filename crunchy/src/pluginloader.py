@@ -6,12 +6,14 @@ unit tests in test_pluginloader.rst
 
 import sys
 import os
+import time
 from imp import find_module
 import os.path
 
 import src.interface as interface
 
 DEBUG = False
+startup_times = {}  # plugin name -> [import time, register time] in seconds
 def gen_register_list(initial_list):  # tested
     """generates a registration ordering from the dependencies.
     It could happen that some plugin would require (at loading time)
@@ -81,21 +83,44 @@ def init_plugin_system(server):
     if DEBUG:
         print("Importing plugins.")
     for plugin in plugins:
+        start = time.time()
         try:
             mod = __import__ (plugin, globals())
             imported_plugins.append(mod)
         except:
             print("Could not import the following plugin:", plugin)
+        startup_times[plugin] = [time.time() - start, 0]
     register_list = gen_register_list(imported_plugins)
     if DEBUG:
         print("Registering plugins.")
     for mod in register_list:
         if hasattr(mod, "register"):
             if server != ["testplugins"]:  # skip for self-testing
+                start = time.time()
                 mod.register()
+                startup_times[mod.__name__][1] = time.time() - start
             if DEBUG:
                 print("  * Registered %s" % mod.__name__)
 
+def startup_report():
+    '''returns a table of the time taken to import and register each
+    plugin by init_plugin_system(), slowest first'''
+    lines = ["%-24s %14s %14s %14s" % ("plugin", "import (ms)",
+                                       "register (ms)", "total (ms)")]
+    times = [(t[0] + t[1], name, t[0], t[1])
+             for name, t in startup_times.items()]
+    times.sort()
+    times.reverse()
+    total = [0, 0]
+    for dummy, name, import_time, register_time in times:
+        total[0] += import_time
+        total[1] += register_time
+        lines.append("%-24s %14.1f %14.1f %14.1f" % (name, 1000*import_time,
+                        1000*register_time, 1000*(import_time+register_time)))
+    lines.append("%-24s %14.1f %14.1f %14.1f" % ("total", 1000*total[0],
+                        1000*total[1], 1000*(total[0]+total[1])))
+    return '\n'.join(lines)
+
 if __name__ == "__main__":
     DEBUG = True
     init_plugin_system(["testplugins"])
\ No newline at end of file
@@ -7,13 +7,34 @@ directory so that they are easier to locate, and that names duplication
 can be avoided.
 """
 
+import src.interface as interface
 from src.interface import plugin
-from src.cometIO import comet, push_input
+from src.cometIO import comet, push_input, status, start_reaper, stop_runaway
+from src.governor import resources, start_watchdog
 
-provides = set(["/comet", "/input"])
+provides = set(["/comet", "/input", "/status", "/resources"])
 
 def register():  # tested
-    '''registers two http handlers: /input and /comet'''
+    '''registers four http handlers: /input, /comet, /status and
+    /resources (the last two for the administrators only), starts
+    reclaiming the pages closed and interrupting the programs running for
+    too long'''
     plugin['register_http_handler'](
                     "/input%s" % plugin['session_random_id'], push_input)
     plugin['register_http_handler']("/comet", comet)
+    plugin['register_http_handler']("/status", admin_only(status))
+    plugin['register_http_handler']("/resources", admin_only(resources))
+    start_reaper()
+    start_watchdog(stop_runaway)
+
+def admin_only(handler):  # tested
+    '''restricts an http handler to the users with administrative rights'''
+    def admin_handler(request):
+        accounts = interface.accounts
+        if not (hasattr(accounts, 'is_admin') and
+                accounts.is_admin(getattr(request, 'crunchy_username', None))):
+            request.send_response(403)
+            request.end_headers()
+            return
+        handler(request)
+    return admin_handler
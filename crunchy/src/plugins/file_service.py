@@ -9,6 +9,7 @@ import sys
 
 # All plugins should import the crunchy plugin API via interface.py
 from src.interface import config, plugin, SubElement, python_version, u_print
+import src.governor as governor
 try:
     from config import local_browser_root
 except:  # the user may, by mistake, have commented out all values inside config
@@ -325,6 +326,8 @@ def exec_external_python_version(code=None,  path=None, alternate_version=True,
         * Windows NT
         * GNOME/KDE/XFCE/xterm (Tested)
         * OS X
+    when started in one of linux_terminals, the processor time and memory
+    used by the program are limited (see governor.limited_command).
     """
     if DEBUG:
         print("Entering exec_external_python_interpreter.")
@@ -349,6 +352,7 @@ def exec_external_python_version(code=None,  path=None, alternate_version=True,
             filename.close()
         except:
             print("Could not save file in file_service.exec_external_python_version()")
+    governor.external_run(username)
 
     if os.name == 'nt':
         os.chdir(target_dir) # change dir so as to deal with paths that
@@ -375,8 +379,8 @@ def exec_external_python_version(code=None,  path=None, alternate_version=True,
                 if DEBUG:
                     print('Try to launch:')
                     u_print(terminal, start_parameter, python_interpreter, path)
-                Popen([terminal, start_parameter,
-                                       python_interpreter, path])
+                Popen([terminal, start_parameter] + governor.limited_command(
+                                           [python_interpreter, path]))
                 # If it works, remove all terminals in the to_try list
                 terminals_to_try = []
             except:
@@ -1,9 +1,13 @@
 """This plugin handles loading all pages not loaded by other plugins"""
 
 import codecs
+import mimetypes
+import os
 import sys
+import threading
 import traceback
-from os.path import normpath, join, isdir, exists
+from email.utils import formatdate, parsedate_tz, mktime_tz
+from os.path import normpath, join, isdir, isfile, exists
 from os import listdir
 
 # All plugins should import the crunchy plugin API via interface.py
@@ -12,10 +16,18 @@ from src.interface import (
     debug_msg, preprocessor, python_version,
     crunchy_bytes, crunchy_unicode, unknown_user_name)
 from src.utilities import meta_content_open, account_exists
+from src.compression import (COMPRESS_MIN_SIZE, accepted_encoding,
+                             compressible, compress)
 import src.interface
 
 _ = translate['_']
 
+STATIC_MAX_AGE = 3600  # seconds during which browsers can reuse static files
+STATIC_CACHE_SIZE = 64  # number of static files kept in memory
+STATIC_CACHE_MAX_FILE = 256*1024  # larger files are not kept in memory
+CHUNK_SIZE = 64*1024  # used to send files not kept in memory
+STATIC_COMPRESS_MAX_FILE = 1024*1024  # larger files are sent uncompressed
+
 def register(): # tested
     '''registers a default http handler'''
     plugin['register_http_handler'](None, handler)
@@ -93,13 +105,13 @@ def path_to_filedata(path, root, username=None):
         creator = plugin['create_vlam_page']
         if extension in ["htm", "html"]:
             f = meta_content_open(npath)
-            text = creator(f, path, username)
+            text = creator(f, path, username, filename=npath)
             f.close()
             text = text.read().encode('utf8')
             return text
         elif extension in preprocessor:
             f = preprocessor[extension](npath)
-            text = creator(f, path, username)
+            text = creator(f, path, username, filename=npath)
             f.close()
             text = text.read().encode('utf8')
             return text
@@ -122,6 +134,184 @@ def path_to_filedata(path, root, username=None):
         traceback.print_exc()
         return error_page(path).encode('utf8')
 
+class StaticCache(object):
+    '''Keeps the content of the most recently requested small static
+       files, along with the (modification time, size) they had when read;
+       an entry is only used while the file is unchanged.'''
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.files = {}  # path -> (mtime, size, content)
+        self.order = []  # least recently used first
+
+    def get(self, path, mtime, size):
+        '''returns the content of path, or None if not found or out of date'''
+        self.lock.acquire()
+        try:
+            entry = self.files.get(path)
+            if entry is None or entry[:2] != (mtime, size):
+                return None
+            self.order.remove(path)
+            self.order.append(path)
+            return entry[2]
+        finally:
+            self.lock.release()
+
+    def put(self, path, mtime, size, content):
+        self.lock.acquire()
+        try:
+            if path in self.files:
+                self.order.remove(path)
+            self.files[path] = (mtime, size, content)
+            self.order.append(path)
+            while len(self.order) > self.size:
+                del self.files[self.order.pop(0)]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        self.files.clear()
+        del self.order[:]
+        self.lock.release()
+
+static_cache = StaticCache(STATIC_CACHE_SIZE)
+
+def static_file(path):
+    '''returns the name of the file under server_root requested by path, if
+    it is sent as is (style sheets, scripts, images...), or None if the
+    request is handled by path_to_filedata() instead: tutorial pages, which
+    are processed for each user, directories, special paths and files found
+    outside server_root.'''
+    if path == server.get('exit') or path == "/null" or "/../" in path:
+        return None
+    extension = path.split('.')[-1]
+    if extension in ["htm", "html"] or extension in preprocessor:
+        return None
+    if exists(path) and path != "/":
+        return None  # see path_to_filedata
+    if extension == "css" and src.interface.last_local_base_url is not None:
+        return None
+    npath = normpath(join(root_path, normpath(path[1:])))
+    if not npath.startswith(normpath(root_path) + os.sep) or not isfile(npath):
+        return None
+    return npath
+
+def not_modified(request, etag, mtime):
+    '''returns True if the browser already has the current version of
+    a file, according to the headers of its conditional request'''
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match is not None:
+        return etag in [tag.strip() for tag in if_none_match.split(',')] \
+               or if_none_match.strip() == '*'
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        try:
+            return int(mtime) <= mktime_tz(parsedate_tz(if_modified_since))
+        except (TypeError, ValueError, OverflowError):
+            return False
+    return False
+
+def compressed_variant(content_type, size):
+    '''returns True if a static file of the given type and size is worth
+    sending compressed to browsers accepting it'''
+    return (content_type is not None and compressible(content_type) and
+            COMPRESS_MIN_SIZE <= size <= STATIC_COMPRESS_MAX_FILE)
+
+def compressed_static_file(npath, mtime, size, coding):
+    '''returns the content of a static file compressed with coding; it is
+    compressed once and kept in static_cache, along with the original.'''
+    content = static_cache.get((npath, coding), mtime, size)
+    if content is None:
+        content = static_cache.get(npath, mtime, size)
+        if content is None:
+            f = open(npath, mode="rb")
+            content = f.read()
+            f.close()
+        content = compress(content, coding)
+        static_cache.put((npath, coding), mtime, size, content)
+    return content
+
+def send_static_file(request, npath):
+    '''sends a file which the browser can keep for STATIC_MAX_AGE seconds,
+    and check afterwards with a conditional request; small files are kept
+    in memory, while the others are sent without being read in memory.
+    Text files are sent compressed to browsers accepting it, each variant
+    having its own ETag.'''
+    stat = os.stat(npath)
+    mtime, size = stat.st_mtime, stat.st_size
+    content_type = mimetypes.guess_type(npath)[0]
+    coding = None
+    variants = compressed_variant(content_type, size)
+    if variants:
+        coding = accepted_encoding(request.headers.get('Accept-Encoding'))
+    etag = '"%x-%x"' % (int(mtime * 1000000), size)
+    if coding is not None:
+        etag = '"%x-%x-%s"' % (int(mtime * 1000000), size, coding)
+    if not_modified(request, etag, mtime):
+        request.send_response(304)
+        request.send_header('ETag', etag)
+        request.send_header('Content-Length', '0')
+        request.end_headers()
+        return
+    f = None
+    if coding is not None:
+        content = compressed_static_file(npath, mtime, size, coding)
+    else:
+        content = static_cache.get(npath, mtime, size)
+    if content is None:
+        f = open(npath, mode="rb")
+        if size <= STATIC_CACHE_MAX_FILE:
+            content = f.read()
+            f.close()
+            f = None
+            static_cache.put(npath, mtime, len(content), content)
+    if content is not None:
+        size = len(content)
+    request.send_response(200)
+    if content_type is not None:
+        request.send_header('Content-Type', content_type)
+    if coding is not None:
+        request.send_header('Content-Encoding', coding)
+    if variants:
+        request.send_header('Vary', 'Accept-Encoding')
+    request.send_header('Cache-Control', 'max-age=%d' % STATIC_MAX_AGE)
+    request.send_header('ETag', etag)
+    request.send_header('Last-Modified', formatdate(mtime, usegmt=True))
+    set_session_cookie(request)
+    request.send_header('Content-Length', str(size))
+    request.end_headers()
+    if f is None:
+        request.wfile.write(content)
+        return
+    try:
+        send_file(request, f, size)
+    finally:
+        f.close()
+
+def send_file(request, f, size):
+    '''writes size bytes read from f to the browser, using sendfile() when
+    the response goes directly to the socket (threaded server, Python 3.5+)'''
+    connection = getattr(request, 'connection', None)
+    if (connection is not None and hasattr(connection, 'sendfile') and
+            request.wfile is getattr(request, 'response_wfile', None)):
+        request.wfile.flush()
+        connection.sendfile(f, 0, size)
+        return
+    while size > 0:
+        data = f.read(min(size, CHUNK_SIZE))
+        if not data:
+            break
+        request.wfile.write(data)
+        size -= len(data)
+
+def set_session_cookie(request):
+    '''Set cookies only once per session.  In single user mode, this
+    will be used to prevent other users to access Crunchy.'''
+    if 'session_cookie_set' not in plugin:
+        request.send_header('Set-Cookie', plugin['session_random_id'])
+        plugin['session_cookie_set'] = True
+
 tell_Safari_page_is_html = False
 
 def handler(request):
@@ -135,6 +325,11 @@ def handler(request):
     except:
         request.crunchy_username = unknown_user_name
 
+    npath = static_file(request.path)
+    if npath is not None:
+        send_static_file(request, npath)
+        return
+
     data = path_to_filedata(request.path, root_path, request.crunchy_username)
     if debug['handle_default'] or debug['handle_default.handler']:
         debug_msg("in handle_default.handler(), beginning of data =")
@@ -148,20 +343,18 @@ def handler(request):
     if data == None:
         request.send_response(301)
         request.send_header("Location", request.path + "/")
+        request.send_header('Content-Length', '0')
         request.end_headers()
     else:
         request.send_response(200)
         # Tell Firefox not to cache; otherwise back button can bring back to
         # a page with a broken interpreter
         request.send_header('Cache-Control', 'no-cache, must-revalidate, no-store')
-        # Set cookies only once per session.  In single user mode, this
-        # will be used to prevent other users to access Crunchy.
-        if 'session_cookie_set' not in plugin:
-            request.send_header('Set-Cookie', plugin['session_random_id'])
-            plugin['session_cookie_set'] = True
+        set_session_cookie(request)
         if tell_Safari_page_is_html:
             request.send_header ("Content-Type", "text/html; charset=UTF-8")
             tell_Safari_page_is_html = False
+        request.send_header('Content-Length', str(len(data)))
         request.end_headers()
         # path_to_filedata guaranteed to return bytestrings.
         request.wfile.write(data)
@@ -50,7 +50,7 @@ def local_loader(request):  # tested
     username = request.crunchy_username
     if "htm" in extension:
         page = plugin['create_vlam_page'](open(url, 'rb'), url, username=username,
-                                          local=True)
+                                          local=True, filename=url)
         # The following will make it possible to include python modules
         # with tutorials so that they can be imported.
         if base_url not in sys.path:
@@ -36,6 +36,14 @@ def register():
                          "/hidden_code%s" % plugin['session_random_id'],
                                        hidden_code_runner_callback)
     plugin['register_service']("reconstitute_hidden_file", reconstitute_hidden_file)
+    plugin['register_page_cleanup'](forget_page)
+
+def forget_page(pageid):
+    """forgets the hidden code of a page closed"""
+    prefix = pageid + "_"
+    for uid in list(config["extracted_lines"]):
+        if uid.startswith(prefix):
+            del config["extracted_lines"][uid]
 
 
 def hidden_code_runner_callback(request):
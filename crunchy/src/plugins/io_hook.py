@@ -10,12 +10,15 @@ import re
 # The set of other "widgets/services" required from other plugins
 requires =  set()
 
-provides = set(["register_io_hook", "apply_io_hook"])
+provides = set(["register_io_hook", "apply_io_hook", "io_hooks"])
 
 def register():
     '''register a service'''
     plugin['register_service']("register_io_hook", register_io_hook)
     plugin['register_service']("apply_io_hook", apply_io_hook)
+    # the hooks registered, by uid; looked up before applying them to
+    # every output (see cometIO.py)
+    plugin['register_service']("io_hooks", _io_hooks)
 
 hook_names =(
     'before_input',
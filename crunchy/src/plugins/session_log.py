@@ -0,0 +1,31 @@
+'''session_log.py
+
+Displays the log of the current session, for the elements of the pages
+marked with a log_id.  The html report is only brought up to date when
+it is requested.
+'''
+
+from src.interface import plugin, translate
+import src.utilities as utilities
+_ = translate['_']
+
+def register():
+    '''registers the handler displaying the log'''
+    plugin['register_http_handler']("/session_log", session_log_request_handler)
+
+def session_log_request_handler(request):
+    '''sends back the html report of the session'''
+    username = request.crunchy_username
+    if username in utilities.session_logs:
+        session_log = utilities.session_logs[username]
+        session_log.flush()
+        f = open(session_log.render(), 'rb')
+        content = f.read()
+        f.close()
+    else:
+        content = (utilities.begin_html + "<p>" + _("Nothing has been logged.")
+                   + "</p>" + utilities.end_html).encode('utf8')
+    request.send_response(200)
+    request.send_header("Content-Type", "text/html; charset=UTF-8")
+    request.end_headers()
+    request.wfile.write(content)
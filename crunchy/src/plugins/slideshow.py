@@ -55,7 +55,7 @@ def insert_interactive_objects(page):
                 # a given slide.
                 # see slides.js line 100
                 pre.text = "# Crunchy Interpreter                             #"
-                uid = page.pageid + "_" + uidgen(page.username)
+                uid = page.pageid + "_" + uidgen()
                 plugin['services'].insert_interpreter(page, pre, uid)
                 div.append(new_div)
                 # add slide with editor
@@ -67,7 +67,7 @@ def insert_interactive_objects(page):
                 pre2 = SubElement(new_div2, "pre", title="editor")
                 # same as above.
                 pre2.text = "# Crunchy editor                                 #"
-                uid = page.pageid + "_" + uidgen(page.username)
+                uid = page.pageid + "_" + uidgen()
                 plugin['services'].insert_editor(page, pre2, uid)
                 div.append(new_div2)
                 return
\ No newline at end of file
@@ -1,30 +1,49 @@
 '''styles the code using Pygments'''
+import copy
 import re
 import random
+import threading
 
 from src.interface import (fromstring, plugin, Element, SubElement,
                            additional_properties, config, python_version,
                            u_print)
 
 if python_version < 3:
-    from pygments import highlight
     from pygments.lexers import get_lexer_by_name, guess_lexer
-    from pygments.formatters import HtmlFormatter
-    from pygments.styles import get_style_by_name, get_all_styles
+    from pygments.formatters import HtmlFormatter, ElementFormatter
+    from pygments.styles import get_all_styles, STYLE_MAP
     from pygments.lexers._mapping import LEXERS
     from pygments.token import STANDARD_TYPES, Generic, Comment
 else:
-    from pygments3 import highlight
     from pygments3.lexers import get_lexer_by_name, guess_lexer
-    from pygments3.formatters import HtmlFormatter
-    from pygments3.styles import get_style_by_name, get_all_styles
+    from pygments3.formatters import HtmlFormatter, ElementFormatter
+    from pygments3.styles import get_all_styles, STYLE_MAP
     from pygments3.lexers._mapping import LEXERS
     from pygments3.token import STANDARD_TYPES, Generic, Comment
 
+if python_version < 3:
+    _chr = unichr
+else:
+    _chr = chr
+
+if python_version < 2.5:
+    import md5
+    new_md5 = md5.new
+else:
+    import hashlib
+    new_md5 = hashlib.md5
+
 import src.interface as interface
 from src.configuration import make_property, options
 from src.utilities import extract_code, wrap_in_div
 
+HIGHLIGHT_CACHE_SIZE = 1000  # number of styled code samples kept in memory
+STYLESHEET_PATH = "/css/pygments_%s.css"  # served by stylesheet_request_handler
+# If True, the pygments languages are not registered as vlam keywords one
+# by one: they are recognized when first found on a page, and the styles
+# provided by setuptools plugins are not included.
+LAZY_REGISTRATION = True
+
 _pygment_lexer_names = {}
 _pygment_language_names = []
 for name in LEXERS:
@@ -32,12 +51,16 @@ for name in LEXERS:
     _pygment_lexer_names[name] = aliases[0]
     for alias in aliases:
         _pygment_language_names.append(alias)
+_pygment_keywords = set(_pygment_language_names)
 
 interface.crunchy_pygments = CRUNCHY_PYGMENTS = \
     "crunchy_pygments_%d" % int(random.random()*1000000000000)
 
 lexers = {}
-options['style'] = list(get_all_styles())
+if LAZY_REGISTRATION:
+    options['style'] = list(STYLE_MAP)  # without looking for plugins
+else:
+    options['style'] = list(get_all_styles())
 additional_properties['style'] = make_property('style', default='tango',
 doc="""\
 Style used by pygments to colorize the code.  In addition to the default
@@ -45,12 +68,16 @@ value ['tango'], it includes all the styles [css classes] included
 in the pygments distribution.""")
 
 def register():
-    for language in _pygment_language_names:
-        plugin["register_tag_handler"]("code", "title", language, pygments_style)
-        plugin["register_tag_handler"]("pre", "title", language, pygments_style)
-    for language in _pygment_lexer_names:
-        plugin["register_tag_handler"]("code", "title", language, pygments_style)
-        plugin["register_tag_handler"]("pre", "title", language, pygments_style)
+    if LAZY_REGISTRATION:
+        plugin["register_fallback_handler"]("code", "title", find_style_handler)
+        plugin["register_fallback_handler"]("pre", "title", find_style_handler)
+    else:
+        for language in _pygment_language_names:
+            plugin["register_tag_handler"]("code", "title", language, pygments_style)
+            plugin["register_tag_handler"]("pre", "title", language, pygments_style)
+        for language in _pygment_lexer_names:
+            plugin["register_tag_handler"]("code", "title", language, pygments_style)
+            plugin["register_tag_handler"]("pre", "title", language, pygments_style)
 
     # for compatibility with the old notation
     styling_choices = ['py_code', 'python_code']
@@ -62,10 +89,93 @@ def register():
 
     plugin["register_tag_handler"]("div", "title", "get_pygments_tokens",
                                    get_pygments_tokens)
+    for cssclass in options['style']:
+        plugin['register_http_handler'](STYLESHEET_PATH % cssclass,
+                                        stylesheet_request_handler)
     plugin['register_service']("style", pygments_style)
     plugin['register_service']("show_vlam", create_show_vlam)
     randomize_css_classes()
 
+def find_style_handler(keyword):
+    '''returns the handler used for a vlam keyword which is the name of a
+    language known to pygments, or None'''
+    if keyword in _pygment_lexer_names or keyword in _pygment_keywords:
+        return pygments_style
+    return None
+
+class HighlightCache(object):
+    '''Keeps the elements built from the most recently styled code samples,
+       keyed on a hash of the code and of the options used, so that the
+       code found on a page that is loaded again is not styled again.
+
+       hits and misses count the lookups that were successful or not.'''
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.elements = {}  # key -> element
+        self.order = []  # keys, from least to most recently used
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, *args):
+        '''returns the key identifying the styled code for the arguments'''
+        return new_md5(repr(args).encode('utf8')).hexdigest()
+
+    def get(self, key):
+        '''returns a copy of the cached element, or None'''
+        self.lock.acquire()
+        try:
+            if key not in self.elements:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.order.remove(key)
+            self.order.append(key)
+            element = self.elements[key]
+        finally:
+            self.lock.release()
+        return copy.deepcopy(element)
+
+    def put(self, key, element):
+        '''adds a copy of element, evicting the least recently used ones
+        if needed'''
+        element = copy.deepcopy(element)
+        self.lock.acquire()
+        try:
+            if key in self.elements:
+                self.order.remove(key)
+            self.elements[key] = element
+            self.order.append(key)
+            while len(self.order) > self.size:
+                del self.elements[self.order.pop(0)]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        self.elements.clear()
+        del self.order[:]
+        self.hits = self.misses = 0
+        self.lock.release()
+
+highlight_cache = HighlightCache(HIGHLIGHT_CACHE_SIZE)
+
+def style_markup(raw_code, language, cssclass, vlam=''):
+    '''Returns the <pre> element containing the styled code, with
+    line numbers if requested in vlam, from highlight_cache if possible.
+
+    The element is built directly from the tokens, without going through
+    an html string (see dev/bench_style.py).'''
+    linenumber = None
+    if 'linenumber' in vlam:
+        linenumber = get_linenumber_offset(vlam)
+    key = highlight_cache.key(raw_code, language, cssclass, linenumber)
+    markup = highlight_cache.get(key)
+    if markup is None:
+        markup = _style_element(raw_code, language, linenumber)
+        highlight_cache.put(key, markup)
+    return markup
+
 def pygments_style(page, elem, dummy_uid='42', vlam=None):
     cssclass = config[page.username]['style']
     wrap = False
@@ -80,13 +190,9 @@ def pygments_style(page, elem, dummy_uid='42', vlam=None):
     if language in ['py_code', 'python_code']:
         language = "python"
     text = extract_code(elem)
-    styled_code = _style(text, language, cssclass)
     if vlam is None:
         vlam = elem.attrib['title']
-    if 'linenumber' in vlam:
-        styled_code = add_linenumber(styled_code, vlam)
-
-    markup = fromstring(styled_code)
+    markup = style_markup(text, language, cssclass, vlam)
     elem[:] = markup[:]
     elem.text = markup.text
     if 'class' in elem.attrib:
@@ -94,13 +200,53 @@ def pygments_style(page, elem, dummy_uid='42', vlam=None):
     else:
         elem.attrib['class'] = CRUNCHY_PYGMENTS
     if not page.includes("pygment_cssclass"):
-        # replacing class name for security reasons.
-        page.add_css_code(HtmlFormatter(style=cssclass).get_style_defs("."+cssclass).replace(cssclass, CRUNCHY_PYGMENTS))
+        # overridden by the other styles, as when it was inserted in <head>
+        page.insert_css_file(stylesheet_url(cssclass), first=True)
         page.add_include("pygment_cssclass")
     if wrap:
         wrap_in_div(elem, dummy_uid, '', "show_vlam", show_vlam)
     return text, show_vlam
 
+stylesheets = {}  # (style, CRUNCHY_PYGMENTS) -> (css, etag)
+
+def pygments_stylesheet(cssclass):
+    '''returns the css definitions of a pygments style and their ETag;
+    they are generated once for all pages, using the random names given to
+    the css classes.'''
+    key = (cssclass, CRUNCHY_PYGMENTS)
+    try:
+        return stylesheets[key]
+    except KeyError:
+        # replacing class name for security reasons.
+        css = HtmlFormatter(style=cssclass).get_style_defs("."+cssclass)
+        css = css.replace(cssclass, CRUNCHY_PYGMENTS)
+        etag = '"%s"' % new_md5(css.encode('utf-8')).hexdigest()
+        stylesheets[key] = css, etag
+        return css, etag
+
+def stylesheet_url(cssclass):
+    '''returns the url of the css definitions of a pygments style; it
+    changes with their content, so that they can be cached by the browser'''
+    etag = pygments_stylesheet(cssclass)[1]
+    return STYLESHEET_PATH % cssclass + "?" + etag.strip('"')[:12]
+
+def stylesheet_request_handler(request):
+    '''sends the css definitions of a pygments style, or 304 (Not Modified)
+    if the browser already has them'''
+    cssclass = request.path[len(STYLESHEET_PATH.split('%s')[0]):-len(".css")]
+    css, etag = pygments_stylesheet(cssclass)
+    if request.headers.get('If-None-Match') == etag:
+        request.send_response(304)
+        request.send_header("ETag", etag)
+        request.end_headers()
+        return
+    request.send_response(200)
+    request.send_header("Content-Type", "text/css; charset=UTF-8")
+    request.send_header("ETag", etag)
+    request.send_header("Cache-Control", "max-age=31536000")
+    request.end_headers()
+    request.wfile.write(css.encode('utf-8'))
+
 def create_show_vlam(page, elem, vlam):
     '''Creates a <code> element showing the complete vlam options
     used, as well as the element type.'''
@@ -112,8 +258,7 @@ def create_show_vlam(page, elem, vlam):
         if attr != 'title':
             attributes += ' %s="%s"' % (attr, elem.attrib[attr])
     elem_info = '<%s%s> ... </%s>' % (elem.tag, attributes, elem.tag)
-    styled_elem_info = _style(elem_info, 'html', cssclass)
-    show_vlam = fromstring(styled_elem_info)
+    show_vlam = style_markup(elem_info, 'html', cssclass)
     show_vlam.tag = 'code'
     show_vlam.attrib['class'] = CRUNCHY_PYGMENTS
     display = Element('h3')
@@ -137,6 +282,9 @@ def randomize_css_classes():
     interface.generic_prompt = STANDARD_TYPES[Generic.Prompt]
     interface.comment = STANDARD_TYPES[Comment]
     interface.init_stdios() # re-init to have proper css class
+    highlight_cache.clear()  # styled with the previous names
+    stylesheets.clear()
+    formatters.clear()
 
 def get_pygments_tokens(page, elem, uid):
     """inserts a table containing all existent token types and corresponding
@@ -175,112 +323,73 @@ def get_pygments_tokens(page, elem, uid):
         var.text = " * test * "
     return
 
-class PreHtmlFormatter(HtmlFormatter):
-    '''unlike HtmlFormatter, does not embed the styled code inside both
-       a <div> and a <pre>; rather embeds it inside a <pre> only.'''
-
-    def wrap(self, source, outfile):
-        return self._wrap_code(source)
-
-    def _wrap_code(self, source):
-        yield 0, '<pre>\n'
-        for i, t in source:
-            yield i, t
-        yield 0, '</pre>'
-
 # We need to prevent pygments from misinterpreting html numerical entities
 # as indicating the beginning of a comment in Python
-entity_pattern = re.compile("(&#\d{1,4};)")
+entity_pattern = re.compile(r"&#(\d{1,4});")
 
-old = None
-new = None
 def replace_entity_pattern(text):
     '''replaces html entities by a unique string; this transformation is later
-    reversed by recover_entity_pattern().
+    reversed by recover_entity_characters(), which needs the marker
+    returned along with the new text.
     Note that single apostrophe represented by html numerical entities are
     converted as normal single apostrophe directly.
     '''
-    global old, new
-    old = []
-    new = []
-    repl = "_a_"
     text = text.replace("&#39;", "'")
-    while repl in text:
-        repl += "_b_"
-    _splits = entity_pattern.split(text)
-    for i, s in enumerate(_splits):
-        if entity_pattern.match(s):
-            old.append(s)
-            _splits[i] = s.replace("&#", repl).replace(";", repl)
-            new.append(_splits[i])
-        else:
-            pass
-    return ''.join(_splits)
-
-def recover_entity_pattern(text):
-    '''reverses the transformation done by replace_entity_pattern'''
-    for i, ent in enumerate(new):
-        text = text.replace(ent, old[i])
-    return text
-
-
-def _style(raw_code, language, cssclass):
-    """Returns a string of formatted and styled HTML, where
-    raw_code is a string, language is a string that Pygments has a lexer for,
-    and cssclass is a class style available for Pygments."""
-    # Note: eventually, cssclass would be obtained from a user's preferences
-    # and would not need to be passed as an argument to style()
-    global _pygment_lexer_names, _sharp
-
-    raw_code = replace_entity_pattern(raw_code)
-    requested_language = language
+    marker = "_a_"
+    while marker in text:
+        marker += "_b_"
+    return entity_pattern.sub(marker + r"\1" + marker, text), marker
+
+def recover_entity_characters(elem, marker):
+    '''reverses the transformation done by replace_entity_pattern in the
+    text of an element and its children, replacing each entity by the
+    corresponding character, as parsing the html would have done.'''
+    pattern = re.compile(re.escape(marker) + r"(\d{1,4})" + re.escape(marker))
+    replace = lambda match: _chr(int(match.group(1)))
+    for item in elem.iter():
+        if item.text and marker in item.text:
+            item.text = pattern.sub(replace, item.text)
+        if item.tail and marker in item.tail:
+            item.tail = pattern.sub(replace, item.tail)
+
+formatters = {}
+
+def get_formatter(linenumber=None):
+    '''returns the formatter numbering the lines starting from linenumber,
+    unless it is None; it is shared by all threads, as format_element()
+    keeps no state of its own'''
+    key = (linenumber, interface.comment, interface.generic_prompt)
     try:
-        lexer = lexers[language]
-    except:
+        return formatters[key]
+    except KeyError:
+        formatter = ElementFormatter(etree=interface.ElementTree,
+                                     linenos=linenumber is not None,
+                                     linenostart=linenumber or 1,
+                                     linenoclass='linenumber %s' % interface.comment,
+                                     promptclass=interface.generic_prompt)
+        formatters[key] = formatter
+        return formatter
+
+def get_lexer(language):
+    '''returns the lexer used for a given language'''
+    try:
+        return lexers[language]
+    except KeyError:
         if language in _pygment_lexer_names:
-            language = _pygment_lexer_names[requested_language]
-            lexers[requested_language] = get_lexer_by_name(language)
+            lexer = get_lexer_by_name(_pygment_lexer_names[language])
         else:
-            lexers[language] = get_lexer_by_name(language)
-        lexer = lexers[requested_language]
-
-    formatter = PreHtmlFormatter()
-    formatter.cssclass = cssclass
-    formatter.style = get_style_by_name(cssclass)
-
-    # the removal of "\n" below prevents an extra space to be introduced
-    # with the background color of the selected cssclass
-    styled_code = highlight(raw_code, lexer, formatter).replace("\n</pre>", "</pre>")
-    return recover_entity_pattern(styled_code)
-
-def add_linenumber(styled_code, vlam):
-    '''adds the line number information'''
-    lines = styled_code.split('\n')
-    # is the class surrounded by quotes or double quotes?
-    prompt1 = '<span class="%s"' % interface.generic_prompt
-    prompt2 = "<span class='%s'" % interface.generic_prompt
-    if lines[1].startswith(prompt1):
-        prompt_present = True
-        prompt = prompt1
-    elif lines[1].startswith(prompt2):
-        prompt_present = True
-        prompt = prompt2
-    else:
-        prompt_present = False
-    lineno = get_linenumber_offset(vlam)
-    # first and last lines are the embedding <pre>...</pre>
-    open_span = "<span class = 'linenumber %s'>" % interface.comment
-    for index, line in enumerate(lines[1:]):
-        if prompt_present:
-            if lines[index+1].startswith(prompt):
-                lines[index+1] = open_span + "%3d </span>" % (lineno) + line
-                lineno += 1
-            else:
-                lines[index+1] = open_span + "    </span>" + line
-        else:
-            lines[index+1] = open_span + "%3d </span>" % (lineno) + line
-            lineno += 1
-    return '\n'.join(lines)
+            lexer = get_lexer_by_name(language)
+        lexers[language] = lexer
+        return lexer
+
+def _style_element(raw_code, language, linenumber=None):
+    '''Returns the <pre> element containing the styled code, numbering
+    the lines starting from linenumber unless it is None.'''
+    raw_code, marker = replace_entity_pattern(raw_code)
+    formatter = get_formatter(linenumber)
+    markup = formatter.format_element(get_lexer(language).get_tokens(raw_code))
+    recover_entity_characters(markup, marker)
+    return markup
 
 def get_linenumber_offset(vlam):
     """ Determine the desired number for the 1st line of Python code.
@@ -3,6 +3,7 @@
 import re
 
 
+import src.cometIO as cometIO
 import src.interpreter as interpreter
 # All plugins should import the crunchy plugin API via interface.py
 from src.interface import config, translate, plugin, Element, names, python_version
@@ -24,6 +25,11 @@ def register():
                                     dir_handler)
     plugin['register_http_handler']("/doc%s" % plugin['session_random_id'],
                                     doc_handler)
+    plugin['register_page_cleanup'](forget_page)
+
+def forget_page(pageid):
+    '''forgets the console used for the tooltips of a page closed'''
+    borg_console.pop(pageid, None)
 
 def insert_tooltip(page, *dummy):
     '''inserts a (hidden) tooltip object in a page'''
@@ -70,18 +76,11 @@ def dir_handler(request):
     # has clicked on a few more keys.
     line = ".".join(line.split(".")[:-1])
 
-    try:
-        result = eval("dir(%s)" % line, {}, borg_console[pageid].__dict__['locals'])
-    except:
+    result = page_query(pageid, dir_text, line)
+    if result is None:
         request.send_response(204)
         request.end_headers()
         return
-    if type(result) == type([]):
-        # strip private variables
-        result = [a for a in result if not a.startswith("_")]
-
-    # have to convert the list to a string
-    result = repr(result)
     request.send_response(200)
     request.end_headers()
     request.wfile.write(result.encode('utf-8'))
@@ -106,25 +105,52 @@ def doc_handler(request):
     # has clicked on a few more keys.
 
     line = "(".join(line.split("(")[:-1])
-    _locals = borg_console[pageid].__dict__['locals']
-    if line in _locals:
-        result = "%s()\n %s" % (line, _locals[line].__doc__)
-    elif '__builtins__' in _locals:
-        if line in _locals['__builtins__']:
-            result = "%s()\n %s" % (line, _locals['__builtins__'][line].__doc__)
-        else:
-            request.send_response(204)
-            request.end_headers()
-            return
-    else:
-        result = _("builtins not defined in console yet.")
-
+    result = page_query(pageid, doc_text, line)
+    if result is None:
+        request.send_response(204)
+        request.end_headers()
+        return
     request.send_response(200)
     request.end_headers()
     request.wfile.write(result.encode('utf-8'))
     request.wfile.flush()
     return
 
+def page_query(pageid, function, line):
+    """returns function(variables of the page, line); with worker processes
+    (see process_exec.py), the variables are those of the worker process of
+    the page, where its code is executed"""
+    if cometIO.execution_backend is not None:
+        return cometIO.execution_backend.query(pageid, function, line)
+    if pageid not in borg_console:
+        return None
+    return function(borg_console[pageid].__dict__['locals'], line)
+
+def dir_text(_locals, line):
+    """returns the list of the public attributes of line, as a string, or
+    None if it cannot be evaluated"""
+    try:
+        result = eval("dir(%s)" % line, {}, _locals)
+    except:
+        return None
+    if type(result) == type([]):
+        # strip private variables
+        result = [a for a in result if not a.startswith("_")]
+
+    # have to convert the list to a string
+    return repr(result)
+
+def doc_text(_locals, line):
+    """returns the signature and documentation of line, or None if it is
+    not known"""
+    if line in _locals:
+        return "%s()\n %s" % (line, _locals[line].__doc__)
+    elif '__builtins__' in _locals:
+        if line in _locals['__builtins__']:
+            return "%s()\n %s" % (line, _locals['__builtins__'][line].__doc__)
+        return None
+    return _("builtins not defined in console yet.")
+
 # javascript code
 tooltip_js = """
 var session_id = "%s";
@@ -43,6 +43,14 @@ def register():
                          "/doctest%s"%plugin['session_random_id'],
                                        doctest_runner_callback)
     plugin['add_vlam_option']('no_markup', 'doctest')
+    plugin['register_page_cleanup'](forget_page)
+
+def forget_page(pageid):
+    """forgets the doctests of a page closed"""
+    prefix = pageid + "_"
+    for uid in list(doctests):
+        if uid.startswith(prefix):
+            del doctests[uid]
 
 def doctest_runner_callback(request):
     """Handles all execution of doctests. The request object will contain
@@ -9,6 +9,7 @@ Crunchy plugin; it probably contains more comments than necessary
 for people familiar with the Crunchy plugin architecture.
 """
 
+import os
 import sys
 
 # All plugins should import the crunchy plugin API via interface.py
@@ -154,39 +155,29 @@ def select_type(vlam, c, elem):
             interp_kind = "borg"
     return interp_kind
 
+# javascript function initializing each kind of interpreter, defined in
+# INTERPRETER_JS_PATH
+init_functions = {
+    'borg': 'init_BorgInterpreter',
+    'interpreter': 'init_BorgInterpreter',
+    'isolated': 'init_SingleInterpreter',
+    'Human': 'init_SingleInterpreter',
+    'parrot': 'init_parrotInterpreter',
+    'Parrots': 'init_ParrotsInterpreter',
+    'TypeInfoConsole': 'init_TypeInfoConsole',
+}
+INTERPRETER_JS_PATH = "/javascript/interpreter.js"
+
 def include_interpreter(interp_kind, page, uid):
     '''includes the relevant code to initialize an interpreter'''
-    BorgInterpreter_js = borg_javascript(page)
-    SingleInterpreter_js = single_javascript(page)
-    parrot_js = parrot_javascript(page)
-    Parrots_js = parrots_javascript(page)
-    TypeInfoConsole_js = type_info_javascript(page)
+    if interp_kind not in init_functions:
+        return
     # first we need to make sure that the required javacript code is in the page:
-    if interp_kind == "borg" or interp_kind == "interpreter":
-        if not page.includes("BorgInterpreter_included"):
-            page.add_include("BorgInterpreter_included")
-            page.add_js_code(BorgInterpreter_js)
-        page.add_js_code('init_BorgInterpreter("%s");' % uid)
-    elif interp_kind == "isolated" or interp_kind == "Human":
-        if not page.includes("SingleInterpreter_included"):
-            page.add_include("SingleInterpreter_included")
-            page.add_js_code(SingleInterpreter_js)
-        page.add_js_code('init_SingleInterpreter("%s");' % uid)
-    elif interp_kind == "parrot":
-        if not page.includes("parrot_included"):
-            page.add_include("parrot_included")
-            page.add_js_code(parrot_js)
-        page.add_js_code('init_parrotInterpreter("%s");' % uid)
-    elif interp_kind == "Parrots":
-        if not page.includes("Parrots_included"):
-            page.add_include("Parrots_included")
-            page.add_js_code(Parrots_js)
-        page.add_js_code('init_ParrotsInterpreter("%s");' % uid)
-    elif interp_kind == "TypeInfoConsole":
-        if not page.includes("TypeInfoConsole_included"):
-            page.add_include("TypeInfoConsole_included")
-            page.add_js_code(TypeInfoConsole_js)
-        page.add_js_code('init_TypeInfoConsole("%s");' % uid)
+    if not page.includes("interpreter_included"):
+        page.add_include("interpreter_included")
+        page.insert_js_file(interpreter_js_url())
+        page.add_js_code(interpreter_javascript(page))
+    page.add_js_init(init_functions[interp_kind], uid)
 #  Unfortunately, IPython interferes with Crunchy; I'm commenting it out, keeping it in as a reference.
 ##        else:
 ##          if not page.includes("IPythonInterpreter_included"):
@@ -194,69 +185,24 @@ def include_interpreter(interp_kind, page, uid):
 ##              page.add_js_code(IPythonInterpreter_js)
 ##          page.add_js_code('init_IPythonInterpreter("%s");' % uid)
 
-def borg_javascript(page):
-    '''create string needed to initialize a Borg interpreter using javascript'''
-    return r"""
-    function init_BorgInterpreter(uid){
-        code = "import src.interpreter\nborg=src.interpreter.BorgConsole(group='%s',username='%s')";
-        code += "\nborg.interact()\n";
-        var j = new XMLHttpRequest();
-        j.open("POST", "/exec%s?uid="+uid, false);
-        j.send(code);
-    };
-    """ % (page.pageid, page.username, plugin['session_random_id'])
-
-def single_javascript(page):
-    '''create string needed to initialize an Isolated (single) interpreter
-       using javascript'''
-    return r"""
-    function init_SingleInterpreter(uid){
-        code = "import src.interpreter\nisolated=src.interpreter.SingleConsole(username='%s')";
-        code += "\nisolated.interact(ps1='--> ')\n";
-        var j = new XMLHttpRequest();
-        j.open("POST", "/exec%s?uid="+uid, false);
-        j.send(code);
-    };
-    """ % (page.username, plugin['session_random_id'])
-
-def parrot_javascript(page):
-    '''create string needed to initialize a parrot (single) interpreter
-       using javascript'''
-    return   r"""
-    function init_parrotInterpreter(uid){
-        code = "import src.interpreter\nisolated=src.interpreter.SingleConsole(username='%s')";
-        code += "\nisolated.interact(ps1='_u__) ', symbol='exec')\n";
-        var j = new XMLHttpRequest();
-        j.open("POST", "/exec%s?uid="+uid, false);
-        j.send(code);
-    };
-    """ % (page.username, plugin['session_random_id'])
-
-def parrots_javascript(page):
-    '''create string needed to initialize a parrots (shared) interpreter
-       using javascript'''
-    return r"""
-    function init_ParrotsInterpreter(uid){
-        code = "import src.interpreter\nborg=src.interpreter.BorgConsole(group='%s', username='%s')";
-        code += "\nborg.interact(ps1='_u__)) ', symbol='exec')\n";
-        var j = new XMLHttpRequest();
-        j.open("POST", "/exec%s?uid="+uid, false);
-        j.send(code);
-    };
-    """ % (page.pageid, page.username, plugin['session_random_id'])
-
-def type_info_javascript(page):
-    '''create string needed to initialize a TypeInfo (shared) interpreter
-       using javascript'''
+def interpreter_js_url():
+    '''returns the url of the script initializing the interpreters; it
+       changes with the file, so that it can be cached by the browser'''
+    path = os.path.join(config['crunchy_base_dir'], "server_root",
+                        *INTERPRETER_JS_PATH.split('/'))
+    try:
+        return INTERPRETER_JS_PATH + "?%x" % int(os.stat(path).st_mtime)
+    except OSError:
+        return INTERPRETER_JS_PATH
+
+def interpreter_javascript(page):
+    '''create string needed by the functions of INTERPRETER_JS_PATH to
+       initialize the interpreters of a page'''
     return r"""
-    function init_TypeInfoConsole(uid){
-        code = "import src.interpreter\nborg=src.interpreter.TypeInfoConsole(group='%s', username='%s')";
-        code += "\nborg.interact(ps1='<t>>> ')\n";
-        var j = new XMLHttpRequest();
-        j.open("POST", "/exec%s?uid="+uid, false);
-        j.send(code);
-    };
-    """ % (page.pageid, page.username, plugin['session_random_id'])
+    var crunchy_exec_url = "/exec%s";
+    var crunchy_pageid = "%s";
+    var crunchy_username = "%s";
+    """ % (plugin['session_random_id'], page.pageid, page.username)
 
 #  Unfortunately, IPython interferes with Crunchy; I'm commenting it out, keeping it in as a reference.
 
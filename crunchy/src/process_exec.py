@@ -0,0 +1,651 @@
+"""
+process_exec.py: runs the code of the users in worker processes
+
+By default, the code sent by the pages is executed by the worker threads
+of cometIO.execution_pool, inside the server process: a program looping
+forever slows down every request, as it competes with them for the GIL,
+and it can only be stopped by an exception raised asynchronously in its
+thread, which has no effect as long as it is busy in a C function.
+
+Here, each page is assigned a worker process, forked in advance, in which
+all the code of the page is executed - so that its Borg interpreters still
+share their variables.  The output of the programs is sent back to the
+output buffer of the page, and the input typed by the user is forwarded
+to them.  A program that does not stop when asked to is killed along with
+its process, whose resources are also limited (see CPU_LIMIT and
+MEMORY_LIMIT); the interpreters of the page then have to be restarted by
+reloading it.  The preferences of the user (the ``crunchy`` object) are not
+available to the code executed in a worker process.  The tooltips of the
+interpreters are also computed in the worker process of the page, where
+its variables are (see ProcessBackend.query).
+
+The worker processes are not forked by the server itself, whose threads
+could be holding locks, and which has connections open, but by a "zygote"
+process forked once, before the server handles any request.
+
+It requires Python 2.6+ on a POSIX system and is selected with
+    python crunchy.py --execution=processes
+
+unit tests in test_process_exec.rst
+"""
+
+import os
+import signal
+import sys
+import threading
+import time
+import multiprocessing
+from multiprocessing.reduction import send_handle, recv_handle
+try:
+    from multiprocessing.connection import Connection as PipeConnection
+except ImportError:  # Python 2
+    from _multiprocessing import Connection as PipeConnection
+
+import src.cometIO as cometIO
+import src.governor as governor
+import src.interpreter as interpreter
+import src.utilities as utilities
+import src.interface as interface
+
+from src.interface import config, translate
+_ = translate['_']
+
+SPARE_PROCESSES = 2   # processes forked in advance, ready for new pages
+MAX_PROCESSES = 16    # beyond that, pages share the existing processes
+KILL_DELAY = 3        # seconds given to a program to stop before its
+                      # process is killed
+CPU_LIMIT = 600       # seconds of processor time used by a worker process
+MEMORY_LIMIT = 1024 * 1024 * 1024  # bytes of address space of a process
+QUERY_TIMEOUT = 2     # seconds waited for a worker process to answer a query
+
+try:
+    _processes = multiprocessing.get_context('fork')
+except AttributeError:  # Python < 3.4: always forks on POSIX systems
+    _processes = multiprocessing
+
+class Connection(object):
+    """One end of the pipe between the server and a worker process; it can
+    be used by several threads at once for sending"""
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.Lock()
+
+    def send(self, message):
+        self.lock.acquire()
+        try:
+            self.connection.send(message)
+        finally:
+            self.lock.release()
+
+    def recv(self):
+        return self.connection.recv()
+
+    def close(self):
+        self.connection.close()
+
+#---------------------------------------------------------------------------
+# In the worker processes
+#---------------------------------------------------------------------------
+
+class RemoteOutput(object):
+    """Replaces the output buffer of a page in a worker process: the
+    output is sent to the server"""
+    def __init__(self, connection, pageid):
+        self.connection = connection
+        self.pageid = pageid
+
+    def put(self, data):
+        self.connection.send(("js", self.pageid, data))
+
+    def put_output(self, data, uid):
+        self.connection.send(("output", uid, data))
+
+class ProcessInterpreter(interpreter.Interpreter):
+    """An Interpreter telling the server when it is done"""
+    def run(self):
+        try:
+            try:
+                interpreter.Interpreter.run(self)
+            except KeyboardInterrupt:  # see WorkerProcess.kill
+                pass
+        finally:
+            if cometIO.threads.get(self.channel) is self:
+                del cometIO.threads[self.channel]
+            stats = None
+            if getattr(self, 'resources', None) is not None:
+                stats = self.resources.stats()
+            self.connection.send(("done", self.channel, stats))
+
+def release_inherited_files(keep):
+    """replaces the files inherited from the server (listening sockets,
+    connections, pipes...), except the standard streams and those in keep,
+    by /dev/null: they are no longer held open by the zygote, while the
+    objects still referring to them can not close a file opened later"""
+    for directory in ('/proc/self/fd', '/dev/fd'):
+        try:
+            fds = [int(fd) for fd in os.listdir(directory)]
+            break
+        except (OSError, ValueError):
+            pass
+    else:
+        try:
+            fds = range(3, os.sysconf('SC_OPEN_MAX'))
+        except (AttributeError, ValueError, OSError):
+            fds = range(3, 256)
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in fds:
+        if fd <= 2 or fd == null or fd in keep:
+            continue
+        try:
+            os.fstat(fd)
+        except OSError:
+            continue  # not open (e.g. the directory listed above)
+        os.dup2(null, fd)
+    os.close(null)
+
+def init_worker(connection):
+    """prepares a newly forked worker process: it starts without any page,
+    and the programs it runs report to the server"""
+    # Ctrl-C in the terminal is for the server, which stops its workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    governor.set_limits(CPU_LIMIT, MEMORY_LIMIT)
+    # multiprocessing has replaced sys.stdin by /dev/null
+    sys.stdin = cometIO.ThreadedBuffer(in_buf=sys.stdin)
+    cometIO.output_buffers.clear()
+    cometIO.input_buffers.clear()
+    cometIO.threads.clear()
+    cometIO.pages.clear()
+    # it might have been held by another thread of the server
+    cometIO.pages_lock = threading.Lock()
+    del cometIO.page_cleanup_handlers[:]
+    cometIO.execution_pool = cometIO.ExecutionPool()
+    interpreter.BorgGroups._shared_states.clear()
+    governor.runs.clear()
+    governor.lock = threading.Lock()
+    governor.measure_memory = True
+
+    def log_entry(username, log_id, data):
+        connection.send(("log", username, log_id, data))
+    interpreter.log_entry = log_entry
+
+    # the server needs to know which programs are waiting for input
+    # (see ProcessBackend.kill); not the threads they have started
+    def suspend_task():
+        uid = cometIO.current_uid()
+        if cometIO.threads.get(uid) is not threading.currentThread():
+            return None
+        connection.send(("waiting", uid))
+        return uid
+    def resume_task(uid):
+        if uid is not None:
+            connection.send(("running", uid))
+    cometIO.suspend_task = suspend_task
+    cometIO.resume_task = resume_task
+
+def execute(connection, code, uid, doctest, username, settings):
+    """starts a program in a worker process"""
+    pageid = uid.split("_")[0]
+    user = config.get(username)
+    if user is None or 'worker_process' not in user:
+        # what has been copied from the server is not kept up to date
+        user = config[username] = {'worker_process': True, 'symbols': {},
+                                   'logging_uids': {}}
+    user['friendly'] = settings['friendly']
+    governor.quotas[username] = settings['quotas']
+    if settings['logging'] is not None:
+        user['logging_uids'][uid] = settings['logging']
+    interface.names[pageid] = username
+    if pageid not in cometIO.output_buffers:
+        cometIO.output_buffers[pageid] = RemoteOutput(connection, pageid)
+
+    t = ProcessInterpreter(code, uid, symbols=user['symbols'],
+                           doctest=doctest, username=username)
+    t.connection = connection
+    t.setDaemon(True)
+    # so that the input sent before the program starts is not lost
+    cometIO.input_buffers[uid] = cometIO.StringBuffer()
+    cometIO.threads[uid] = t
+    t.start()
+
+def interrupt(uid):
+    """stops a program in a worker process, if it cooperates"""
+    thread = cometIO.threads.get(uid)
+    if thread is None:
+        return
+    try:
+        thread.terminate()
+    except Exception:
+        return  # it just ended
+    # a program waiting for input only stops once it gets some
+    if uid in cometIO.input_buffers:
+        cometIO.input_buffers[uid].put("\n")
+
+def answer(connection, query_id, pageid, function, args):
+    """sends back the result of function(variables of the page, *args);
+    run in a thread of its own, in case it does not return"""
+    state = interpreter.BorgGroups._shared_states.get(pageid, {})
+    try:
+        result = function(state.get('locals', {}), *args)
+    except Exception:
+        result = None
+    connection.send(("answer", query_id, result))
+
+def serve(connection):
+    """main loop of a worker process, carrying out the instructions of the
+    server until it goes away"""
+    connection = Connection(connection)
+    init_worker(connection)
+    while True:
+        try:
+            message = connection.recv()
+        except (EOFError, IOError, OSError):
+            return
+        except Exception:  # e.g. a function from a module it cannot import
+            cometIO.debug_msg("Problem in process_exec.serve", 6)
+            continue
+        kind = message[0]
+        try:
+            if kind == "exec":
+                execute(connection, *message[1:])
+            elif kind == "input":
+                uid, data = message[1:]
+                if uid in cometIO.input_buffers:
+                    cometIO.input_buffers[uid].put(data)
+            elif kind == "kill":
+                interrupt(message[1])
+            elif kind == "reclaim":
+                cometIO.reclaim_page(message[1])
+            elif kind == "query":
+                t = threading.Thread(target=answer,
+                                     args=(connection,) + tuple(message[1:]))
+                t.setDaemon(True)
+                t.start()
+        except Exception:
+            cometIO.debug_msg("Problem in process_exec.serve", 6)
+
+def fork_worker(connection):
+    """forks a worker process, in the zygote; the server is sent its end of
+    the pipe to the process, then its pid"""
+    server_end, worker_end = _processes.Pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 0
+        try:
+            try:
+                connection.close()
+                server_end.close()
+                # the programs of the users may wait for their own processes
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                serve(worker_end)
+            except:
+                status = 1
+        finally:
+            os._exit(status)
+    try:
+        send_handle(connection, server_end.fileno(), os.getppid())
+        connection.send(pid)
+    finally:
+        server_end.close()
+        worker_end.close()
+
+def zygote(connection, server_connection):
+    """main loop of the zygote, forking a worker process each time the
+    server asks for one, until it goes away"""
+    server_connection.close()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # the worker processes which have ended are not kept as zombies
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    release_inherited_files([connection.fileno()])
+    while True:
+        try:
+            connection.recv()
+        except (EOFError, IOError, OSError):
+            return
+        fork_worker(connection)
+
+#---------------------------------------------------------------------------
+# In the server
+#---------------------------------------------------------------------------
+
+class Zygote(object):
+    """The process forking the worker processes; it is forked by the server
+    before it starts handling requests, when it has no connection open, and
+    has a single thread: the worker processes do not inherit the locks
+    held by the threads of the server (except those created again by
+    init_worker)"""
+    def __init__(self):
+        server_end, zygote_end = _processes.Pipe()
+        self.process = _processes.Process(target=zygote,
+                                          args=(zygote_end, server_end),
+                                          name="crunchy zygote")
+        self.process.daemon = True
+        self.process.start()
+        zygote_end.close()
+        self.connection = server_end
+        self.lock = threading.Lock()
+
+    def fork(self):
+        """returns the pid of a new worker process, and the connection to
+        it; raises OSError if the zygote is gone"""
+        self.lock.acquire()
+        try:
+            try:
+                self.connection.send("fork")
+                connection = PipeConnection(recv_handle(self.connection))
+                pid = self.connection.recv()
+            except (EOFError, IOError, ValueError):
+                raise OSError("the zygote process has ended")
+        finally:
+            self.lock.release()
+        return pid, connection
+
+    def stop(self):
+        self.connection.close()
+        self.process.join(1)
+
+class RemoteInput(object):
+    """Replaces the input buffer of a program running in a worker process:
+    the input is sent to the program"""
+    def __init__(self, worker, uid):
+        self.worker = worker
+        self.uid = uid
+
+    def put(self, data):
+        self.worker.send(("input", self.uid, data))
+
+class WorkerProcess(object):
+    """A worker process, and the thread of the server reading what it
+    sends back"""
+    def __init__(self, backend):
+        self.backend = backend
+        self.pages = set()
+        self.uids = set()     # programs running
+        self.waiting = set()  # programs waiting for input
+        self.alive = True
+        self.answered = threading.Condition()
+        self.nb_queries = 0
+        self.pending = set()  # queries waiting for an answer
+        self.answers = {}
+        self.pid, connection = backend.zygote.fork()
+        self.connection = Connection(connection)
+        self.reader = threading.Thread(target=self.read,
+                                       name="worker process %d" % self.pid)
+        self.reader.setDaemon(True)
+        self.reader.start()
+
+    def send(self, message):
+        try:
+            self.connection.send(message)
+        except (IOError, OSError, ValueError):
+            self.kill()  # it will be reported by read()
+
+    def read(self):
+        """dispatches what is sent by the process, until it ends"""
+        while True:
+            try:
+                message = self.connection.recv()
+            except (EOFError, IOError, OSError):
+                break
+            try:
+                self.dispatch(message)
+            except Exception:
+                cometIO.debug_msg("Problem in WorkerProcess.read", 6)
+        self.connection.close()
+        self.ended()
+
+    def dispatch(self, message):
+        kind = message[0]
+        if kind == "output":
+            uid, data = message[1:]
+            cometIO.write_output(uid.split("_")[0], uid, data)
+        elif kind == "js":
+            pageid, data = message[1:]
+            if pageid in cometIO.output_buffers:
+                cometIO.write_js(pageid, data)
+        elif kind == "waiting":
+            self.waiting.add(message[1])
+            governor.waiting(message[1])
+        elif kind == "running":
+            self.waiting.discard(message[1])
+            governor.resumed(message[1])
+        elif kind == "done":
+            self.forget(*message[1:])
+        elif kind == "log":
+            utilities.log_entry(*message[1:])
+        elif kind == "answer":
+            query_id, result = message[1:]
+            self.answered.acquire()
+            try:
+                if query_id in self.pending:
+                    self.answers[query_id] = result
+                    self.answered.notifyAll()
+            finally:
+                self.answered.release()
+
+    def forget(self, uid, stats=None):
+        """the program uid is over, having used the resources given by
+        stats (see governor.Run.stats) if known"""
+        governor.end_run(uid, stats)
+        self.uids.discard(uid)
+        self.waiting.discard(uid)
+        remote = cometIO.input_buffers.get(uid)
+        if isinstance(remote, RemoteInput) and remote.worker is self:
+            del cometIO.input_buffers[uid]
+
+    def ended(self):
+        """the process is gone: its programs are reported as stopped"""
+        self.alive = False
+        self.answered.acquire()
+        self.answered.notifyAll()
+        self.answered.release()
+        self.backend.remove(self)
+        message = _("The program has been stopped; the interpreters of this page need to be restarted by reloading it.")
+        for uid in list(self.uids):
+            self.forget(uid)
+            pageid = uid.split("_")[0]
+            if pageid not in cometIO.output_buffers:
+                continue
+            cometIO.write_output(pageid, uid, "<span class='%s'>\\n%s\\n</span>"
+                                 % (interface.generic_traceback, message))
+            cometIO.write_js(pageid, cometIO.hide_io_js % (uid, uid, uid))
+
+    def execute(self, code, uid, doctest, username):
+        """runs some code in the process"""
+        user = config[username]
+        settings = {'friendly': user['friendly'],
+                    'logging': user['logging_uids'].get(uid),
+                    'quotas': {'output': governor.quota(username, 'output')}}
+        if not self.alive:  # its page will get another one next time
+            return
+        self.uids.add(uid)
+        governor.start_run(uid, username, local=False)
+        cometIO.input_buffers[uid] = RemoteInput(self, uid)
+        self.send(("exec", code, uid, doctest, username, settings))
+
+    def query(self, pageid, function, *args):
+        """returns function(variables of the page, *args), computed in the
+        process; None if it fails or takes more than QUERY_TIMEOUT seconds"""
+        self.answered.acquire()
+        try:
+            self.nb_queries += 1
+            query_id = self.nb_queries
+            self.pending.add(query_id)
+        finally:
+            self.answered.release()
+        self.send(("query", query_id, pageid, function, args))
+        deadline = time.time() + QUERY_TIMEOUT
+        self.answered.acquire()
+        try:
+            while query_id not in self.answers and self.alive:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.answered.wait(remaining)
+            self.pending.discard(query_id)
+            return self.answers.pop(query_id, None)
+        finally:
+            self.answered.release()
+
+    def kill(self):
+        """ends the process, whatever it is doing"""
+        if not self.alive:
+            return
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass  # already gone
+
+    def kill_if_busy(self, uid):
+        """kills the process if the program uid is still running, instead
+        of waiting for input"""
+        if uid in self.uids and uid not in self.waiting:
+            self.kill()
+
+class ProcessBackend(object):
+    """Assigns a worker process to each page, keeping SPARE_PROCESSES
+    of them ready for the new pages"""
+    def __init__(self, spares=SPARE_PROCESSES, max_processes=MAX_PROCESSES):
+        self.nb_spares = spares
+        self.max_processes = max_processes
+        self.spares = []
+        self.workers = []
+        self.assigned = {}
+        self.lock = threading.Condition()
+        self.forker = None
+        self.zygote = None
+        self.failures = 0  # spare processes ended before being used
+
+    def start(self):
+        """starts the zygote, forks the spare processes, and starts the
+        thread replacing those put to use"""
+        self.zygote = Zygote()
+        for i in range(self.nb_spares):
+            self.spares.append(WorkerProcess(self))
+        self.forker = threading.Thread(target=self.fork_spares,
+                                       name="process forker")
+        self.forker.setDaemon(True)
+        self.forker.start()
+        cometIO.page_cleanup_handlers.append(self.forget_page)
+
+    def fork_spares(self):
+        while True:
+            self.lock.acquire()
+            try:
+                while len(self.spares) >= self.nb_spares:
+                    self.lock.wait()
+                failures = self.failures
+            finally:
+                self.lock.release()
+            if failures:  # do not keep forking processes which fail
+                time.sleep(min(failures, 60) * KILL_DELAY)
+            try:
+                worker = WorkerProcess(self)
+            except (IOError, OSError):  # e.g. too many processes
+                cometIO.debug_msg("Problem in ProcessBackend.fork_spares", 6)
+                time.sleep(KILL_DELAY)
+                continue
+            self.lock.acquire()
+            self.spares.append(worker)
+            self.lock.release()
+
+    def worker_for(self, pageid):
+        """returns the worker process of a page"""
+        self.lock.acquire()
+        try:
+            worker = self.assigned.get(pageid)
+            if worker is None:
+                if len(self.workers) >= self.max_processes:
+                    worker = min(self.workers, key=lambda w: len(w.pages))
+                else:
+                    if self.spares:
+                        worker = self.spares.pop(0)
+                        self.failures = 0
+                        self.lock.notifyAll()
+                    else:
+                        worker = WorkerProcess(self)
+                    self.workers.append(worker)
+                worker.pages.add(pageid)
+                self.assigned[pageid] = worker
+            return worker
+        finally:
+            self.lock.release()
+
+    def worker_running(self, uid):
+        """returns the worker process running the program uid, if any"""
+        worker = self.assigned.get(uid.split("_")[0])
+        if worker is not None and uid in worker.uids:
+            return worker
+        return None
+
+    def submit(self, code, uid, doctest, username):
+        """runs some code in the worker process of its page"""
+        self.worker_for(uid.split("_")[0]).execute(code, uid, doctest, username)
+
+    def query(self, pageid, function, *args):
+        """returns function(variables of the page, *args), computed in the
+        worker process of the page; function must be defined at the top
+        level of a module, as it is sent to the process"""
+        return self.worker_for(pageid).query(pageid, function, *args)
+
+    def kill(self, uid):
+        """stops the program uid, killing its process if it does not stop
+        within KILL_DELAY seconds; returns False if it is not running in a
+        worker process"""
+        worker = self.worker_running(uid)
+        if worker is None:
+            return False
+        worker.send(("kill", uid))
+        timer = threading.Timer(KILL_DELAY, worker.kill_if_busy, (uid,))
+        timer.setDaemon(True)
+        timer.start()
+        return True
+
+    def forget_page(self, pageid):
+        """the page has been reclaimed; so is its process, unless it is
+        shared with other pages"""
+        self.lock.acquire()
+        try:
+            worker = self.assigned.pop(pageid, None)
+            if worker is None:
+                return
+            worker.pages.discard(pageid)
+            alone = not worker.pages
+        finally:
+            self.lock.release()
+        if alone:
+            worker.kill()
+        else:
+            worker.send(("reclaim", pageid))
+
+    def remove(self, worker):
+        """forgets a worker process which has ended"""
+        self.lock.acquire()
+        try:
+            if worker in self.spares:
+                self.spares.remove(worker)
+                self.failures += 1
+                self.lock.notifyAll()
+            if worker in self.workers:
+                self.workers.remove(worker)
+            for pageid in list(worker.pages):
+                if self.assigned.get(pageid) is worker:
+                    del self.assigned[pageid]
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        """kills all the worker processes"""
+        self.nb_spares = 0
+        self.lock.acquire()
+        workers = self.spares + self.workers
+        self.lock.release()
+        for worker in workers:
+            worker.kill()
+        self.zygote.stop()
+
+def init(spares=SPARE_PROCESSES, max_processes=MAX_PROCESSES):
+    """makes cometIO.do_exec run the code in worker processes"""
+    backend = ProcessBackend(spares, max_processes)
+    backend.start()
+    cometIO.execution_backend = backend
+    return backend
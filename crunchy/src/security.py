@@ -17,19 +17,26 @@ caused by insertion of malicious javascript code within a web page.
 import os
 import imghdr
 import sys
+import threading
+import time
 
 from src.interface import config, ElementTree, u_print, python_version
 
 
 if python_version < 3:
     from urlparse import urljoin
-    from urllib import unquote_plus, urlopen
+    from urllib import unquote_plus
+    from urllib2 import urlopen
 else:
     from urllib.parse import unquote_plus, urljoin
     from urllib.request import urlopen
 
 DEBUG = False
 DEBUG2 = False
+RESOURCE_CACHE_SIZE = 512  # number of images and style sheets remembered
+RESOURCE_CACHE_TTL = 600   # seconds before a remote one is checked again
+FETCH_THREADS = 8   # images and style sheets of a page checked concurrently
+FETCH_TIMEOUT = 10  # seconds to wait for all of them before giving up
 # the root of the server is in a separate directory:
 
 root_path = os.path.join(config['crunchy_base_dir'], "server_root")
@@ -251,6 +258,14 @@ strict['meta'] = ['title', 'name']  # name needed for appending path to sys.path
 allowed_attributes['strict'] = strict
 allowed_attributes['display strict'] = strict
 
+# The same information as frozensets, as used by remove_unwanted():
+# security level -> tag -> allowed attributes
+allowed_sets = {}
+for level in allowed_attributes:
+    allowed_sets[level] = {}
+    for key in allowed_attributes[level]:
+        allowed_sets[level][key] = frozenset(allowed_attributes[level][key])
+
 
 # Just like XSS vulnerability are possible through <style> or 'style' attrib
 # -moz-binding:url(" http://ha.ckers.org/xssmoz.xml#xss")
@@ -271,13 +286,83 @@ dangerous_strings = ['url(', '&#']
 
 __dangerous_text = ''
 
-good_images = set()
-bad_images = set()
+class ResourceCache(object):
+    '''Remembers the result of the validation of the most recently used
+       images and style sheets, keyed on their path or url.  Local files
+       are validated again once modified, remote ones after
+       RESOURCE_CACHE_TTL seconds.'''
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}  # location -> (mtime or time of validation, result)
+        self.order = []  # locations, from least to most recently used
+
+    def stamp(self, location, remote):
+        '''returns the time of validation of a remote resource or the
+        modification time of a local file, None if it does not exist'''
+        if remote:
+            return time.time()
+        try:
+            return os.stat(location).st_mtime
+        except Exception:
+            return None
+
+    def get(self, location, remote):
+        '''returns the cached result, or None'''
+        self.lock.acquire()
+        try:
+            if location not in self.entries:
+                return None
+            stamp, result = self.entries[location]
+        finally:
+            self.lock.release()
+        if remote:
+            fresh = time.time() - stamp < self.ttl
+        else:
+            fresh = self.stamp(location, remote) == stamp
+        if not fresh:
+            return None
+        self.lock.acquire()
+        try:
+            if location in self.order:
+                self.order.remove(location)
+                self.order.append(location)
+        finally:
+            self.lock.release()
+        return result
+
+    def put(self, location, remote, result):
+        '''adds a result, evicting the least recently used ones if needed'''
+        stamp = self.stamp(location, remote)
+        if stamp is None:
+            return
+        self.lock.acquire()
+        try:
+            if location in self.entries:
+                self.order.remove(location)
+            self.entries[location] = (stamp, result)
+            self.order.append(location)
+            while len(self.order) > self.size:
+                del self.entries[self.order.pop(0)]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        self.entries.clear()
+        del self.order[:]
+        self.lock.release()
+
+resource_cache = ResourceCache(RESOURCE_CACHE_SIZE, RESOURCE_CACHE_TTL)
 
 def remove_unwanted(tree, page):  # partially tested
     '''Removes unwanted tags and or attributes from a "tree" created by
-    ElementTree from an html page.'''
-    global __dangerous_text
+    ElementTree from an html page.
+
+    The tree is walked through only once: elements whose tag is not allowed
+    are removed together with their content as soon as they are found,
+    while the attributes of the other ones are filtered.'''
 
     # determine if site security level has been set to override
     # the default
@@ -293,7 +378,8 @@ def remove_unwanted(tree, page):  # partially tested
         except:
             u_print("config[page.username] is not defined")
         raise
-    _allowed = allowed_attributes[security_level]
+    _allowed = allowed_sets[security_level]
+    validate = not 'trusted' in security_level
     #The following will be updated so as to add result from page.
     page.security_info = { 'level': security_level,
                           'number removed': 0,
@@ -301,173 +387,242 @@ def remove_unwanted(tree, page):  # partially tested
                           'attributes removed': [],
                           'styles removed': []
                         }
-
-# first, removing unwanted tags
-    unwanted = set()
+    info = page.security_info
+
+    checked = {}
+    if validate:
+        # fetching the images and style sheets may take a while
+        checked = prefetch(tree, page, _allowed)
+    bad_images = set()
+    unwanted_tags = set()
     tag_count = {}
-    page.security_info['number removed'] = 0
-    for element in tree.getiterator():
-        if element.tag not in _allowed:
-            unwanted.add(element.tag)
-            if element.tag in tag_count:
-                tag_count[element.tag] += 1
-            else:
-                tag_count[element.tag] = 1
-            page.security_info['number removed'] += 1
-    for tag in unwanted:
-        for element in tree.getiterator(tag):
-            element.clear() # removes the text
-            element.tag = None  # set up so that cleanup will remove it.
-        page.security_info['tags removed'].append([tag, tag_count[tag]])
-    if DEBUG:
-        u_print("These unwanted tags have been removed:")
-        u_print(unwanted)
-
-# next, removing unwanted attributes of allowed tags
-    unwanted = set()
-    count = 0
-    for tag in _allowed:
-        for element in tree.getiterator(tag):
-            # Filtering for possible dangerous content in "styles..."
-            if tag == "link":
-                if not 'trusted' in security_level:
-                    if not is_link_safe(element, page):
-                        page.security_info['styles removed'].append(
+    unwanted = set()  # only used for debugging
+    # attributes and styles removed are grouped by tag, and listed
+    # in the order of the allowed tags
+    attributes_removed = {}
+    styles_removed = {}
+
+    def remove_tag(element):
+        '''removes an element whose tag is not allowed, counting it
+        together with the unwanted elements it contains'''
+        for e in element.getiterator():
+            if e.tag not in _allowed:
+                unwanted_tags.add(e.tag)
+                tag_count[e.tag] = tag_count.get(e.tag, 0) + 1
+                info['number removed'] += 1
+        element.clear() # removes the text
+        element.tag = None
+
+    def filter_element(element):
+        '''removes unwanted attributes of an element whose tag is allowed;
+        returns False if the element itself had to be removed'''
+        global __dangerous_text
+        tag = element.tag
+        # Filtering for possible dangerous content in "styles..."
+        if tag == "link":
+            if validate:
+                if not is_link_safe(element, page, checked):
+                    styles_removed.setdefault(tag, []).append(
                                                 [tag, '', __dangerous_text])
-                        __dangerous_text = ''
-                        element.clear()
-                        element.tag = None
-                        page.security_info['number removed'] += 1
-                        continue
-            if tag == "meta":
-                for attr in list(element.attrib.items()):
-                    if (attr[0].lower() == 'http-equiv' and
-                        attr[1].lower() != 'content-type'):
-                        page.security_info['attributes removed'].append(
-                                                [tag, attr[0], attr[1]])
-                        del element.attrib[attr[0]]
-                        page.security_info['number removed'] += 1
+                    __dangerous_text = ''
+                    element.clear()
+                    element.tag = None
+                    info['number removed'] += 1
+                    return False
+        if tag == "meta":
             for attr in list(element.attrib.items()):
-                if attr[0].lower() not in _allowed[tag]:
-                    if DEBUG:
-                        unwanted.add(attr[0])
-                    page.security_info['attributes removed'].append(
-                                                [tag, attr[0], ''])
-                    del element.attrib[attr[0]]
-                    page.security_info['number removed'] += 1
-                elif attr[0].lower() == 'href':
-                    testHREF = unquote_plus(attr[1]).replace("\r","").replace("\n","")
-                    testHREF = testHREF.replace("\t","").lstrip().lower()
-                    if testHREF.startswith("javascript:"):
-                        if DEBUG:
-                            u_print("removing href = "+ testHREF)
-                        page.security_info['attributes removed'].append(
+                if (attr[0].lower() == 'http-equiv' and
+                    attr[1].lower() != 'content-type'):
+                    attributes_removed.setdefault(tag, []).append(
                                                 [tag, attr[0], attr[1]])
-                        del element.attrib[attr[0]]
-                        page.security_info['number removed'] += 1
-                # Filtering for possible dangerous content in "styles..."
-                elif attr[0].lower() == 'style':
-                    if not 'trusted' in security_level:
-                        value = attr[1].lower().replace(' ', '').replace('\t', '')
-                        for x in dangerous_strings:
-                            if x in value:
-                                if DEBUG:
-                                    unwanted.add(value)
-                                page.security_info['styles removed'].append(
+                    del element.attrib[attr[0]]
+                    info['number removed'] += 1
+        allowed_attrs = _allowed[tag]
+        for attr in list(element.attrib.items()):
+            name = attr[0].lower()
+            if name not in allowed_attrs:
+                if DEBUG:
+                    unwanted.add(attr[0])
+                attributes_removed.setdefault(tag, []).append(
+                                                [tag, attr[0], ''])
+                del element.attrib[attr[0]]
+                info['number removed'] += 1
+            elif name == 'href':
+                testHREF = unquote_plus(attr[1]).replace("\r","").replace("\n","")
+                testHREF = testHREF.replace("\t","").lstrip().lower()
+                if testHREF.startswith("javascript:"):
+                    if DEBUG:
+                        u_print("removing href = "+ testHREF)
+                    attributes_removed.setdefault(tag, []).append(
                                                 [tag, attr[0], attr[1]])
-                                del element.attrib[attr[0]]
-                                page.security_info['number removed'] += 1
-            # Filtering for possible dangerous content in "styles...", but
-            # skipping over empty <style/> element.
-            if tag == 'style' and element.text is not None:
-                if not 'trusted' in security_level:
-                    text = element.text.lower().replace(' ', '').replace('\t', '')
+                    del element.attrib[attr[0]]
+                    info['number removed'] += 1
+            # Filtering for possible dangerous content in "styles..."
+            elif name == 'style':
+                if validate:
+                    value = attr[1].lower().replace(' ', '').replace('\t', '')
                     for x in dangerous_strings:
-                        if x in text:
+                        if x in value:
                             if DEBUG:
-                                unwanted.add(text)
-                            page.security_info['styles removed'].append(
+                                unwanted.add(value)
+                            styles_removed.setdefault(tag, []).append(
+                                                [tag, attr[0], attr[1]])
+                            del element.attrib[attr[0]]
+                            info['number removed'] += 1
+        # Filtering for possible dangerous content in "styles...", but
+        # skipping over empty <style/> element.
+        if tag == 'style' and element.text is not None:
+            if validate:
+                text = element.text.lower().replace(' ', '').replace('\t', '')
+                for x in dangerous_strings:
+                    if x in text:
+                        if DEBUG:
+                            unwanted.add(text)
+                        styles_removed.setdefault(tag, []).append(
                                                 [tag, '', element.text])
-                            element.clear()
-                            element.tag = None
-                            page.security_info['number removed'] += 1
-            # making sure that this is an image
-            if tag == "img" and \
-                      not 'trusted' in security_level:
-                _rem = False
-                if 'src' in element.attrib:
-                    src = element.attrib["src"]
-                    if src in good_images:
-                        pass
-                    elif src in bad_images:
                         element.clear()
                         element.tag = None
-                        # do not repeat the information; same image
-                        #_rem = True
-                    else:
-                        if validate_image(src, page):
-                            good_images.add(src)
-                        else:
-                            bad_images.add(src)
-                            element.clear()
-                            element.tag = None
-                            _rem = True
-                else:
+                        info['number removed'] += 1
+        # making sure that this is an image
+        if tag == "img" and validate:
+            _rem = False
+            if 'src' in element.attrib:
+                src = element.attrib["src"]
+                if not validate_image(src, page, checked):
                     element.clear()
                     element.tag = None
-                    _rem = True
-                    src = 'No src attribute included.'
-                if _rem:
-                    page.security_info['number removed'] += 1
-                    page.security_info['attributes removed'].append(
-                        ['img', 'src',
-                        "could not validate or accept image:" + src])
-    __cleanup(tree.getroot(), lambda e: e.tag)
+                    # do not repeat the information; same image
+                    if src not in bad_images:
+                        bad_images.add(src)
+                        _rem = True
+            else:
+                element.clear()
+                element.tag = None
+                _rem = True
+                src = 'No src attribute included.'
+            if _rem:
+                info['number removed'] += 1
+                attributes_removed.setdefault(tag, []).append(
+                    ['img', 'src',
+                    "could not validate or accept image:" + src])
+        return element.tag is not None
+
+    def clean(elem):
+        '''filters the children of elem, removing the unwanted ones
+        See http://effbot.org/zone/element-bits-and-pieces.htm'''
+        out = []
+        for child in elem:
+            if child.tag not in _allowed:
+                remove_tag(child)
+            elif filter_element(child):
+                clean(child)
+                out.append(child)
+        if len(out) != len(elem):
+            try:
+                elem[:] = out  # quick and works with Python 2.x but not 3.x
+            except AssertionError:
+                del elem[:]
+                for child in out:
+                    elem.append(child)
+
+    root = tree.getroot()
+    if root.tag not in _allowed:
+        remove_tag(root)
+    elif filter_element(root):
+        clean(root)
+
+    for tag in unwanted_tags:
+        info['tags removed'].append([tag, tag_count[tag]])
+    for tag in allowed_attributes[security_level]:
+        if tag in attributes_removed:
+            info['attributes removed'].extend(attributes_removed[tag])
+        if tag in styles_removed:
+            info['styles removed'].extend(styles_removed[tag])
     if DEBUG:
+        u_print("These unwanted tags have been removed:")
+        u_print(unwanted_tags)
         u_print("These unwanted attributes have been removed:")
         u_print(unwanted)
     return
 
-def __cleanup(elem, filter):
-    ''' See http://effbot.org/zone/element-bits-and-pieces.htm'''
-    out = []
-    for e in elem:
-        __cleanup(e, filter)
-        if not filter(e):
-            if e.text:
-                if out:
-                    out[-1].tail += e.text
-                else:
-                    elem.text += e.text
-            out.extend(e)
-            if e.tail:
-                if out:
-                    out[-1].tail += e.tail
-                else:
-                    elem.text += e.tail
+def fetch_all(tasks):
+    '''runs check(location, remote) for all the (location, remote, check)
+    tasks, using FETCH_THREADS threads; returns a dict: location -> result
+    where the result is None if it could not be obtained within
+    FETCH_TIMEOUT seconds'''
+    results = {}
+    todo = list(tasks)
+    lock = threading.Lock()
+    def work():
+        while True:
+            lock.acquire()
+            try:
+                if not todo:
+                    return
+                location, remote, check = todo.pop()
+            finally:
+                lock.release()
+            result = check(location, remote)
+            lock.acquire()
+            results[location] = result
+            lock.release()
+    threads = []
+    for i in range(min(FETCH_THREADS, len(todo))):
+        thread = threading.Thread(target=work)
+        thread.setDaemon(True)  # a slow server must not prevent exiting
+        thread.start()
+        threads.append(thread)
+    deadline = time.time() + FETCH_TIMEOUT
+    for thread in threads:
+        thread.join(max(0, deadline - time.time()))
+    lock.acquire()
+    done = {}
+    for location, remote, check in tasks:
+        done[location] = results.get(location)
+    lock.release()
+    return done
+
+def prefetch(tree, page, allowed):
+    '''validates concurrently the images and style sheets of a page which
+    are not found in resource_cache; returns the results obtained, as
+    given by fetch_all()'''
+    tasks = []
+    found = set()
+    for element in tree.getiterator():
+        if element.tag not in allowed:
+            continue
+        if element.tag == "img" and 'src' in element.attrib:
+            location, remote = image_location(element.attrib['src'], page)
+            check = check_image
+        elif element.tag == "link":
+            location = stylesheet_url(element, page)[0]
+            if location is None:
+                continue
+            remote = location.startswith("http://")
+            check = check_stylesheet
         else:
-            out.append(e)
-
-    try:
-        elem[:] = out  # quick and works with Python 2.x but not 3.x
-    except AssertionError:
-        del elem[:]
-        for child in out:
-            elem.append(child)
-    return
-
-def validate_image(src, page):
-    '''verifies that the file contents appears to be that of an image'''
-    global root_path
-
-    if DEBUG:
-        u_print("entering validate_image")
-        u_print("page.is_local "+ str(page.is_local))
-        u_print("page.is_remote "+ str(page.is_remote))
-        u_print("page.url "+ page.url)
-        u_print("src "+ src)
-        u_print("root_path "+ root_path)
-
+            continue
+        if location in found:
+            continue
+        found.add(location)
+        if resource_cache.get(location, remote) is None:
+            tasks.append((location, remote, check))
+    if not tasks:
+        return {}
+    return fetch_all(tasks)
+
+def cached_check(location, remote, check, checked=None):
+    '''returns the result of check(location, remote) as found in checked,
+    in resource_cache, or obtained by running it'''
+    if checked is not None and location in checked:
+        return checked[location]
+    result = resource_cache.get(location, remote)
+    if result is None:
+        result = check(location, remote)
+    return result
+
+def image_location(src, page):
+    '''returns the path or url of an image, and True if it is remote'''
     if src.startswith("http://"):
         # the image may be residing on a different site than the one
         # currently viewed.
@@ -483,70 +638,88 @@ def validate_image(src, page):
         # - assuming plain string, which may be wrong
         #fn = os.path.join(root_path, src.decode('utf-8'))
         fn = os.path.join(root_path, src)
+    return fn, page.is_remote or src.startswith("http://")
+
+def open_url(url):
+    '''opens a remote url, giving up after FETCH_TIMEOUT seconds without
+    an answer where urlopen() allows it'''
+    if python_version >= 2.6:
+        return urlopen(url, timeout=FETCH_TIMEOUT)
+    return urlopen(url)
+
+def check_image(fn, remote):
+    '''verifies that the file contents appears to be that of an image;
+    returns None if the file can not be read'''
     try:
         if DEBUG:
             u_print("opening fn="+ fn)
+        if remote:
+            f = open_url(fn)
+        else:
+            f = open(fn.encode(sys.getfilesystemencoding()), 'rb')
         try:
-            if page.is_remote or src.startswith("http://"):
-                h = urlopen(fn).read(32) #32 is all that's needed for
-                                                # imghrd.what
-            else:
-                h = open(fn.encode(sys.getfilesystemencoding()), 'rb').read(32)
-            if DEBUG:
-                u_print("opened the file")
-        except:
-            if DEBUG:
-                u_print("could not open")
-            return False
-        try:
-            type = imghdr.what('ignore', h)
-            if DEBUG:
-                u_print("opened with imghdr.what")
-                u_print("image type = "+ type)
-                u_print("image src = "+ src)
-            if type is not None:
-                u_print("validated image:"+ fn)
-                return True
-        except:
-            if DEBUG:
-                u_print("could not open with imghdr.what")
-            return False
+            h = f.read(32) #32 is all that's needed for imghrd.what
+        finally:
+            f.close()
+        if DEBUG:
+            u_print("opened the file")
     except:
-        return False
-
-def is_link_safe(elem, page):
-    '''only keep <link> referring to style sheets that are deemed to
-       be safe'''
-    global __dangerous_text
-    url = page.url
+        if DEBUG:
+            u_print("could not open")
+        return None
+    try:
+        type = imghdr.what('ignore', h)
+        if DEBUG:
+            u_print("opened with imghdr.what")
+            u_print("image type = "+ str(type))
+            u_print("image src = "+ fn)
+    except:
+        if DEBUG:
+            u_print("could not open with imghdr.what")
+        type = None
+    result = type is not None
+    if result:
+        u_print("validated image:"+ fn)
+    resource_cache.put(fn, remote, result)
+    return result
+
+def validate_image(src, page, checked=None):
+    '''verifies that the file contents appears to be that of an image'''
+    fn, remote = image_location(src, page)
     if DEBUG:
-        u_print("found link element; page url = "+ url)
+        u_print("entering validate_image")
+        u_print("page.is_local "+ str(page.is_local))
+        u_print("page.is_remote "+ str(page.is_remote))
+        u_print("page.url "+ page.url)
+        u_print("src "+ src)
+        u_print("root_path "+ root_path)
+    return bool(cached_check(fn, remote, check_image, checked))
+
+def stylesheet_url(elem, page):
+    '''returns the url of the style sheet referred to by a <link> element,
+       or None and the reason why it is not accepted'''
     #--  Only allow style files
     if "type" in elem.attrib:
         type = elem.attrib["type"]
         if DEBUG2:
             u_print("type = "+ type)
         if type.lower() != "text/css":  # not a style sheet - eliminate
-            __dangerous_text = 'type != "text/css"'
-            return False
+            return None, 'type != "text/css"'
     else:
         if DEBUG2:
             u_print("type not found.")
-        __dangerous_text = 'type not found'
-        return False
+        return None, 'type not found'
     #--
     if "rel" in elem.attrib:
         rel = elem.attrib["rel"]
         if DEBUG2:
             u_print("rel = "+ rel)
         if rel.lower() != "stylesheet":  # not a style sheet - eliminate
-            __dangerous_text = 'rel != "stylesheet"'
-            return False
+            return None, 'rel != "stylesheet"'
     else:
         if DEBUG2:
             u_print("rel not found.")
-        __dangerous_text = 'rel not found'
-        return False
+        return None, 'rel not found'
     #--
     if "href" in elem.attrib:
         href = elem.attrib["href"]
@@ -555,46 +728,59 @@ def is_link_safe(elem, page):
     else:         # no link to a style sheet: not a style sheet!
         if DEBUG2:
             u_print("href not found.")
-        __dangerous_text = 'href not found'
-        return False
+        return None, 'href not found'
     #--If we reach this point we have in principle a valid style sheet.
 
     try:
-        link_url = find_url(url, href, page)
+        link_url = find_url(page.url, href, page)
     except:
         u_print("problem encountered in security.py (trying link_url = find_url)")
-        return False
+        return None, None
     if DEBUG2:
         u_print("link url = "+ link_url)
-    #--Scan for suspicious content
-    suspicious = False
-    if page.is_local:
-        css_file = open_local_file(link_url)
-        if not css_file:  # could not open the file
-            return False
-        suspicious = scan_for_unwanted(css_file)
-    elif page.is_remote:
-        css_file = open_local_file(link_url)
-        if not css_file:  # could not open the file
-            return False
-        suspicious = scan_for_unwanted(css_file)
-    else:  # local page loaded via normal link.
-        css_file = open_local_file(link_url)
-        if not css_file:  # could not open the file
-            return False
-        suspicious = scan_for_unwanted(css_file)
-
-    if not suspicious:
+    return link_url, None
+
+def check_stylesheet(link_url, remote):
+    '''returns (True, '') if a style sheet contains nothing suspicious,
+       (False, the suspicious line) otherwise, and None if it can not
+       be read'''
+    css_file = open_local_file(link_url)
+    if not css_file:  # could not open the file
+        return None
+    try:
+        text = find_dangerous_text(css_file)
+    finally:
+        css_file.close()
+    if text is None:
         if DEBUG:
             u_print("No suspicious content found in css file.")
-        return True
-    elif DEBUG:
-        u_print("Suspicious content found in css file.")
-        return False
+        result = (True, '')
+    else:
+        if DEBUG:
+            u_print("Suspicious content found in css file.")
+        result = (False, text)
+    resource_cache.put(link_url, remote, result)
+    return result
 
+def is_link_safe(elem, page, checked=None):
+    '''only keep <link> referring to style sheets that are deemed to
+       be safe'''
+    global __dangerous_text
     if DEBUG:
-        u_print("should not be reached")
-    return False  # don't take any chances
+        u_print("found link element; page url = "+ page.url)
+    link_url, reason = stylesheet_url(elem, page)
+    if link_url is None:
+        if reason is not None:
+            __dangerous_text = reason
+        return False
+    #--Scan for suspicious content
+    result = cached_check(link_url, link_url.startswith("http://"),
+                          check_stylesheet, checked)
+    if result is None:  # could not open the file
+        return False
+    if not result[0]:
+        __dangerous_text = result[1]
+    return result[0]
 
 def find_url(url, href, page):
     '''given the url of a "parent" html page and the href of a "child"
@@ -650,7 +836,7 @@ def open_local_file(url):
         u_print("attempting to open file: " + url)
     if url.startswith("http://"):
         try:
-            return urlopen(url)
+            return open_url(url)
         except:
             if DEBUG:
                 u_print("Cannot open remote file with url= " + url)
@@ -668,6 +854,19 @@ def open_local_file(url):
                 u_print("Cannot open local file with url= " + url)
             return False
 
+def find_dangerous_text(css_file):
+    '''returns the first line of a css file containing one of the
+    dangerous_strings (without spaces), or None'''
+    for line in css_file.readlines():
+        squished = line.replace(' ', '').replace('\t', '')
+        for x in dangerous_strings:
+            if x in squished:
+                if DEBUG:
+                    u_print("Found suspicious content in the following line:")
+                    u_print(squished)
+                return squished
+    return None
+
 def scan_for_unwanted(css_file):
     '''Looks for any suspicious code in a css file
 
@@ -677,13 +876,8 @@ def scan_for_unwanted(css_file):
     returns True if suspicious code is found.'''
     global __dangerous_text
 
-    for line in css_file.readlines():
-        squished = line.replace(' ', '').replace('\t', '')
-        for x in dangerous_strings:
-            if x in squished:
-                if DEBUG:
-                    u_print("Found suspicious content in the following line:")
-                    u_print(squished)
-                __dangerous_text = squished
-                return True
-    return False
+    text = find_dangerous_text(css_file)
+    if text is None:
+        return False
+    __dangerous_text = text
+    return True
@@ -45,6 +45,9 @@ class Page(object):
     def add_js_code(self, dummy):
         self.added_info.append('add_js_code')
 
+    def add_js_init(self, function, dummy):
+        self.added_info.append(('add_js_init', function))
+
     def insert_js_file(self, filename):
         self.added_info.append(('insert_js_file', filename))
 
@@ -127,6 +130,9 @@ def register_begin_pagehandler(handler):
 def register_end_pagehandler(handler):
     registered_end_pagehandlers[str(handler)] = handler
 
+def register_page_cleanup(handler):
+    registered_page_cleanups[str(handler)] = handler
+
 def register_preprocess_page(tag, handler):
     registered_preprocess_page[tag] = handler
 
@@ -144,7 +150,7 @@ def init():
     global registered_tag_handler, registered_http_handler, registered_services,\
         registered_begin_pagehandlers, registered_end_pagehandlers,\
         registered_preprocessors, registered_preprocess_page,\
-        registered_final_tag_handlers
+        registered_final_tag_handlers, registered_page_cleanups
     registered_tag_handler = {}
     registered_http_handler = {}
     registered_services = {}
@@ -153,6 +159,7 @@ def init():
     registered_end_pagehandlers = {}
     registered_preprocess_page = {}
     registered_final_tag_handlers = {}
+    registered_page_cleanups = {}
 
     plugin['register_tag_handler'] = register_tag_handler
     plugin['register_http_handler'] = register_http_handler
@@ -162,3 +169,4 @@ def init():
     plugin['register_end_pagehandler'] = register_end_pagehandler
     plugin['register_preprocess_page'] = register_preprocess_page
     plugin['register_final_tag_handler'] = register_final_tag_handler
+    plugin['register_page_cleanup'] = register_page_cleanup
@@ -10,7 +10,9 @@ import copy
 import re
 import sys
 import textwrap
-from os.path import join
+import threading
+import time
+from os.path import join, splitext
 from src.interface import (config, plugin, Element, SubElement, names,
                            StringIO, server, translate)
 _ = translate['_']
@@ -23,7 +25,7 @@ else:
     from urllib.request import FancyURLopener
 
 COUNT = 0
-def uidgen(username):  # tested
+def uidgen(username=None):  # tested
     """an suid (session unique ID) generator
     """
     global COUNT
@@ -32,9 +34,11 @@ def uidgen(username):  # tested
     # uid's get passed around to various modules; by associating a uid
     # to a username, we facilitate adapting behaviour of a given function/method
     # to the preferences of the user.
-    names[uid] = username
+    if username is not None:
+        names[uid] = username
     # note that Crunchy's uid's are usually composed of TWO uid's - one for
-    # the page, the other for a given html "object".
+    # the page, the other for a given html "object".  Only the first one,
+    # given a username, is kept in names: see cometIO.reclaim_page
     return uid
 
 def extract_log_id(vlam):  # tested
@@ -229,6 +233,107 @@ end_html = """
 </html>
 """
 
+LOG_FLUSH_INTERVAL = 1  # seconds during which log entries are gathered
+                        # before being written together
+session_logs = {}  # username: SessionLog
+session_logs_lock = threading.Lock()
+
+class SessionLog(object):
+    '''Writes the log of a user's session to disk.
+
+    Each entry is appended to a journal, next to the html report, by a
+    background thread which writes the entries received during
+    LOG_FLUSH_INTERVAL in one go; the report itself, where the entries
+    are grouped by log_id, is only created when it is needed.'''
+    def __init__(self, username):
+        self.username = username
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.has_pending = threading.Event()
+        self.pending = []
+        self.last_log_id = None
+        self.stale = False  # the report does not include all the entries
+        writer = threading.Thread(target=self.run)
+        writer.setDaemon(True)
+        writer.start()
+
+    def journal_filename(self):
+        return splitext(config[self.username]['log_filename'])[0] + "_journal.html"
+
+    def add(self, log_id, data):
+        '''queues up an entry to be written'''
+        self.lock.acquire()
+        self.pending.append((log_id, data))
+        self.stale = True
+        self.has_pending.set()
+        self.lock.release()
+
+    def run(self):
+        while True:
+            self.has_pending.wait()
+            time.sleep(LOG_FLUSH_INTERVAL)
+            try:
+                self.flush()
+            except Exception:
+                sys.stderr.write("Could not write the session log of %s:\n%s\n"
+                                 % (self.username, sys.exc_info()[1]))
+
+    def flush(self):
+        '''appends the pending entries to the journal'''
+        self.write_lock.acquire()
+        try:
+            self.lock.acquire()
+            pending = self.pending
+            self.pending = []
+            self.has_pending.clear()
+            self.lock.release()
+            if not pending:
+                return
+            text = []
+            for log_id, data in pending:
+                if log_id != self.last_log_id:
+                    if self.last_log_id is not None:
+                        text.append("</pre>\n")
+                    text.append("<h2>log_id = %s    <small>(%s)</small></h2><pre>"
+                                % (log_id, time.strftime('%Y-%m-%d %X')))
+                    self.last_log_id = log_id
+                text.append(data)
+            f = open(self.journal_filename(), 'a')
+            f.write(''.join(text))
+            f.close()
+        finally:
+            self.write_lock.release()
+
+    def render(self):
+        '''writes the report, if it is not up to date, and returns its
+        filename'''
+        self.lock.acquire()
+        stale = self.stale
+        self.stale = False
+        self.lock.release()
+        if stale:
+            log_session(self.username)
+        return config[self.username]['log_filename']
+
+def get_session_log(username):
+    '''returns the SessionLog of a user, creating it if needed'''
+    session_logs_lock.acquire()
+    if username not in session_logs:
+        session_logs[username] = SessionLog(username)
+    session_logs_lock.release()
+    return session_logs[username]
+
+def log_entry(username, log_id, data):
+    '''adds some data to the log of a session'''
+    config[username]['log'][log_id].append(data)
+    get_session_log(username).add(log_id, data)
+
+def render_session_logs():
+    '''brings all the session logs up to date on disk'''
+    for session_log in list(session_logs.values()):
+        session_log.flush()
+        session_log.render()
+
 def log_session(username):
     '''create a log of a session in a file'''
     f = open(config[username]['log_filename'], 'w')
@@ -258,7 +363,7 @@ def append_warning(pageid, parent_uid):
 def append_image(pageid, parent_uid, attributes):
     '''appends an image using dhtml techniques
     '''
-    child_uid = parent_uid + uidgen("_")
+    child_uid = parent_uid + uidgen()
     plugin['exec_js'](pageid,
                       """var currentDiv = document.getElementById("%s");
                       var newTag = document.createElement("img");
@@ -5,6 +5,9 @@ sets up the page and calls appropriate plugins
 """
 
 import codecs
+import copy
+import os
+import threading
 import traceback
 from os.path import join
 
@@ -24,6 +27,8 @@ else:
 DTD = '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '\
 '"http://www.w3.org/TR/xhtml1/DTD/strict.dtd">\n'
 
+PAGE_CACHE_SIZE = 32  # number of sanitized pages kept in memory
+
 TRACE = """Please file a bug report at http://code.google.com/p/crunchy/issues/list
 ================================================================================
 """
@@ -48,6 +53,83 @@ def handle_exception(full_page=True):
     text = text.replace("TRACEBACK", TRACE + trace)
     return text
 
+def reset_dispatch_index():
+    '''to be called when handlers of type 1, 2 or 3 are registered'''
+    BasePage.dispatch = None
+
+class KeywordHandlers(dict):
+    '''keyword -> handler function, for a given tag and attribute in
+       BasePage.handlers3.  A keyword which has not been registered is
+       passed to the fallback functions, in the order in which they were
+       added, until one of them returns a handler; the handler found is
+       then registered for this keyword.'''
+    def __init__(self, *args):
+        dict.__init__(self, *args)
+        self.fallbacks = []
+
+    def __contains__(self, keyword):
+        return self.find(keyword) is not None
+
+    def __getitem__(self, keyword):
+        handler = self.find(keyword)
+        if handler is None:
+            raise KeyError(keyword)
+        return handler
+
+    def find(self, keyword):
+        '''returns the handler for keyword, or None'''
+        handler = self.get(keyword)
+        if handler is None:
+            for fallback in self.fallbacks:
+                handler = fallback(keyword)
+                if handler is not None:
+                    self[keyword] = handler
+                    break
+        return handler
+
+class PageCache(object):
+    '''Keeps the trees of the most recently requested pages, as they are
+       before any vlam processing, so that a page opened by many users
+       needs only be parsed and sanitized once.'''
+    def __init__(self, size):
+        self.size = size
+        self.lock = threading.Lock()
+        self.pages = {}  # key -> (tree, security_info)
+        self.order = []  # keys, from least to most recently used
+
+    def get(self, key):
+        '''returns the cached (tree, security_info) or None'''
+        self.lock.acquire()
+        try:
+            if key not in self.pages:
+                return None
+            self.order.remove(key)
+            self.order.append(key)
+            return self.pages[key]
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        '''adds a page, evicting the least recently used ones if needed'''
+        self.lock.acquire()
+        try:
+            if key in self.pages:
+                self.order.remove(key)
+            self.pages[key] = value
+            self.order.append(key)
+            while len(self.order) > self.size:
+                del self.pages[self.order.pop(0)]
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        self.pages.clear()
+        del self.order[:]
+        self.lock.release()
+
+page_cache = PageCache(PAGE_CACHE_SIZE)
+
 # The purpose of the following class is to facilitate unit testing.  It can
 # be initialized with no further action taking place, and each method
 # has then to be called explicitly.
@@ -68,10 +150,13 @@ class BasePage(object): # tested
     begin_pagehandlers = []
     meta_handler = {} # attribute -> [handler_fn1, handler_fn2, ...]
     end_pagehandlers = []
+    dispatch = None  # see dispatch_index()
 
     def __init__(self, username):  # tested
         '''initialises a few values, and registers the page for comet i/o.'''
         self.included = set([])
+        self.js_inits = {}  # see add_js_init()
+        self.js_init_script = None
         self.username = username
         self.pageid = uidgen(self.username)
         from_comet['register_new_page'](self.pageid)
@@ -80,10 +165,16 @@ class BasePage(object): # tested
     def create_tree(self, filehandle):  # tested
         '''creates a tree (elementtree object) from an html file'''
         # note: this process removes the existing DTD
-        html = ElementSoup.parse(filehandle)
+        html = ElementSoup.parse(filehandle, backend=self.html_parser())
         self.tree = et.ElementTree(html)
         filehandle.close()
 
+    def html_parser(self):
+        '''returns the html parser chosen by the user, if any'''
+        if self.username in config:
+            return config[self.username].get('html_parser')
+        return None
+
     def fix_divs(self):
         '''ensure that empty divs are not self-closing so that sites are
            displayed properly'''
@@ -165,15 +256,20 @@ class BasePage(object): # tested
         # style and by user's preferences.
         return
 
-    def insert_css_file(self, path):
-        '''inserts a link to the standard Crunchy style file'''
+    def insert_css_file(self, path, first=False):
+        '''inserts a link to a style file; if first is True, it is inserted
+        before the other styles, so that they can override it.'''
         css = et.Element("link", type= "text/css", rel="stylesheet",
                          href=path)
         try:
-            self.head.append(css)
-        except:   # should never be needed in normal call from CrunchyPage
+            head = self.head
+        except AttributeError:  # should never be needed in normal call from CrunchyPage
             self.find_head()
-            self.head.append(css)
+            head = self.head
+        if first:
+            head.insert(0, css)
+        else:
+            head.append(css)
         return
 
     def add_user_style(self):  # tested
@@ -214,6 +310,23 @@ class BasePage(object): # tested
             self.head.append(js)
         return
 
+    def add_js_init(self, function, uid):  # tested
+        '''arranges for a javascript function to be called with the list of
+           the uids of all the widgets it initializes, instead of once per
+           widget; the calls are made from a single <script> in the <head>.'''
+        if function not in self.js_inits:
+            self.js_inits[function] = []
+        self.js_inits[function].append('"%s"' % uid)
+        if self.js_init_script is None:
+            self.add_js_code('')
+            self.js_init_script = self.head[-1]
+        calls = []
+        for function in sorted(self.js_inits):
+            calls.append('%s([%s]);' % (function,
+                                        ', '.join(self.js_inits[function])))
+        self.js_init_script.text = '\n'.join(calls)
+        return
+
     def insert_js_file(self, filename):  # tested
         '''Inserts a javascript file link in the <head>.
            This should only be used for really big scripts
@@ -253,22 +366,64 @@ class BasePage(object): # tested
             keyword = None
         return keyword
 
+    def dispatch_index(self):  # tested
+        '''returns a dict: tag -> (type 1 handler, type 2 handlers,
+        type 3 handlers) for all the tags having registered handlers of
+        type 1, 2 or 3, so that the handlers relevant to an element are
+        found with a single lookup while walking the tree.
+
+        The index is built once plugins have registered their handlers and
+        is only rebuilt when they change (see reset_dispatch_index()).
+        '''
+        handlers = (self.handlers1, self.handlers2, self.handlers3)
+        if BasePage.dispatch is not None:
+            built_from, index = BasePage.dispatch
+            if (built_from[0] is handlers[0] and built_from[1] is handlers[1]
+                                            and built_from[2] is handlers[2]):
+                return index
+        index = {}
+        for tag in handlers[0]:
+            index[tag] = (handlers[0][tag], {}, {})
+        for tag in handlers[1]:
+            handler1 = index.get(tag, (None, {}, {}))[0]
+            index[tag] = (handler1, handlers[1][tag], {})
+        for tag in handlers[2]:
+            handler1, handlers2 = index.get(tag, (None, {}, {}))[:2]
+            index[tag] = (handler1, handlers2, handlers[2][tag])
+        BasePage.dispatch = (handlers, index)
+        return index
+
+    def has_handler3(self, elem, handlers3):
+        '''returns True if a handler of type 3 is registered for one of
+        the (attribute, keyword) combinations found in elem'''
+        for attr in elem.attrib:
+            if attr in handlers3:
+                if self.extract_keyword(elem, attr) in handlers3[attr]:
+                    return True
+        return False
+
     def process_handlers3(self):  # tested
         '''
         For all registered "tags" of "type 3", this method
         processes:  (tag, attribute, keyword) -> handler function
         '''
-        for tag in self.handlers3:
-            for elem in list(self.tree.iter(tag)):
-                # elem.attrib  size may change during the loop
-                attributes = dict(elem.attrib)
-                for attr in attributes:
-                    if attr in self.handlers3[tag]:
-                        keyword = self.extract_keyword(elem, attr)
-                        if keyword in self.handlers3[tag][attr]:
-                            self.handlers3[tag][attr][keyword]( self,
-                                            elem, self.pageid + "_" + uidgen(self.username))
-                            break
+        index = self.dispatch_index()
+        # elements added by a handler are not processed
+        for elem in list(self.tree.iter()):
+            if elem.tag not in index:
+                continue
+            handlers3 = index[elem.tag][2]
+            if not handlers3:
+                continue
+            # elem.attrib  size may change during the loop
+            attributes = dict(elem.attrib)
+            for attr in attributes:
+                if attr in handlers3:
+                    keyword = self.extract_keyword(elem, attr)
+                    if keyword in handlers3[attr]:
+                        handlers3[attr][keyword]( self,
+                                        elem, self.pageid + "_" + uidgen())
+                        break
 
     def process_handlers2(self):  # tested
         '''
@@ -278,20 +433,25 @@ class BasePage(object): # tested
         "type 3" : (tag, attribute, keyword) -> handler function
         have not been defined.
         '''
-        for tag in self.handlers2:
-            for elem in self.tree.getiterator(tag):
-                # elem.attrib size may change during the loop
-                attributes = dict(elem.attrib)
-                for attr in attributes:
-                    if attr in self.handlers2[tag]:
-                        do_it = True
-                        if attr in self.handlers3[tag]:
-                            keyword = self.extract_keyword(elem, attr)
-                            if keyword in self.handlers3[tag][attr]:
-                                do_it = False
-                        if do_it:
-                            uid = self.pageid + "_" + uidgen(self.username)
-                            self.handlers2[tag][attr](self, elem, uid)
+        index = self.dispatch_index()
+        for elem in self.tree.iter():
+            if elem.tag not in index:
+                continue
+            dummy, handlers2, handlers3 = index[elem.tag]
+            if not handlers2:
+                continue
+            # elem.attrib size may change during the loop
+            attributes = dict(elem.attrib)
+            for attr in attributes:
+                if attr in handlers2:
+                    do_it = True
+                    if attr in handlers3:
+                        keyword = self.extract_keyword(elem, attr)
+                        if keyword in handlers3[attr]:
+                            do_it = False
+                    if do_it:
+                        uid = self.pageid + "_" + uidgen()
+                        handlers2[attr](self, elem, uid)
         return
 
     def process_type1(self, handlers):  # tested
@@ -303,24 +463,22 @@ class BasePage(object): # tested
         "type 3" : (tag, attribute, keyword) -> handler function
         have not been defined.
         '''
-        for tag in handlers:
-            for elem in self.tree.getiterator(tag):
-                do_it = True
-                if tag in self.handlers2:  # may need to skip
-                    for attr in elem.attrib:
-                        if attr in self.handlers2[tag]:
-                            do_it = False
-                            break
-                if tag in self.handlers3:  # may need to skip
-                    for attr in elem.attrib:
-                        if attr in self.handlers3[tag]:
-                            keyword = self.extract_keyword(elem, attr)
-                            if keyword in self.handlers3[tag][attr]:
-                                do_it = False
-                                break
-                if do_it:
-                    uid = self.pageid + "_" + uidgen(self.username)
-                    handlers[tag](self, elem, uid)
+        index = self.dispatch_index()
+        no_handlers = (None, {}, {})
+        for elem in self.tree.iter():
+            if elem.tag not in handlers:
+                continue
+            dummy, handlers2, handlers3 = index.get(elem.tag, no_handlers)
+            do_it = True
+            for attr in elem.attrib:
+                if attr in handlers2:  # may need to skip
+                    do_it = False
+                    break
+            if do_it and self.has_handler3(elem, handlers3):
+                do_it = False
+            if do_it:
+                uid = self.pageid + "_" + uidgen()
+                handlers[elem.tag](self, elem, uid)
         return
 
     def process_preprocess_page(self, handlers):
@@ -329,9 +487,9 @@ class BasePage(object): # tested
 
         Used, for example, to modify existing markup on a page.
         '''
-        for tag in handlers:
-            for elem in self.tree.getiterator(tag):
-                handlers[tag](self, elem, 'dummy')
+        for elem in self.tree.iter():
+            if elem.tag in handlers:
+                handlers[elem.tag](self, elem, 'dummy')
         return
 
     def process_meta_handlers(self):
@@ -370,13 +528,18 @@ class CrunchyPage(BasePage):
     '''class used to store an html page processed by Crunchy with added
        interactive elements.
     '''
-    def __init__(self, filehandle, url, username=None, remote=False, local=False):
+    def __init__(self, filehandle, url, username=None, remote=False, local=False,
+                 filename=None):
         """
         read a page, processes it and outputs a completely transformed one,
         ready for display in browser.
 
         url should be just a path if crunchy accesses the page locally, or
         the full URL if it is remote.
+
+        filename is the file from which the page is read, if any; when
+        given, the page is only parsed and sanitized again once the file
+        has been modified.
         """
         if username is None:
             username = interface.unknown_user
@@ -391,18 +554,30 @@ class CrunchyPage(BasePage):
         else:
             self.is_from_root = False
 
-        # Create the proper tree structure from the html file
-        try:
-            self.create_tree(filehandle)  # assigns self.tree
-        except: # reports formatted traceback in browser window
-            text = changeHTMLspecialCharacters(handle_exception(False))
-            self.tree = et.ElementTree(et.fromstring(
+        key = self.cache_key(filename)
+        cached = None
+        if key is not None:
+            cached = page_cache.get(key)
+        if cached is not None:
+            filehandle.close()
+            self.tree = copy.deepcopy(cached[0])
+            self.security_info = copy.deepcopy(cached[1])
+        else:
+            # Create the proper tree structure from the html file
+            try:
+                self.create_tree(filehandle)  # assigns self.tree
+            except: # reports formatted traceback in browser window
+                text = changeHTMLspecialCharacters(handle_exception(False))
+                self.tree = et.ElementTree(et.fromstring(
                             "<html><head/><body><pre>%s</pre></body></html>"%text))
-            return
+                return
 
-        # Removing pre-existing javascript, unwanted objects and
-        # all kinds of other potential security holes
-        remove_unwanted(self.tree, self) # from the security module
+            # Removing pre-existing javascript, unwanted objects and
+            # all kinds of other potential security holes
+            remove_unwanted(self.tree, self) # from the security module
+            if key is not None:
+                page_cache.put(key, (copy.deepcopy(self.tree),
+                                     copy.deepcopy(self.security_info)))
 
         self.find_head()  # assigns self.head
         self.find_body()  # assigns self.body
@@ -427,6 +602,20 @@ class CrunchyPage(BasePage):
         self.add_user_style()    # user's preferences can override Crunchy's
         return
 
+    def cache_key(self, filename):
+        """returns the key identifying the sanitized tree of the page in
+        page_cache, or None if it can not be cached"""
+        if filename is None:
+            return None
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        security_level = config[self.username]['page_security_level'](self.url)
+        return (filename, stat.st_mtime, stat.st_size, self.url,
+                security_level, self.is_remote, self.is_local,
+                self.html_parser())
+
     def process_tags(self):
         """process all the customised tags in the page"""
 